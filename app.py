@@ -1,59 +1,1043 @@
-from flask import Flask, render_template_string, request, session, redirect, url_for, send_from_directory, flash
+from flask import Flask, Blueprint, current_app, has_request_context, stream_with_context, render_template_string, request, session, redirect, url_for, send_from_directory, flash, g, Response, abort, jsonify
 from datetime import datetime
+from bisect import bisect_left, bisect_right, insort
+from array import array
+from urllib.parse import quote, urlencode
+from decimal import Decimal, ROUND_HALF_UP, InvalidOperation
+from functools import total_ordering
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import click
+import re
+import csv
+import io
+import json
+import itertools
+import operator
+import mimetypes
+import gzip
+import hashlib
+import hmac
+import math
+import shutil
+import zipfile
+import unicodedata
 import secrets
 import sqlite3
+import threading
+import random
+import queue
+import fcntl
+import signal
+import time
+import sys
 import os
 from werkzeug.utils import secure_filename
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.security import safe_join, generate_password_hash, check_password_hash
+from markupsafe import escape
 
-app = Flask(__name__)
-app.secret_key = secrets.token_hex(16)
+try:
+    import brotli
+except ImportError:
+    #optional, responses fall back to gzip without it
+    brotli = None
 
-DATABASE = 'bazaro.db'
-UPLOAD_FOLDER = 'product_images'
-ALLOWED_EXTENSIONS = {'png', 'jpeg', 'jpg', 'gif', 'webp'}
+bp = Blueprint('bazaro', __name__, cli_group=None)
 
-# Create upload folder if it doesn't exist
-if not os.path.exists(UPLOAD_FOLDER):
-    os.makedirs(UPLOAD_FOLDER)
+ALLOWED_EXTENSIONS = {'png', 'jpeg', 'jpg', 'gif', 'webp'}
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_FOLDER = os.path.join(BASE_DIR, 'static')
 
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+def default_config():
+    #every setting can be overridden with a BAZARO_* environment variable
+    env = os.environ.get
+    return {
+        'DATABASE': env('BAZARO_DATABASE', os.path.join(BASE_DIR, 'bazaro.db')),
+        # orders older than ARCHIVE_AFTER_DAYS are moved here by `flask archive-orders`
+        'ARCHIVE_DATABASE': env('BAZARO_ARCHIVE_DATABASE', os.path.join(BASE_DIR, 'bazaro.archive.db')),
+        'ARCHIVE_AFTER_DAYS': int(env('BAZARO_ARCHIVE_AFTER_DAYS', '365')),
+        'UPLOAD_FOLDER': env('BAZARO_UPLOAD_FOLDER', os.path.join(BASE_DIR, 'product_images')),
+        # shared by all workers, when unset it is generated once into the instance folder
+        'SECRET_KEY': env('BAZARO_SECRET_KEY'),
+        # idle connections kept per process, and sqlite page cache per connection
+        'DB_POOL_SIZE': int(env('BAZARO_DB_POOL_SIZE', '8')),
+        'DB_CACHE_SIZE_KB': int(env('BAZARO_DB_CACHE_SIZE_KB', '8192')),
+        'DB_TIMEOUT': float(env('BAZARO_DB_TIMEOUT', '5')),
+        # writer connections per process, sqlite only runs one write transaction at a time anyway
+        'WRITE_POOL_SIZE': int(env('BAZARO_WRITE_POOL_SIZE', '1')),
+        # seconds between snapshot copies for catalog reads, 0 reads the live database instead
+        'READ_SNAPSHOT_INTERVAL': float(env('BAZARO_READ_SNAPSHOT_INTERVAL', '0')),
+        'READ_SNAPSHOT_PATH': env('BAZARO_READ_SNAPSHOT_PATH', os.path.join(BASE_DIR, 'bazaro.snapshot.db')),
+        # comma separated emails of the users allowed to see the /admin pages
+        'ADMIN_EMAILS': {e.strip().lower() for e in env('BAZARO_ADMIN_EMAILS', '').split(',') if e.strip()},
+        # fraction of requests to profile (0 = off), requests sending X-Bazaro-Profile: <token> are always profiled
+        'PROFILE_SAMPLE_RATE': float(env('BAZARO_PROFILE_SAMPLE_RATE', '0')),
+        'PROFILE_TOKEN': env('BAZARO_PROFILE_TOKEN'),
+        'PROFILE_INTERVAL': float(env('BAZARO_PROFILE_INTERVAL', '0.005')),
+        # responses smaller than this many bytes are sent uncompressed
+        'COMPRESS_MIN_SIZE': int(env('BAZARO_COMPRESS_MIN_SIZE', '512')),
+        'COMPRESS_LEVEL': int(env('BAZARO_COMPRESS_LEVEL', '6')),
+        'BROTLI_QUALITY': int(env('BAZARO_BROTLI_QUALITY', '5')),
+        # background jobs: worker threads, seconds a claimed job is leased for, retries and the first retry delay
+        'JOB_WORKER_THREADS': int(env('BAZARO_JOB_WORKER_THREADS', '4')),
+        'JOB_LEASE_SECONDS': float(env('BAZARO_JOB_LEASE_SECONDS', '300')),
+        'JOB_MAX_ATTEMPTS': int(env('BAZARO_JOB_MAX_ATTEMPTS', '5')),
+        'JOB_BACKOFF_SECONDS': float(env('BAZARO_JOB_BACKOFF_SECONDS', '10')),
+        # `flask maintenance`: seconds between scheduler ticks, and without commits before a window counts as quiet
+        'MAINTENANCE_TICK_SECONDS': float(env('BAZARO_MAINTENANCE_TICK_SECONDS', '10')),
+        'MAINTENANCE_QUIET_SECONDS': float(env('BAZARO_MAINTENANCE_QUIET_SECONDS', '30')),
+        'WAL_TRUNCATE_BYTES': int(env('BAZARO_WAL_TRUNCATE_BYTES', str(64 * 1024 * 1024))),
+        'VACUUM_PAGES_PER_STEP': int(env('BAZARO_VACUUM_PAGES_PER_STEP', '1000')),
+        'BACKUP_DIR': env('BAZARO_BACKUP_DIR', os.path.join(BASE_DIR, 'backups')),
+        'BACKUP_INTERVAL_HOURS': float(env('BAZARO_BACKUP_INTERVAL_HOURS', '24')),
+        'BACKUP_KEEP': int(env('BAZARO_BACKUP_KEEP', '7')),
+        'BACKUP_PAGES_PER_STEP': int(env('BAZARO_BACKUP_PAGES_PER_STEP', '1024')),
+        'BACKUP_STEP_PAUSE': float(env('BAZARO_BACKUP_STEP_PAUSE', '0.05')),
+        # how long bookkeeping rows are kept before `flask maintenance` prunes them
+        'IDEMPOTENCY_KEY_HOURS': float(env('BAZARO_IDEMPOTENCY_KEY_HOURS', '24')),
+        'JOB_RETENTION_DAYS': float(env('BAZARO_JOB_RETENTION_DAYS', '7')),
+        'ITEM_CHANGES_KEEP': int(env('BAZARO_ITEM_CHANGES_KEEP', '10000')),
+        # password hashing threads per process, and how many logins may wait for one (for up to HASH_QUEUE_TIMEOUT seconds)
+        'HASH_WORKERS': int(env('BAZARO_HASH_WORKERS', '2')),
+        'HASH_QUEUE_SIZE': int(env('BAZARO_HASH_QUEUE_SIZE', '16')),
+        'HASH_QUEUE_TIMEOUT': float(env('BAZARO_HASH_QUEUE_TIMEOUT', '2')),
+        # login attempts per minute and burst size, per client IP and per email
+        'LOGIN_IP_RATE_PER_MINUTE': float(env('BAZARO_LOGIN_IP_RATE_PER_MINUTE', '30')),
+        'LOGIN_IP_BURST': int(env('BAZARO_LOGIN_IP_BURST', '10')),
+        'LOGIN_EMAIL_RATE_PER_MINUTE': float(env('BAZARO_LOGIN_EMAIL_RATE_PER_MINUTE', '6')),
+        'LOGIN_EMAIL_BURST': int(env('BAZARO_LOGIN_EMAIL_BURST', '5')),
+        # registrations per minute and burst size per client IP, a separate budget from the logins
+        'REGISTER_IP_RATE_PER_MINUTE': float(env('BAZARO_REGISTER_IP_RATE_PER_MINUTE', '10')),
+        'REGISTER_IP_BURST': int(env('BAZARO_REGISTER_IP_BURST', '5')),
+        # reverse proxies in front of the app whose X-Forwarded-For/-Proto are trusted, 0 uses the socket address
+        'PROXY_COUNT': int(env('BAZARO_PROXY_COUNT', '0')),
+        # filter and sort /products in an in-memory copy of the items columns, only the page itself is read from sqlite
+        'CATALOG_SNAPSHOT': env('BAZARO_CATALOG_SNAPSHOT', '0') not in ('', '0', 'false', 'no'),
+    }
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+@total_ordering
+class Money:
+    #an amount in integer cents, money is stored as INTEGER cents in the database
+    #so totals and balance checks are exact and can be summed in SQL
+    __slots__ = ('cents',)
+
+    def __init__(self, cents):
+        self.cents = int(cents)
+
+    @classmethod
+    def parse(cls, text):
+        #'12.5' -> Money(1250), raises ValueError for anything that isn't an amount
+        #or doesn't fit the INTEGER cents column
+        try:
+            value = Decimal(str(text).strip())
+            if not value.is_finite():
+                raise ValueError(f'invalid amount: {text!r}')
+            cents = (value * 100).quantize(Decimal('1'), rounding=ROUND_HALF_UP)
+        except ArithmeticError:
+            raise ValueError(f'invalid amount: {text!r}')
+        if not -2 ** 63 <= cents < 2 ** 63:
+            raise ValueError(f'amount out of range: {text!r}')
+        return cls(cents)
+
+    def __str__(self):
+        sign = '-' if self.cents < 0 else ''
+        return f'{sign}${abs(self.cents) // 100:,}.{abs(self.cents) % 100:02d}'
+
+    def plain(self):
+        #'1234.50', for files and APIs
+        sign = '-' if self.cents < 0 else ''
+        return f'{sign}{abs(self.cents) // 100}.{abs(self.cents) % 100:02d}'
+
+    def __repr__(self):
+        return f'Money({self.cents})'
+
+    def __add__(self, other):
+        return Money(self.cents + other.cents)
+
+    def __sub__(self, other):
+        return Money(self.cents - other.cents)
+
+    def __mul__(self, quantity):
+        return Money(self.cents * quantity)
+
+    def __neg__(self):
+        return Money(-self.cents)
+
+    def __eq__(self, other):
+        return isinstance(other, Money) and self.cents == other.cents
+
+    def __lt__(self, other):
+        return self.cents < other.cents
+
+    def __hash__(self):
+        return hash(self.cents)
+
+    def __bool__(self):
+        return self.cents != 0
+
+sqlite3.register_adapter(Money, lambda money: money.cents)
+
+def cart_cte(cart):
+    #the session cart as a CTE, so cart totals can be computed in SQL
+    values = ', '.join(['(?, ?)'] * len(cart))
+    params = [value for c in cart for value in (c['item_id'], c['quantity'])]
+    return f'WITH cart(item_id, quantity) AS (VALUES {values})', params
+
+# Wallet ledger. Every balance change is a wallet_transactions row with entries
+# on two or more accounts that sum to zero ('user:<id>' wallets, 'funding' for
+# money paid in, 'sales' for money paid out to the marketplace). Balances are
+# checkpointed into wallet_snapshots, so an account's balance is its snapshot
+# plus the few entries after it. Pages show that balance; users.wallet_balance_cents
+# is kept in step only for the guarded decrement that makes checkout atomic.
+WALLET_SNAPSHOT_EVERY = 50
+STATEMENT_PAGE_SIZE = 20
+
+def wallet_account(user_id):
+    return f'user:{user_id}'
+
+def post_wallet_transaction(cur, kind, legs, order_id=None):
+    #legs is [(account, Money)], call it inside the transaction that changes the balance
+    if sum(amount.cents for _, amount in legs) != 0:
+        raise ValueError(f'unbalanced wallet transaction: {legs!r}')
+    cur.execute('INSERT INTO wallet_transactions (kind, order_id) VALUES (?, ?)', (kind, order_id))
+    txn_id = cur.lastrowid
+    cur.executemany(
+        'INSERT INTO wallet_entries (txn_id, account, amount_cents) VALUES (?, ?, ?)',
+        [(txn_id, account, amount) for account, amount in legs]
+    )
+    for account, _ in legs:
+        checkpoint_wallet_account(cur, account, WALLET_SNAPSHOT_EVERY)
+    return txn_id
+
+def checkpoint_wallet_account(cur, account, min_entries=1):
+    #move the snapshot forward once at least min_entries entries piled up after it
+    cur.execute(
+        '''SELECT COUNT(*), COALESCE(SUM(e.amount_cents), 0), MAX(e.entry_id), s.balance_cents
+           FROM (SELECT ? AS account) a
+           LEFT JOIN wallet_snapshots s ON s.account = a.account
+           LEFT JOIN wallet_entries e ON e.account = a.account AND e.entry_id > COALESCE(s.entry_id, 0)''',
+        (account,)
+    )
+    count, recent, last_entry_id, snapshot = cur.fetchone()
+    if count >= min_entries and last_entry_id is not None:
+        cur.execute(
+            '''INSERT INTO wallet_snapshots (account, entry_id, balance_cents) VALUES (?, ?, ?)
+               ON CONFLICT (account) DO UPDATE SET entry_id = excluded.entry_id, balance_cents = excluded.balance_cents''',
+            (account, last_entry_id, (snapshot or 0) + recent)
+        )
+
+def ledger_balance(cur, account):
+    #snapshot + SUM(newer entries), the sum is an index-only range scan
+    cur.execute(
+        '''SELECT COALESCE(s.balance_cents, 0) + COALESCE((SELECT SUM(e.amount_cents) FROM wallet_entries e
+                                                          WHERE e.account = a.account AND e.entry_id > COALESCE(s.entry_id, 0)), 0)
+           FROM (SELECT ? AS account) a LEFT JOIN wallet_snapshots s ON s.account = a.account''',
+        (account,)
+    )
+    return Money(cur.fetchone()[0])
+
+# Idempotency keys: the cart and wallet forms carry a one-time key (API clients
+# can send an Idempotency-Key header), a duplicate submission of the same key
+# is answered with the stored redirect instead of running the write again.
+def idempotency_key():
+    return request.form.get('idempotency_key') or request.headers.get('Idempotency-Key')
+
+class IdempotencyKeyReused(Exception):
+    pass
+
+def idempotent_replay(cur, user_id):
+    #(redirect, order_id) stored for this submission if it was already processed;
+    #a key first used on another endpoint is an error, not a replay of this request
+    key = idempotency_key()
+    if not key:
+        return None
+    cur.execute('SELECT location, order_id, endpoint FROM idempotency_keys WHERE idem_key = ? AND user_id = ?', (key, user_id))
+    row = cur.fetchone()
+    if row and row[2] != request.endpoint:
+        raise IdempotencyKeyReused(key)
+    return (row[0], row[1]) if row else None
+
+@bp.app_errorhandler(IdempotencyKeyReused)
+def idempotency_key_reused(e):
+    #the connection the view had open is released by release_db_connections
+    message = 'This Idempotency-Key was already used for a different request.'
+    if request.blueprint == 'api':
+        return api_error(message, 422)
+    return render_page(f'<div class="alert alert-warning">{message}</div>', 'Error'), 422
+
+def remember_idempotent(cur, user_id, location, order_id=None):
+    #call inside the write transaction, so the key is stored exactly when the write commits
+    key = idempotency_key()
+    if key:
+        cur.execute(
+            'INSERT INTO idempotency_keys (idem_key, user_id, endpoint, location, order_id) VALUES (?, ?, ?, ?, ?)',
+            (key, user_id, request.endpoint, location, order_id)
+        )
+
+def begin_idempotent(cur, user_id):
+    #takes the write lock, returns the stored redirect if a concurrent duplicate committed first
+    replay = idempotent_replay(cur, user_id)
+    if replay:
+        return replay
+    cur.execute('BEGIN IMMEDIATE')
+    return idempotent_replay(cur, user_id)
+
+def check_idempotent(user_id):
+    #cheap pre-check on a read connection, so duplicates never queue for the writer
+    if not idempotency_key():
+        return None
+    conn = get_read_connection()
+    cur = conn.cursor()
+    replay = idempotent_replay(cur, user_id)
+    cur.close()
+    conn.close()
+    if replay:
+        metrics.inc('bazaro_idempotent_replays_total')
+    return replay
+
+def idempotency_field():
+    return f'<input type="hidden" name="idempotency_key" value="{secrets.token_urlsafe(16)}">'
+
+# Request metrics, exposed in Prometheus text format on /metrics
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+MAX_LIVE_SHARDS = 256
+
+class Metrics:
+    #every thread records into its own shard so the hot path never takes a lock,
+    #the shards are only summed up when /metrics is scraped
+    def __init__(self):
+        self.local = threading.local()
+        self.shards = []
+        self.retired = self.new_shard(None)
+        self.shards_lock = threading.Lock()
+
+    def new_shard(self, thread):
+        return {'thread': thread, 'latency': {}, 'status': {}, 'db': {}, 'counters': {}, 'in_flight': 0}
+
+    def shard(self):
+        shard = getattr(self.local, 'shard', None)
+        if shard is None:
+            shard = self.new_shard(threading.current_thread())
+            self.local.shard = shard
+            with self.shards_lock:
+                self.shards.append(shard)
+                if len(self.shards) > MAX_LIVE_SHARDS:
+                    self.retire_dead_shards()
+        return shard
+
+    def retire_dead_shards(self):
+        #fold shards of finished threads into one, so thread-per-request servers don't grow the list forever
+        #caller holds shards_lock
+        live = []
+        for shard in self.shards:
+            if shard['thread'].is_alive():
+                live.append(shard)
+            else:
+                merge_shard(self.retired, shard)
+        self.shards = live
+
+    def request_started(self):
+        self.shard()['in_flight'] += 1
+        self.local.db_seconds = 0.0
+        self.local.db_queries = 0
+
+    def request_finished(self, endpoint, status, seconds):
+        shard = self.shard()
+        shard['in_flight'] -= 1
+        hist = shard['latency'].get(endpoint)
+        if hist is None:
+            #bucket counts, then +Inf, then the sum
+            hist = shard['latency'][endpoint] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+        hist[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        hist[-1] += seconds
+        key = (endpoint, status)
+        shard['status'][key] = shard['status'].get(key, 0) + 1
+        db = shard['db'].get(endpoint)
+        if db is None:
+            db = shard['db'][endpoint] = [0.0, 0]
+        db[0] += getattr(self.local, 'db_seconds', 0.0)
+        db[1] += getattr(self.local, 'db_queries', 0)
+
+    def record_db(self, seconds, queries=0):
+        self.local.db_seconds = getattr(self.local, 'db_seconds', 0.0) + seconds
+        self.local.db_queries = getattr(self.local, 'db_queries', 0) + queries
+
+    def inc(self, name, amount=1):
+        counters = self.shard()['counters']
+        counters[name] = counters.get(name, 0) + amount
+
+    def snapshot(self):
+        total = self.new_shard(None)
+        with self.shards_lock:
+            self.retire_dead_shards()
+            merge_shard(total, self.retired)
+            shards = list(self.shards)
+        for shard in shards:
+            merge_shard(total, shard)
+        return total
+
+def merge_shard(into, shard):
+    for endpoint, hist in list(shard['latency'].items()):
+        target = into['latency'].setdefault(endpoint, [0] * (len(LATENCY_BUCKETS) + 1) + [0.0])
+        for i, value in enumerate(list(hist)):
+            target[i] += value
+    for key, value in list(shard['status'].items()):
+        into['status'][key] = into['status'].get(key, 0) + value
+    for endpoint, (seconds, queries) in list(shard['db'].items()):
+        target = into['db'].setdefault(endpoint, [0.0, 0])
+        target[0] += seconds
+        target[1] += queries
+    for name, value in list(shard['counters'].items()):
+        into['counters'][name] = into['counters'].get(name, 0) + value
+    into['in_flight'] += shard['in_flight']
+
+metrics = Metrics()
+
+# name -> help text for the counters bumped with metrics.inc()
+COUNTERS = {
+    'bazaro_orders_total': 'Orders placed through checkout.',
+    'bazaro_checkout_insufficient_funds_total': 'Checkouts rejected because the wallet balance was too low.',
+    'bazaro_stock_failures_total': 'Cart or checkout requests rejected because of missing stock.',
+    'bazaro_idempotent_replays_total': 'Duplicate checkout or add-funds submissions answered from the idempotency key.',
+    'bazaro_login_throttled_total': 'Login and register attempts rejected by the rate limiter or a full hashing pool.',
+}
+
+def render_metrics():
+    snap = metrics.snapshot()
+    lines = [
+        '# HELP bazaro_request_duration_seconds Request latency per endpoint.',
+        '# TYPE bazaro_request_duration_seconds histogram',
+    ]
+    for endpoint, hist in sorted(snap['latency'].items()):
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), hist[:-1]):
+            cumulative += count
+            lines.append(f'bazaro_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{bound}"}} {cumulative}')
+        lines.append(f'bazaro_request_duration_seconds_sum{{endpoint="{endpoint}"}} {hist[-1]:.6f}')
+        lines.append(f'bazaro_request_duration_seconds_count{{endpoint="{endpoint}"}} {cumulative}')
+    lines.append('# HELP bazaro_requests_total Responses per endpoint and status code.')
+    lines.append('# TYPE bazaro_requests_total counter')
+    for (endpoint, status), count in sorted(snap['status'].items()):
+        lines.append(f'bazaro_requests_total{{endpoint="{endpoint}",status="{status}"}} {count}')
+    lines.append('# HELP bazaro_db_seconds_total Time spent in SQLite per endpoint.')
+    lines.append('# TYPE bazaro_db_seconds_total counter')
+    for endpoint, (seconds, _) in sorted(snap['db'].items()):
+        lines.append(f'bazaro_db_seconds_total{{endpoint="{endpoint}"}} {seconds:.6f}')
+    lines.append('# HELP bazaro_db_queries_total SQL statements executed per endpoint.')
+    lines.append('# TYPE bazaro_db_queries_total counter')
+    for endpoint, (_, queries) in sorted(snap['db'].items()):
+        lines.append(f'bazaro_db_queries_total{{endpoint="{endpoint}"}} {queries}')
+    lines.append('# HELP bazaro_requests_in_flight Requests currently being handled.')
+    lines.append('# TYPE bazaro_requests_in_flight gauge')
+    lines.append(f'bazaro_requests_in_flight {snap["in_flight"]}')
+    for name, help_text in COUNTERS.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} counter')
+        lines.append(f'{name} {snap["counters"].get(name, 0)}')
+    return '\n'.join(lines) + '\n'
+
+# Sampling profiler: a single background thread looks at the stacks of the
+# threads serving profiled requests every PROFILE_INTERVAL seconds
+class SamplingProfiler:
+    def __init__(self):
+        self.active = {}
+        self.stacks = {}
+        self.requests = {}
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start_request(self, endpoint, interval):
+        self.interval = interval
+        self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+        self.active[threading.get_ident()] = endpoint
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.run, name='bazaro-profiler', daemon=True)
+                    self.thread.start()
+
+    def finish_request(self):
+        self.active.pop(threading.get_ident(), None)
+
+    def reset(self):
+        self.stacks = {}
+        self.requests = {}
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            if not self.active:
+                continue
+            frames = sys._current_frames()
+            for ident, endpoint in list(self.active.items()):
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                    frame = frame.f_back
+                if not stack:
+                    continue
+                stack.reverse()
+                counts = self.stacks.setdefault(endpoint, {})
+                key = tuple(stack)
+                counts[key] = counts.get(key, 0) + 1
+
+    def collected(self, endpoint):
+        #(stack, samples) pairs, 'all' merges every endpoint under a root frame named after it
+        if endpoint == 'all':
+            return [(((name, '', 0),) + stack, count)
+                    for name, counts in list(self.stacks.items())
+                    for stack, count in list(counts.items())]
+        return list(self.stacks.get(endpoint, {}).items())
+
+    def collapsed(self, endpoint):
+        lines = []
+        for stack, count in self.collected(endpoint):
+            frames = ';'.join(f'{name} ({filename}:{line})' if filename else name for name, filename, line in stack)
+            lines.append(f'{frames} {count}')
+        return '\n'.join(sorted(lines)) + '\n'
+
+    def speedscope(self, endpoint):
+        frames = []
+        frame_index = {}
+        samples = []
+        weights = []
+        interval = current_app.config['PROFILE_INTERVAL']
+        for stack, count in self.collected(endpoint):
+            sample = []
+            for frame in stack:
+                if frame not in frame_index:
+                    frame_index[frame] = len(frames)
+                    name, filename, line = frame
+                    frames.append({'name': name, 'file': filename, 'line': line} if filename else {'name': name})
+                sample.append(frame_index[frame])
+            samples.append(sample)
+            weights.append(count * interval)
+        return {
+            '$schema': 'https://www.speedscope.app/file-format-schema.json',
+            'name': f'bazaro {endpoint}',
+            'exporter': 'bazaro',
+            'shared': {'frames': frames},
+            'profiles': [{
+                'type': 'sampled',
+                'name': endpoint,
+                'unit': 'seconds',
+                'startValue': 0,
+                'endValue': sum(weights),
+                'samples': samples,
+                'weights': weights,
+            }],
+        }
+
+profiler = SamplingProfiler()
+
+def should_profile():
+    token = current_app.config['PROFILE_TOKEN']
+    if token and request.headers.get('X-Bazaro-Profile') == token:
+        return True
+    rate = current_app.config['PROFILE_SAMPLE_RATE']
+    return rate > 0 and random.random() < rate
+
+class TimedCursor(sqlite3.Cursor):
+    #adds the time spent in sqlite to the current request's db time
+    def execute(self, *args):
+        start = time.perf_counter()
+        try:
+            return super().execute(*args)
+        finally:
+            metrics.record_db(time.perf_counter() - start, 1)
+
+    def executemany(self, *args):
+        start = time.perf_counter()
+        try:
+            return super().executemany(*args)
+        finally:
+            metrics.record_db(time.perf_counter() - start, 1)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            metrics.record_db(time.perf_counter() - start)
+
+    def fetchmany(self, *args):
+        start = time.perf_counter()
+        try:
+            return super().fetchmany(*args)
+        finally:
+            metrics.record_db(time.perf_counter() - start)
+
+    def fetchall(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            metrics.record_db(time.perf_counter() - start)
+
+class TimedConnection(sqlite3.Connection):
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+class PooledConnection(TimedConnection):
+    #close() hands the connection back to its pool instead of closing it
+    pool = None
+    generation = None
+    checked_out = False
+    archive_attached = False
+
+    def close(self):
+        if self.pool is None:
+            super().close()
+        elif self.checked_out:
+            self.pool.put(self)
+
+class ConnectionPool:
+    #mode is 'rw' for the writer, 'ro' for read-only connections to the live
+    #database and 'snapshot' for reads from the periodically copied snapshot
+    def __init__(self, app, mode, size, max_open=None):
+        self.database = app.config['DATABASE']
+        self.cache_size_kb = app.config['DB_CACHE_SIZE_KB']
+        self.timeout = app.config['DB_TIMEOUT']
+        self.mode = mode
+        self.pid = os.getpid()
+        self.idle = queue.LifoQueue(maxsize=size)
+        #with max_open, callers wait for a free connection instead of opening more
+        self.slots = threading.BoundedSemaphore(max_open) if max_open else None
+        self.snapshot = get_read_snapshot(app) if mode == 'snapshot' else None
+
+    def connect(self):
+        if self.mode == 'rw':
+            conn = sqlite3.connect(self.database, timeout=self.timeout, factory=PooledConnection, check_same_thread=False)
+        elif self.mode == 'ro':
+            conn = sqlite3.connect(f'file:{quote(self.database)}?mode=ro', uri=True, timeout=self.timeout,
+                                   factory=PooledConnection, check_same_thread=False)
+        else:
+            #the snapshot file is replaced, never modified, so sqlite can skip locking entirely
+            generation, path = self.snapshot.current()
+            conn = sqlite3.connect(f'file:{quote(path)}?mode=ro&immutable=1', uri=True,
+                                   factory=PooledConnection, check_same_thread=False)
+            conn.generation = generation
+        conn.row_factory = sqlite3.Row
+        conn.execute(f'PRAGMA cache_size = -{self.cache_size_kb}')
+        conn.pool = self
+        return conn
+
+    def get(self):
+        if self.slots is not None and not self.slots.acquire(timeout=self.timeout):
+            raise sqlite3.OperationalError('timed out waiting for a database connection')
+        try:
+            conn = None
+            while conn is None:
+                try:
+                    conn = self.idle.get_nowait()
+                except queue.Empty:
+                    conn = self.connect()
+                    break
+                if self.snapshot is not None and conn.generation != self.snapshot.current()[0]:
+                    #a newer snapshot was taken since this connection was opened
+                    conn.pool = None
+                    conn.close()
+                    conn = None
+        except BaseException:
+            if self.slots is not None:
+                self.slots.release()
+            raise
+        conn.checked_out = True
+        if has_request_context():
+            g.setdefault('db_connections', []).append(conn)
+        return conn
+
+    def put(self, conn):
+        conn.checked_out = False
+        if conn.in_transaction:
+            #a request bailed out without committing
+            conn.rollback()
+        try:
+            self.idle.put_nowait(conn)
+        except queue.Full:
+            conn.pool = None
+            conn.close()
+        if self.slots is not None:
+            self.slots.release()
+
+class ReadSnapshot:
+    #a copy of the database taken with the sqlite backup API every READ_SNAPSHOT_INTERVAL seconds,
+    #catalog reads go there so they never wait behind the writer
+    def __init__(self, database, path, interval, logger):
+        self.database = database
+        self.path = path
+        self.interval = interval
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def current(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            self.refresh()
+            stat = os.stat(self.path)
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.run, name='bazaro-snapshot', daemon=True)
+                    self.thread.start()
+        return stat.st_mtime_ns, self.path
+
+    def run(self):
+        while True:
+            time.sleep(self.interval / 2)
+            try:
+                if time.time() - os.stat(self.path).st_mtime >= self.interval:
+                    self.refresh()
+            except Exception as e:
+                #catalog reads keep using the old copy, so it goes stale until a refresh works again
+                self.logger.warning('read snapshot refresh failed: %s', e)
+
+    def refresh(self):
+        #the lock file keeps several workers from copying the database at the same time
+        with self.lock, open(self.path + '.lock', 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                #another process is refreshing, wait for it and use its copy
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                if os.path.exists(self.path):
+                    return
+            tmp_path = f'{self.path}.{os.getpid()}.tmp'
+            src = sqlite3.connect(f'file:{quote(self.database)}?mode=ro', uri=True)
+            dst = sqlite3.connect(tmp_path)
+            try:
+                src.backup(dst)
+                dst.execute('PRAGMA journal_mode = DELETE')
+            finally:
+                dst.close()
+                src.close()
+            os.replace(tmp_path, self.path)
+
+def get_read_snapshot(app):
+    snapshot = app.extensions.get('bazaro_snapshot')
+    if snapshot is None or snapshot.thread is not None and not snapshot.thread.is_alive():
+        snapshot = ReadSnapshot(app.config['DATABASE'], app.config['READ_SNAPSHOT_PATH'], app.config['READ_SNAPSHOT_INTERVAL'], app.logger)
+        app.extensions['bazaro_snapshot'] = snapshot
+    return snapshot
+
+POOLS_LOCK = threading.Lock()
+
+def get_pool(app, mode):
+    pools = app.extensions.setdefault('bazaro_pools', {})
+    pool = pools.get(mode)
+    #sqlite connections must not cross a fork, so a forked worker starts its own pools
+    if pool is None or pool.pid != os.getpid():
+        #two threads serving their first request must not both open an rw pool
+        with POOLS_LOCK:
+            pool = pools.get(mode)
+            if pool is None or pool.pid != os.getpid():
+                if mode == 'rw':
+                    pool = ConnectionPool(app, mode, app.config['WRITE_POOL_SIZE'], max_open=app.config['WRITE_POOL_SIZE'])
+                else:
+                    pool = ConnectionPool(app, mode, app.config['DB_POOL_SIZE'])
+                #the schema is checked on the first connection of a process, not at import time
+                conn = pool.get()
+                try:
+                    check_schema(conn)
+                finally:
+                    conn.close()
+                pools[mode] = pool
+    return pool
+
 def get_db_connection():
     #Create and return a database connection
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
-    return conn
+    #this is the writer, use get_read_connection() for pages that only read
+    return get_pool(current_app, 'rw').get()
+
+def get_read_connection(snapshot_ok=False):
+    #read-only connection, snapshot_ok=True allows reading a copy that may be
+    #up to READ_SNAPSHOT_INTERVAL seconds old (catalog pages)
+    if snapshot_ok and current_app.config['READ_SNAPSHOT_INTERVAL'] > 0:
+        return get_pool(current_app, 'snapshot').get()
+    return get_pool(current_app, 'ro').get()
 
-def init_database():
+# Schema migrations, applied in order by `flask migrate`. PRAGMA user_version
+# stores how many have run, so checking for pending ones costs a single read.
+def migration_item_columns(cur):
     #onceden yoktu foto columnu onu koymak icin
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
     cur.execute("PRAGMA table_info(items)")
     columns = [column[1] for column in cur.fetchall()]
     
     if 'image_filename' not in columns:
         cur.execute('ALTER TABLE items ADD COLUMN image_filename TEXT DEFAULT "temp.jpg"')
-        conn.commit()
         print("image_filename column added")
     
     # Add owner_user_id column to track which user added the product
     if 'owner_user_id' not in columns:
         cur.execute('ALTER TABLE items ADD COLUMN owner_user_id INTEGER')
-        conn.commit()
         print("owner_user_id column added")
+
+def migration_integer_cents(cur):
+    #REAL dollars -> INTEGER cents
+    for table, column in [('items', 'price'), ('users', 'wallet_balance'), ('orders', 'total_price'), ('order_items', 'price')]:
+        cur.execute(f'ALTER TABLE {table} ADD COLUMN {column}_cents INTEGER NOT NULL DEFAULT 0')
+        cur.execute(f'UPDATE {table} SET {column}_cents = CAST(ROUND({column} * 100) AS INTEGER)')
+        cur.execute(f'ALTER TABLE {table} DROP COLUMN {column}')
+
+def migration_wallet_ledger(cur):
+    cur.execute('''
+        CREATE TABLE wallet_transactions (
+            txn_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            order_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (order_id) REFERENCES orders(order_id)
+        )''')
+    cur.execute('''
+        CREATE TABLE wallet_entries (
+            entry_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            txn_id INTEGER NOT NULL,
+            account TEXT NOT NULL,
+            amount_cents INTEGER NOT NULL,
+            FOREIGN KEY (txn_id) REFERENCES wallet_transactions(txn_id)
+        )''')
+    # covers both the balance sums and the statement pages
+    cur.execute('CREATE INDEX idx_wallet_entries_account ON wallet_entries (account, entry_id, amount_cents, txn_id)')
+    cur.execute('''
+        CREATE TABLE wallet_snapshots (
+            account TEXT PRIMARY KEY,
+            entry_id INTEGER NOT NULL,
+            balance_cents INTEGER NOT NULL
+        )''')
+    # the balances from before the ledger become opening entries
+    cur.execute('SELECT user_id, wallet_balance_cents FROM users WHERE wallet_balance_cents != 0')
+    for user_id, balance in cur.fetchall():
+        post_wallet_transaction(cur, 'opening', [(wallet_account(user_id), Money(balance)), ('funding', Money(-balance))])
+
+# Facet counts for /products, kept up to date by triggers on items so the page
+# reads them from facet_counts instead of aggregating over items.
+# (lower bound in cents, label), the last band has no upper bound
+TOP_SELLER_FACETS = 10
+PRICE_BANDS = [(0, 'Under $10'), (1000, '$10 - $50'), (5000, '$50 - $100'), (10000, '$100 - $500'), (50000, '$500 and up')]
+
+def price_band_sql(column):
+    cases = ' '.join(f"WHEN {column} >= {low} THEN '{low}'" for low, _ in reversed(PRICE_BANDS[1:]))
+    return f"CASE {cases} ELSE '0' END"
+
+def facet_values_sql(row):
+    #(facet, value expression) for a row of items, row is 'new' or 'old' inside a trigger;
+    #items without a category or owner count under '', facet_counts keys can't be NULL
+    return [
+        ('category', f"COALESCE(CAST({row}.category_id AS TEXT), '')"),
+        ('price', price_band_sql(f'{row}.price_cents')),
+        ('stock', f"CASE WHEN {row}.quantity > 0 THEN 'in' ELSE 'out' END"),
+        ('seller', f"COALESCE('s:' || {row}.seller_id, 'u:' || {row}.owner_user_id, '')"),
+    ]
+
+def facet_triggers_sql():
+    change = '''INSERT INTO facet_counts (facet, value, count) VALUES ('{facet}', {value}, {delta})
+                ON CONFLICT (facet, value) DO UPDATE SET count = count + {delta};'''
+    new_values = facet_values_sql('new')
+    old_values = facet_values_sql('old')
+    statements = [
+        'CREATE TRIGGER items_facets_insert AFTER INSERT ON items BEGIN '
+        + ' '.join(change.format(facet=f, value=v, delta=1) for f, v in new_values) + ' END',
+        'CREATE TRIGGER items_facets_delete AFTER DELETE ON items BEGIN '
+        + ' '.join(change.format(facet=f, value=v, delta=-1) for f, v in old_values) + ' END',
+    ]
+    #one update trigger per facet, so a checkout only touches facet_counts when an item sells out
+    for (facet, new_value), (_, old_value) in zip(new_values, old_values):
+        statements.append(
+            f'CREATE TRIGGER items_facets_update_{facet} AFTER UPDATE ON items WHEN ({old_value}) IS NOT ({new_value}) BEGIN '
+            + change.format(facet=facet, value=old_value, delta=-1) + ' '
+            + change.format(facet=facet, value=new_value, delta=1) + ' END'
+        )
+    return statements
+
+def rebuild_facet_counts(cur):
+    cur.execute('DELETE FROM facet_counts')
+    for facet, value in facet_values_sql('items'):
+        cur.execute(f"INSERT INTO facet_counts (facet, value, count) SELECT '{facet}', {value}, COUNT(*) FROM items GROUP BY 2")
+
+def migration_idempotency_keys(cur):
+    cur.execute('''
+        CREATE TABLE idempotency_keys (
+            idem_key TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            endpoint TEXT NOT NULL,
+            location TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        ) WITHOUT ROWID''')
+    cur.execute('CREATE INDEX idx_idempotency_keys_created ON idempotency_keys (created_at)')
+
+def migration_facet_counts(cur):
+    cur.execute('''
+        CREATE TABLE facet_counts (
+            facet TEXT NOT NULL,
+            value TEXT,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (facet, value)
+        ) WITHOUT ROWID''')
+    for statement in facet_triggers_sql():
+        cur.execute(statement)
+    rebuild_facet_counts(cur)
+    # the facet filters
+    cur.execute('CREATE INDEX idx_items_category ON items (category_id)')
+    cur.execute('CREATE INDEX idx_items_seller ON items (seller_id)')
+    cur.execute('CREATE INDEX idx_items_owner ON items (owner_user_id)')
+
+def migration_sort_indexes(cur):
+    #units sold per item, bumped by checkout so "best selling" never aggregates order_items
+    cur.execute('ALTER TABLE items ADD COLUMN sales_count INTEGER NOT NULL DEFAULT 0')
+    cur.execute('UPDATE items SET sales_count = (SELECT COALESCE(SUM(quantity), 0) FROM order_items oi WHERE oi.item_id = items.item_id)')
+    # one index per sort order, with and without a category filter; item_id breaks ties for the keyset cursors
+    cur.execute('CREATE INDEX idx_items_price ON items (price_cents, item_id)')
+    cur.execute('CREATE INDEX idx_items_category_price ON items (category_id, price_cents, item_id)')
+    cur.execute('CREATE INDEX idx_items_sales ON items (sales_count, item_id)')
+    cur.execute('CREATE INDEX idx_items_category_sales ON items (category_id, sales_count, item_id)')
+
+def migration_item_changes(cur):
+    #every write to items leaves its item_id here, in-memory copies of the catalog
+    #(like the suggest index) catch up by reading the changes after the last one they saw
+    cur.execute('''
+        CREATE TABLE item_changes (
+            change_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            item_id INTEGER NOT NULL
+        )''')
+    cur.execute('CREATE TRIGGER items_changes_insert AFTER INSERT ON items BEGIN INSERT INTO item_changes (item_id) VALUES (new.item_id); END')
+    cur.execute('CREATE TRIGGER items_changes_delete AFTER DELETE ON items BEGIN INSERT INTO item_changes (item_id) VALUES (old.item_id); END')
+    cur.execute('''CREATE TRIGGER items_changes_update AFTER UPDATE ON items BEGIN
+                   INSERT INTO item_changes (item_id) VALUES (new.item_id); END''')
+
+def migration_api_indexes(cur):
+    #the API replays a checkout with its order id, and orders are paged by id
+    cur.execute('ALTER TABLE idempotency_keys ADD COLUMN order_id INTEGER')
+    cur.execute('CREATE INDEX idx_orders_buyer ON orders (buyer_id, order_id)')
+    cur.execute('CREATE INDEX idx_order_items_order ON order_items (order_id)')
+    cur.execute('CREATE INDEX idx_payments_order ON payments (order_id)')
+
+def migration_jobs(cur):
+    #background job queue, run_after doubles as the lease expiry while a job is running
+    cur.execute('''
+        CREATE TABLE jobs (
+            job_id INTEGER PRIMARY KEY,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            run_after REAL NOT NULL,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    ''')
+    cur.execute('CREATE INDEX idx_jobs_ready ON jobs (status, run_after)')
+
+def migration_sales_rollups(cur):
+    #reporting tables, kept current by the order_placed job; sales_rollup_orders
+    #records which orders are already counted so applying one twice is harmless
+    cur.execute('CREATE TABLE sales_daily (day TEXT PRIMARY KEY, orders INTEGER NOT NULL, units INTEGER NOT NULL, revenue_cents INTEGER NOT NULL) WITHOUT ROWID')
+    cur.execute('CREATE TABLE sales_by_category (category_id INTEGER PRIMARY KEY, units INTEGER NOT NULL, revenue_cents INTEGER NOT NULL)')
+    cur.execute('CREATE TABLE sales_by_seller (seller_key TEXT PRIMARY KEY, units INTEGER NOT NULL, revenue_cents INTEGER NOT NULL) WITHOUT ROWID')
+    cur.execute('CREATE TABLE sales_by_item (item_id INTEGER PRIMARY KEY, units INTEGER NOT NULL, revenue_cents INTEGER NOT NULL)')
+    cur.execute('CREATE INDEX idx_sales_by_item_revenue ON sales_by_item (revenue_cents)')
+    cur.execute('CREATE TABLE sales_rollup_orders (order_id INTEGER PRIMARY KEY)')
+    rebuild_sales_rollups(cur)
+
+def migration_co_purchases(cur):
+    #filled by `flask rebuild-co-purchases`, then kept current by the order_placed job
+    cur.execute('''CREATE TABLE co_purchases (item_id INTEGER, other_item_id INTEGER, count INTEGER NOT NULL,
+                   PRIMARY KEY (item_id, other_item_id)) WITHOUT ROWID''')
+    cur.execute('''CREATE TABLE co_purchase_top (item_id INTEGER, rank INTEGER, other_item_id INTEGER NOT NULL, count INTEGER NOT NULL,
+                   PRIMARY KEY (item_id, rank)) WITHOUT ROWID''')
+    cur.execute('CREATE TABLE co_purchase_orders (order_id INTEGER PRIMARY KEY)')
+
+def migration_image_index(cur):
+    #gc-images and delete_product look items up by image
+    cur.execute('CREATE INDEX idx_items_image ON items (image_filename)')
+
+def migration_facet_null_values(cur):
+    #the facet triggers failed on items without a category or owner, recreate them with the '' value
+    cur.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'items_facets_%'")
+    for (name,) in cur.fetchall():
+        cur.execute(f'DROP TRIGGER {name}')
+    for statement in facet_triggers_sql():
+        cur.execute(statement)
+    rebuild_facet_counts(cur)
+
+def migration_idempotency_user_keys(cur):
+    #keys are only unique per user, two clients may well send the same Idempotency-Key
+    cur.execute('''
+        CREATE TABLE idempotency_keys_new (
+            idem_key TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            endpoint TEXT NOT NULL,
+            location TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            order_id INTEGER,
+            PRIMARY KEY (user_id, idem_key)
+        ) WITHOUT ROWID''')
+    cur.execute('''INSERT INTO idempotency_keys_new (idem_key, user_id, endpoint, location, created_at, order_id)
+                   SELECT idem_key, user_id, endpoint, location, created_at, order_id FROM idempotency_keys''')
+    cur.execute('DROP TABLE idempotency_keys')
+    cur.execute('ALTER TABLE idempotency_keys_new RENAME TO idempotency_keys')
+    cur.execute('CREATE INDEX idx_idempotency_keys_created ON idempotency_keys (created_at)')
+
+MIGRATIONS = [
+    migration_item_columns,
+    migration_integer_cents,
+    migration_wallet_ledger,
+    migration_idempotency_keys,
+    migration_facet_counts,
+    migration_sort_indexes,
+    migration_item_changes,
+    migration_api_indexes,
+    migration_jobs,
+    migration_sales_rollups,
+    migration_co_purchases,
+    migration_image_index,
+    migration_idempotency_user_keys,
+    migration_facet_null_values,
+]
+
+def migrate(app):
+    # Create upload folder if it doesn't exist
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
     
+    conn = sqlite3.connect(app.config['DATABASE'], isolation_level=None)
+    cur = conn.cursor()
+    #WAL lets the read-only connections read while a checkout is writing
+    cur.execute('PRAGMA journal_mode = WAL')
+    version = cur.execute('PRAGMA user_version').fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        cur.execute('BEGIN IMMEDIATE')
+        try:
+            migration(cur)
+            cur.execute(f'PRAGMA user_version = {number}')
+            cur.execute('COMMIT')
+        except Exception:
+            cur.execute('ROLLBACK')
+            raise
+        click.echo(f"migration {number} ({migration.__name__}) applied")
     cur.close()
     conn.close()
 
+def check_schema(conn):
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    if version < len(MIGRATIONS):
+        raise RuntimeError(f'database schema is at version {version} but the code expects {len(MIGRATIONS)}, run `flask --app app migrate`')
+
+def is_admin(user):
+    return bool(user) and user['email'].lower() in current_app.config['ADMIN_EMAILS']
+
 def get_current_user():
     #get the current user
     user_id = session.get('user_id')
     if user_id:
-        conn = get_db_connection()
+        conn = get_read_connection()
         cur = conn.cursor()
         cur.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
         user = cur.fetchone()
@@ -62,10 +1046,201 @@ def get_current_user():
         return dict(user) if user else None
     return None
 
+@bp.before_app_request
+def start_request_metrics():
+    g.request_start = time.perf_counter()
+    metrics.request_started()
+
+@bp.after_app_request
+def remember_response_status(response):
+    g.response_status = response.status_code
+    return response
+
+@bp.teardown_app_request
+def finish_request_metrics(exc):
+    if 'request_start' not in g:
+        return
+    #after_request is skipped when the view raised, that ends up as a 500
+    status = g.get('response_status', 500)
+    metrics.request_finished(request.endpoint or 'unmatched', status, time.perf_counter() - g.request_start)
+
+@bp.teardown_app_request
+def release_db_connections(exc):
+    #hand back connections a view forgot to close (or couldn't, because it raised),
+    #otherwise a leaked writer would block every later write
+    for conn in g.get('db_connections', []):
+        if conn.checked_out:
+            conn.close()
+
+@bp.before_app_request
+def start_profiling():
+    if should_profile():
+        g.profiled = True
+        profiler.start_request(request.endpoint or 'unmatched', current_app.config['PROFILE_INTERVAL'])
+
+@bp.teardown_app_request
+def stop_profiling(exc):
+    if g.get('profiled'):
+        profiler.finish_request()
+
+@bp.route('/metrics')
+def metrics_endpoint():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@bp.route('/admin/profiles')
+def admin_profiles():
+    if not is_admin(get_current_user()):
+        abort(403)
+    
+    rows_html = ''
+    for endpoint in sorted(profiler.stacks):
+        samples = sum(profiler.stacks[endpoint].values())
+        rows_html += f'''
+            <div style="display: flex; justify-content: space-between; padding: 0.5rem 0; border-bottom: 1px solid #E5E7EB;">
+                <span><strong>{endpoint}</strong> ({profiler.requests.get(endpoint, 0)} requests, {samples} samples)</span>
+                <span>
+                    <a href="/admin/profiles/{endpoint}/collapsed.txt" class="seller-link">collapsed</a> |
+                    <a href="/admin/profiles/{endpoint}/speedscope.json" class="seller-link">speedscope</a>
+                </span>
+            </div>
+        '''
+    
+    content = f'''
+        <h2 style="margin-bottom: 1.5rem;">Profiles</h2>
+        <div class="card">
+            <p style="color: #6B7280; margin-bottom: 1rem;">Sample rate: {current_app.config['PROFILE_SAMPLE_RATE']}, interval: {current_app.config['PROFILE_INTERVAL'] * 1000:.1f} ms</p>
+            {rows_html if rows_html else '<p>No profiles collected yet</p>'}
+            <div style="display: flex; gap: 1rem; margin-top: 1.5rem;">
+                <a href="/admin/profiles/all/collapsed.txt" class="btn btn-primary">Download all (collapsed)</a>
+                <form method="POST" action="/admin/profiles/reset">
+                    <button type="submit" class="btn btn-danger">Reset</button>
+                </form>
+            </div>
+        </div>
+    '''
+    return render_page(content, 'Profiles')
+
+@bp.route('/admin/profiles/<endpoint>/collapsed.txt')
+def admin_profile_collapsed(endpoint):
+    if not is_admin(get_current_user()):
+        abort(403)
+    response = Response(profiler.collapsed(endpoint), mimetype='text/plain')
+    response.headers['Content-Disposition'] = f'attachment; filename={endpoint}.collapsed.txt'
+    return response
+
+@bp.route('/admin/profiles/<endpoint>/speedscope.json')
+def admin_profile_speedscope(endpoint):
+    if not is_admin(get_current_user()):
+        abort(403)
+    response = jsonify(profiler.speedscope(endpoint))
+    response.headers['Content-Disposition'] = f'attachment; filename={endpoint}.speedscope.json'
+    return response
+
+@bp.route('/admin/profiles/reset', methods=['POST'])
+def admin_profiles_reset():
+    if not is_admin(get_current_user()):
+        abort(403)
+    profiler.reset()
+    return redirect('/admin/profiles')
+
+# Compression. Dynamic responses are compressed per request; static files and
+# product images get .br/.gz sidecars written once by `flask precompress` or at
+# upload, and are sent as they are.
+COMPRESSIBLE_MIMETYPES = {'text/html', 'text/css', 'text/plain', 'text/csv', 'application/json', 'application/javascript', 'image/svg+xml'}
+# a sidecar is only kept when it is at least this much smaller than the original
+PRECOMPRESS_MIN_SAVING = 0.1
+
+def compress_response(response, min_size, level, brotli_quality):
+    #brotli when the client takes it and the module is installed, gzip otherwise; returns the encoding used
+    if (response.direct_passthrough or response.is_streamed or response.status_code in (204, 304)
+            or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return None
+    response.vary.add('Accept-Encoding')
+    body = response.get_data()
+    if len(body) < min_size:
+        return None
+    accepted = request.accept_encodings
+    if brotli and accepted['br']:
+        encoding, body = 'br', brotli.compress(body, quality=brotli_quality)
+    elif accepted['gzip']:
+        encoding, body = 'gzip', gzip.compress(body, compresslevel=level, mtime=0)
+    else:
+        return None
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    return encoding
+
+@bp.after_app_request
+def compress_dynamic_response(response):
+    config = current_app.config
+    compress_response(response, config['COMPRESS_MIN_SIZE'], config['COMPRESS_LEVEL'], config['BROTLI_QUALITY'])
+    return response
+
+def precompress_file(path):
+    #writes path.br/path.gz next to the file when worth it, returns the bytes saved
+    with open(path, 'rb') as f:
+        data = f.read()
+    saved = 0
+    encoders = [('.gz', lambda d: gzip.compress(d, compresslevel=9, mtime=0))]
+    if brotli:
+        encoders.append(('.br', lambda d: brotli.compress(d, quality=11)))
+    for suffix, encode in encoders:
+        sidecar = path + suffix
+        if os.path.exists(sidecar) and os.path.getmtime(sidecar) >= os.path.getmtime(path):
+            continue
+        compressed = encode(data)
+        if len(compressed) <= len(data) * (1 - PRECOMPRESS_MIN_SAVING):
+            with open(sidecar + '.tmp', 'wb') as f:
+                f.write(compressed)
+            os.replace(sidecar + '.tmp', sidecar)
+            saved += len(data) - len(compressed)
+        elif os.path.exists(sidecar):
+            #stale sidecar of an older version of the file
+            os.remove(sidecar)
+    return saved
+
+def send_precompressed(directory, filename, max_age=None):
+    #the .br or .gz sidecar when the client accepts it, otherwise the file itself
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    accepted = request.accept_encodings
+    for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+        sidecar = safe_join(directory, filename + suffix)
+        if accepted[encoding] and sidecar and os.path.isfile(sidecar):
+            response = send_from_directory(directory, filename + suffix, mimetype=mimetype, max_age=max_age)
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_from_directory(directory, filename, mimetype=mimetype, max_age=max_age)
+    response.vary.add('Accept-Encoding')
+    return response
+
+def stylesheet_version():
+    #content hash for the stylesheet url, so browsers can cache it for good
+    with open(os.path.join(STATIC_FOLDER, 'bazaro.css'), 'rb') as f:
+        return hashlib.blake2b(f.read(), digest_size=6).hexdigest()
+
+STYLESHEET_VERSION = stylesheet_version()
+
+@bp.route('/static/<path:filename>')
+def static_file(filename):
+    #versioned urls never change content
+    return send_precompressed(STATIC_FOLDER, filename, max_age=31536000 if request.args.get('v') else 3600)
+
 #image location
-@app.route('/product_images/<filename>')
+@bp.route('/product_images/<filename>')
 def product_image(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    return send_precompressed(current_app.config['UPLOAD_FOLDER'], filename)
+
+@bp.cli.command('precompress')
+def precompress_command():
+    #writes compressed sidecars for the stylesheet and product images, run at deploy time
+    saved = 0
+    for folder in (STATIC_FOLDER, current_app.config['UPLOAD_FOLDER']):
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.is_file() and not entry.name.endswith(('.gz', '.br', '.tmp')):
+                    saved += precompress_file(entry.path)
+    click.echo(f'precompressed, {saved} bytes saved')
 
 def render_page(content, page_title='Bazaro'):
     current_user = get_current_user()
@@ -93,74 +1268,7 @@ def render_page(content, page_title='Bazaro'):
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Bazaro - {page_title}</title>
-    <style>
-        * {{ margin: 0; padding: 0; box-sizing: border-box; }}
-        body {{ font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif; background: linear-gradient(to bottom, #EBF4FF, #FFFFFF); min-height: 100vh; }}
-        .header {{ background: linear-gradient(to right, #2563EB, #1E40AF); color: white; padding: 1rem 0; box-shadow: 0 2px 10px rgba(0,0,0,0.1); position: sticky; top: 0; z-index: 1000; }}
-        .header-content {{ max-width: 1200px; margin: 0 auto; padding: 0 1rem; display: flex; justify-content: space-between; align-items: center; flex-wrap: wrap; }}
-        .logo {{ display: flex; align-items: center; gap: 0.5rem; font-size: 1.5rem; font-weight: bold; }}
-        .nav-links {{ display: flex; gap: 2rem; align-items: center; flex-wrap: wrap; }}
-        .nav-links a {{ color: white; text-decoration: none; transition: opacity 0.3s; }}
-        .nav-links a:hover {{ opacity: 0.8; }}
-        .btn {{ padding: 0.5rem 1.5rem; border: none; border-radius: 0.5rem; cursor: pointer; font-size: 1rem; font-weight: 600; transition: all 0.3s; text-decoration: none; display: inline-block; }}
-        .btn-primary {{ background: #2563EB; color: white; }}
-        .btn-primary:hover {{ background: #1D4ED8; }}
-        .btn-success {{ background: #059669; color: white; }}
-        .btn-success:hover {{ background: #047857; }}
-        .btn-danger {{ background: #DC2626; color: white; }}
-        .btn-danger:hover {{ background: #B91C1C; }}
-        .btn-white {{ background: #2563EB; color: #2563EB; padding: 0.5rem 1.5rem; }}
-        .btn-white:hover {{ background: #F3F4F6; }}
-        .container {{ max-width: 1200px; margin: 0 auto; padding: 2rem 1rem; }}
-        .card {{ background: white; border-radius: 1rem; padding: 2rem; box-shadow: 0 4px 6px rgba(0,0,0,0.1); margin-bottom: 1.5rem; }}
-        .grid {{ display: grid; gap: 1.5rem; }}
-        .grid-2 {{ grid-template-columns: repeat(auto-fit, minmax(300px, 1fr)); }}
-        .forstock {{position: relative; text-align: center;}}
-        .forstock .stock{{position: absolute; top: 43.75%; background: rgb(0, 0, 0); background: rgba(0, 0, 0, 0.5); color: #f1f1f1; width: 92.5%; padding: 157px; border-radius: 15px; text-align: center; left: 50.3%; transform: translate(-50%, -50%);}}
-        .grid-3 {{ grid-template-columns: repeat(auto-fit, minmax(250px, 1fr)); }}
-        .grid-4 {{ grid-template-columns: repeat(auto-fit, minmax(200px, 1fr)); }}
-        .product-card {{ background: white; border-radius: 1rem; overflow: hidden; box-shadow: 0 2px 8px rgba(0,0,0,0.1); transition: transform 0.3s, box-shadow 0.3s; cursor: pointer; }}
-        .product-card:hover {{ transform: translateY(-5px); box-shadow: 0 8px 16px rgba(0,0,0,0.15); }}
-        .product-image {{ width: 100%; height: 200px; object-fit: cover; background: #F3F4F6; }}
-        .product-info {{ padding: 1rem; }}
-        .product-category {{ color: #2563EB; font-size: 0.75rem; font-weight: 600; margin-bottom: 0.5rem; }}
-        .product-name {{ font-size: 1.25rem; font-weight: bold; margin-bottom: 0.5rem; }}
-        .product-price {{ font-size: 1.5rem; font-weight: bold; color: #2563EB; margin: 1rem 0; }}
-        .form-group {{ margin-bottom: 1rem; }}
-        .form-group label {{ display: block; margin-bottom: 0.5rem; font-weight: 500; }}
-        .form-control {{ width: 100%; padding: 0.75rem; border: 1px solid #D1D5DB; border-radius: 0.5rem; font-size: 1rem; }}
-        .form-control:focus {{ outline: none; border-color: #2563EB; box-shadow: 0 0 0 3px rgba(37, 99, 235, 0.1); }}
-        .hero {{ text-align: center; padding: 4rem 0; }}
-        .hero h1 {{ font-size: 3rem; margin-bottom: 1rem; color: #1F2937; }}
-        .hero p {{ font-size: 1.25rem; color: #6B7280; margin-bottom: 2rem; }}
-        .cart-item {{ display: flex; align-items: center; gap: 1rem; padding: 1rem; background: white; border-radius: 0.5rem; box-shadow: 0 2px 4px rgba(0,0,0,0.1); margin-bottom: 1rem; }}
-        .cart-item-image {{ width: 80px; height: 80px; object-fit: cover; border-radius: 0.5rem; background: #F3F4F6; }}
-        .cart-item-info {{ flex: 1; }}
-        .quantity-controls {{ display: flex; align-items: center; gap: 0.5rem; }}
-        .quantity-btn {{ width: 2rem; height: 2rem; border: none; background: #E5E7EB; border-radius: 0.25rem; cursor: pointer; font-weight: bold; }}
-        .quantity-btn:hover {{ background: #D1D5DB; }}
-        .alert {{ padding: 1rem; border-radius: 0.5rem; margin-bottom: 1rem; }}
-        .alert-info {{ background: #DBEAFE; color: #1E40AF; }}
-        .alert-success {{ background: #D1FAE5; color: #065F46; }}
-        .alert-warning {{ background: #FEF3C7; color: #92400E; }}
-        .wallet-card {{ background: linear-gradient(to right, #2563EB, #1E40AF); color: white; padding: 2rem; border-radius: 1rem; margin-bottom: 2rem; }}
-        .wallet-balance {{ font-size: 3rem; font-weight: bold; margin-top: 0.5rem; }}
-        .order-card {{ background: white; padding: 1.5rem; border-radius: 1rem; box-shadow: 0 2px 8px rgba(0,0,0,0.1); margin-bottom: 1rem; }}
-        .status-badge {{ display: inline-block; padding: 0.25rem 0.75rem; border-radius: 9999px; font-size: 0.75rem; font-weight: 600; background: #D1FAE5; color: #065F46; }}
-        .cart-badge {{ background: #DC2626; color: white; border-radius: 50%; width: 20px; height: 20px; display: inline-flex; align-items: center; justify-content: center; font-size: 0.75rem; font-weight: bold; margin-left: 0.25rem; }}
-        .search-bar {{ display: flex; gap: 1rem; margin-bottom: 1.5rem; flex-wrap: wrap; }}
-        .search-bar input, .search-bar select {{ flex: 1; min-width: 200px; }}
-        .detail-image {{ width: 100%; max-width: 500px; height: 400px; object-fit: cover; border-radius: 1rem; margin-bottom: 2rem; }}
-        .seller-link {{ color: #2563EB; text-decoration: none; font-weight: 600; }}
-        .seller-link:hover {{ text-decoration: underline; }}
-        .seller-card {{ background: linear-gradient(to right, #F3F4F6, #E5E7EB); padding: 2rem; border-radius: 1rem; margin-bottom: 2rem; }}
-        .rating {{ color: #F59E0B; font-size: 1.5rem; }}
-        @media (max-width: 768px) {{
-            .nav-links {{ gap: 1rem; font-size: 0.875rem; }}
-            .hero h1 {{ font-size: 2rem; }}
-            .grid-4 {{ grid-template-columns: repeat(auto-fit, minmax(150px, 1fr)); }}
-        }}
-    </style>
+    <link rel="stylesheet" href="/static/bazaro.css?v={STYLESHEET_VERSION}">
 </head>
 <body>
     <div class="header">
@@ -185,7 +1293,7 @@ def render_page(content, page_title='Bazaro'):
     '''
     return template
 
-@app.route('/')
+@bp.route('/')
 def home():
     content = '''
         <div class="hero">
@@ -214,27 +1322,161 @@ def home():
     '''
     return render_page(content, 'Home')
 
-@app.route('/login', methods=['GET', 'POST'])
-def login():
-    if request.method == 'POST':
-        email = request.form.get('email')
-        password = request.form.get('password')
-        
+# Login. Passwords are stored as werkzeug hashes, rows still holding a plaintext
+# password are upgraded the first time their user logs in. Hashing runs on a small
+# per-process thread pool, so a burst of logins can only occupy HASH_WORKERS cores,
+# and token buckets per IP and per email turn bursts away before any hashing.
+# Limits are per process, with several workers the effective budget is multiplied.
+PASSWORD_HASH_METHOD = 'scrypt'
+
+class LoginThrottled(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f'too many login attempts, retry in {retry_after}s')
+        self.retry_after = retry_after
+
+class TokenBucketLimiter:
+    #rate tokens per second per key, up to burst; a key idle long enough is full again
+    #anyway, so the least recently used keys are dropped beyond max_keys
+    def __init__(self, rate, burst, max_keys=100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, key):
+        #0 when a token was taken, otherwise the seconds until one is available
+        now = time.monotonic()
+        with self.lock:
+            tokens, last = self.buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            wait = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / self.rate
+            self.buckets[key] = (tokens, now)
+            if len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        return wait
+
+class HashPool:
+    #runs password hashing on at most workers threads, with room for queue_size more waiting;
+    #callers that can't get a slot within timeout are throttled instead of piling up
+    def __init__(self, workers, queue_size, timeout):
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='bazaro-hash')
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+        self.timeout = timeout
+        self.pid = os.getpid()
+        self.current_prefix = None
+        self.dummy_hash = None
+
+    def run(self, fn, *args):
+        if not self.slots.acquire(timeout=self.timeout):
+            raise LoginThrottled(1)
+        try:
+            future = self.executor.submit(fn, *args)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda f: self.slots.release())
+        return future.result()
+
+    def hash(self, password):
+        hashed = self.run(generate_password_hash, password, PASSWORD_HASH_METHOD)
+        self.current_prefix = hashed.split('$')[0]
+        return hashed
+
+    def check(self, stored, password):
+        #(matches, needs_rehash); unknown users are checked against a dummy hash so they take as long
+        if stored is None:
+            if self.dummy_hash is None:
+                self.dummy_hash = self.hash(secrets.token_hex(16))
+            self.run(check_password_hash, self.dummy_hash, password)
+            return False, False
+        if not stored.startswith(('scrypt:', 'pbkdf2:')) or '$' not in stored:
+            #not migrated yet, still plaintext
+            matches = hmac.compare_digest(stored.encode(), password.encode())
+            return matches, matches
+        matches = self.run(check_password_hash, stored, password)
+        if self.current_prefix is None:
+            self.hash('')
+        return matches, matches and stored.split('$')[0] != self.current_prefix
+
+def get_hash_pool(app):
+    pool = app.extensions.get('bazaro_hash_pool')
+    #threads don't survive a fork, so a forked worker starts its own pool
+    if pool is None or pool.pid != os.getpid():
+        config = app.config
+        pool = app.extensions['bazaro_hash_pool'] = HashPool(config['HASH_WORKERS'], config['HASH_QUEUE_SIZE'], config['HASH_QUEUE_TIMEOUT'])
+    return pool
+
+def get_login_limiters(app):
+    limiters = app.extensions.get('bazaro_login_limiters')
+    if limiters is None:
+        config = app.config
+        limiters = app.extensions['bazaro_login_limiters'] = {
+            'ip': TokenBucketLimiter(config['LOGIN_IP_RATE_PER_MINUTE'] / 60, config['LOGIN_IP_BURST']),
+            'email': TokenBucketLimiter(config['LOGIN_EMAIL_RATE_PER_MINUTE'] / 60, config['LOGIN_EMAIL_BURST']),
+            'register': TokenBucketLimiter(config['REGISTER_IP_RATE_PER_MINUTE'] / 60, config['REGISTER_IP_BURST']),
+        }
+    return limiters
+
+def throttle_login(email=None, bucket='ip'):
+    #raises LoginThrottled when the client's IP, or the email being tried, is over its limit;
+    #remote_addr is the client's own address only with PROXY_COUNT set behind a reverse proxy
+    limiters = get_login_limiters(current_app)
+    wait = limiters[bucket].take(request.remote_addr)
+    if email is not None:
+        wait = max(wait, limiters['email'].take(email.strip().lower()))
+    if wait:
+        metrics.inc('bazaro_login_throttled_total')
+        raise LoginThrottled(math.ceil(wait))
+
+def authenticate(email, password):
+    #the user row for these credentials, or None; raises LoginThrottled
+    email, password = email or '', password or ''
+    throttle_login(email)
+    conn = get_read_connection()
+    cur = conn.cursor()
+    cur.execute('SELECT * FROM users WHERE email = ?', (email,))
+    user = cur.fetchone()
+    cur.close()
+    conn.close()
+    
+    pool = get_hash_pool(current_app)
+    matches, needs_rehash = pool.check(user['password'] if user else None, password)
+    if not matches:
+        return None
+    if needs_rehash:
+        hashed = pool.hash(password)
         conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute('SELECT * FROM users WHERE email = ? AND password = ?', (email, password))
-        user = cur.fetchone()
-        cur.close()
+        #only if the password hasn't changed in the meantime
+        conn.execute('UPDATE users SET password = ? WHERE user_id = ? AND password = ?', (hashed, user['user_id'], user['password']))
+        conn.commit()
         conn.close()
-        
-        if user:
-            session['user_id'] = user['user_id']
-            return redirect('/products')
+    return user
+
+@bp.route('/login', methods=['GET', 'POST'])
+def login():
+    error = request.args.get('error')
+    headers = {}
+    if request.method == 'POST':
+        try:
+            user = authenticate(request.form.get('email'), request.form.get('password'))
+        except LoginThrottled as e:
+            error, headers = '3', {'Retry-After': str(e.retry_after)}
         else:
-            return redirect('/login?error=1')
+            if user:
+                session['user_id'] = user['user_id']
+                return redirect('/products')
+            else:
+                return redirect('/login?error=1')
     
-    error = request.args.get('error')
-    error_msg = '<div class="alert alert-warning">Invalid credentials. Please try again.</div>' if error else ''
+    if error == '3':
+        error_msg = '<div class="alert alert-warning">Too many login attempts. Please wait a minute and try again.</div>'
+    else:
+        error_msg = '<div class="alert alert-warning">Invalid credentials. Please try again.</div>' if error else ''
     
     content = f'''
         {error_msg}
@@ -278,20 +1520,24 @@ def login():
             </div>
         </div>
     '''
-    return render_page(content, 'Login')
+    return render_page(content, 'Login'), 429 if headers else 200, headers
 
-@app.route('/register', methods=['POST'])
+@bp.route('/register', methods=['POST'])
 def register():
     name = request.form.get('name')
     email = request.form.get('email')
-    password = request.form.get('password')
+    try:
+        throttle_login(bucket='register')
+        password = get_hash_pool(current_app).hash(request.form.get('password') or '')
+    except LoginThrottled:
+        return redirect('/login?error=3')
     
     conn = get_db_connection()
     cur = conn.cursor()
     try:
         cur.execute(
-            'INSERT INTO users (name, email, password, wallet_balance) VALUES (?, ?, ?, ?)',
-            (name, email, password, 0.0)
+            'INSERT INTO users (name, email, password, wallet_balance_cents) VALUES (?, ?, ?, ?)',
+            (name, email, password, 0)
         )
         conn.commit()
         user_id = cur.lastrowid
@@ -304,36 +1550,386 @@ def register():
     
     return redirect('/products')
 
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     session.clear()
     return redirect('/')
 
-@app.route('/products')
-def products():
-    search = request.args.get('search', '')
-    category = request.args.get('category', '')
+def catalog_filters(args):
+    #the /products filters from a query string, anything invalid is dropped
+    filters = {
+        'search': args.get('search', '').strip(),
+        'category': args.get('category', type=int),
+        'min_price': None,
+        'max_price': None,
+        'availability': args.get('availability') if args.get('availability') in ('in', 'out') else '',
+        'seller': args.get('seller') if re.fullmatch(r'[su]:\d+', args.get('seller', '')) else '',
+        'sort': args.get('sort') if args.get('sort') in SORT_MODES else '',
+    }
+    for key in ('min_price', 'max_price'):
+        try:
+            filters[key] = Money.parse(args[key]) if args.get(key) else None
+        except ValueError:
+            pass
+    return filters
+
+def filter_sql(filters):
+    #WHERE clause and params for the filters, one query over items however many are set
+    where = ['1=1']
+    params = []
+    if filters['search']:
+        where.append('(name LIKE ? OR description LIKE ?)')
+        params.extend([f"%{filters['search']}%", f"%{filters['search']}%"])
+    if filters['category']:
+        where.append('category_id = ?')
+        params.append(filters['category'])
+    if filters['min_price'] is not None:
+        where.append('price_cents >= ?')
+        params.append(filters['min_price'])
+    if filters['max_price'] is not None:
+        where.append('price_cents <= ?')
+        params.append(filters['max_price'])
+    if filters['availability'] == 'in':
+        where.append('quantity > 0')
+    elif filters['availability'] == 'out':
+        where.append('quantity <= 0')
+    if filters['seller']:
+        kind, seller_id = filters['seller'].split(':')
+        where.append('seller_id = ?' if kind == 's' else '(seller_id IS NULL AND owner_user_id = ?)')
+        params.append(int(seller_id))
+    return ' AND '.join(where), params
+
+# sort mode -> (label, sort column, direction), ties and the default order use item_id
+SORT_MODES = {
+    '': ('Featured', None, 'ASC'),
+    'price_asc': ('Price: low to high', 'price_cents', 'ASC'),
+    'price_desc': ('Price: high to low', 'price_cents', 'DESC'),
+    'newest': ('Newest', None, 'DESC'),
+    'best_selling': ('Best selling', 'sales_count', 'DESC'),
+}
+PRODUCTS_PAGE_SIZE = 24
+
+def catalog_cursor(after, column):
+    #the (sort value, item_id) or (item_id,) a page continues after, None for the first page or a bad cursor
+    try:
+        values = tuple(int(v) for v in (after or '').split(','))
+    except ValueError:
+        return None
+    return values if len(values) == (2 if column else 1) else None
+
+def query_catalog_page(cur, filters, after=None, limit=PRODUCTS_PAGE_SIZE):
+    #one page of items in the chosen order, continuing after the cursor of the previous page;
+    #the sort indexes make this a short index range scan whatever the page
+    if current_app.config.get('CATALOG_SNAPSHOT') and not filters['search']:
+        return catalog_snapshot_page(cur, filters, after, limit)
+    _, column, direction = SORT_MODES[filters['sort']]
+    where, params = filter_sql(filters)
+    keys = f'{column}, item_id' if column else 'item_id'
+    cursor = catalog_cursor(after, column)
+    if cursor:
+        where += f" AND ({keys}) {'>' if direction == 'ASC' else '<'} ({', '.join('?' * len(cursor))})"
+        params.extend(cursor)
+    order = ', '.join(f'{key} {direction}' for key in keys.split(', '))
+    cur.execute(f'SELECT * FROM items WHERE {where} ORDER BY {order} LIMIT ?', params + [limit + 1])
+    items = cur.fetchall()
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        last = items[-1]
+        next_cursor = f"{last[column]},{last['item_id']}" if column else str(last['item_id'])
+    return items, next_cursor
+
+# The catalog snapshot: the filter and sort columns of items as parallel int64 arrays
+# in item_id order, one copy per process, caught up from item_changes like the suggest
+# index. Category, seller and stock filters are bitmaps over array positions (python
+# ints, so combining them is one C-level AND), the price and sales sorts are arrays of
+# positions kept in order. A page is the first matches along that order, and only its
+# rows are fetched from sqlite. Text search still goes to sqlite.
+FLAGS_TO_BITS = bytes.maketrans(b'\x00\x01', b'01')
+BITS_TO_FLAGS = bytes.maketrans(b'01', b'\x00\x01')
+
+def positions_bitmap(positions, size):
+    #int with the bits of the given array positions set
+    bits = bytearray(b'0' * size)
+    for p in positions:
+        bits[size - 1 - p] = ord('1')
+    return int(bits or b'0', 2)
+
+class CatalogSnapshot:
+    COLUMNS = ('item_ids', 'price_cents', 'category_id', 'quantity', 'seller_id', 'owner_user_id', 'sales_count')
+    SORTED = ('price_cents', 'sales_count')
+    # NULL category/seller/owner ids are stored as 0
+    SELECT = '''item_id, price_cents, COALESCE(category_id, 0), quantity, COALESCE(seller_id, 0),
+                COALESCE(owner_user_id, 0), sales_count'''
+
+    def __init__(self):
+        for name in self.COLUMNS:
+            setattr(self, name, array('q'))
+        self.orders = {name: array('q') for name in self.SORTED}
+        self.live = self.in_stock = 0
+        self.by_category = {}
+        self.by_seller = {}
+        self.last_change = None
+        self.lock = threading.Lock()
+
+    def seller_key(self, p):
+        #the same 's:1' / 'u:2' keys as the seller filter
+        if self.seller_id[p]:
+            return f's:{self.seller_id[p]}'
+        return f'u:{self.owner_user_id[p]}' if self.owner_user_id[p] else ''
+
+    def sort_key(self, name):
+        values, ids = getattr(self, name), self.item_ids
+        return lambda p: (values[p], ids[p])
+
+    def index(self, p, add):
+        #add position p to (or drop it from) the bitmaps and sort orders, using its current values
+        bit = 1 << p
+        bitmaps = [(self.by_category, self.category_id[p]), (self.by_seller, self.seller_key(p))]
+        if add:
+            self.live |= bit
+            if self.quantity[p] > 0:
+                self.in_stock |= bit
+            for bitmap, key in bitmaps:
+                bitmap[key] = bitmap.get(key, 0) | bit
+        else:
+            self.live &= ~bit
+            self.in_stock &= ~bit
+            for bitmap, key in bitmaps:
+                bitmap[key] = bitmap.get(key, 0) & ~bit
+                if not bitmap[key]:
+                    del bitmap[key]
+        for name, order in self.orders.items():
+            key = self.sort_key(name)
+            i = bisect_left(order, key(p), key=key)
+            if add:
+                order.insert(i, p)
+            else:
+                del order[i]
+
+    def rebuild(self, cur):
+        cur.execute('SELECT COALESCE(MAX(change_id), 0) FROM item_changes')
+        last_change = cur.fetchone()[0]
+        columns = [array('q') for _ in self.COLUMNS]
+        cur.execute(f'SELECT {self.SELECT} FROM items ORDER BY item_id')
+        while True:
+            rows = cur.fetchmany(5000)
+            if not rows:
+                break
+            for column, values in zip(columns, zip(*rows)):
+                column.extend(values)
+        for name, column in zip(self.COLUMNS, columns):
+            setattr(self, name, column)
+        size = len(self.item_ids)
+        #position order is item_id order, so a stable sort by value breaks ties by item_id
+        self.orders = {name: array('q', sorted(range(size), key=getattr(self, name).__getitem__)) for name in self.SORTED}
+        self.live = (1 << size) - 1
+        self.in_stock = positions_bitmap(itertools.compress(range(size), map(operator.gt, self.quantity, itertools.repeat(0))), size)
+        for bitmap, keys in ((self.by_category, self.category_id), (self.by_seller, map(self.seller_key, range(size)))):
+            groups = {}
+            for p, key in enumerate(keys):
+                groups.setdefault(key, []).append(p)
+            bitmap.clear()
+            bitmap.update((key, positions_bitmap(positions, size)) for key, positions in groups.items())
+        self.last_change = last_change
+
+    def refresh(self, cur):
+        #apply the item writes since the last refresh, or rebuild if the change log was pruned past them
+        #(or went backwards, when reads switch between the live database and a read snapshot)
+        cur.execute('SELECT COALESCE((SELECT MAX(change_id) FROM item_changes), 0), COALESCE((SELECT MIN(change_id) FROM item_changes), 0)')
+        last_change, first_change = cur.fetchone()
+        with self.lock:
+            if self.last_change is None or first_change > self.last_change + 1 or last_change < self.last_change:
+                self.rebuild(cur)
+                return
+            if last_change == self.last_change:
+                return
+            cur.execute(
+                f'''SELECT c.item_id, i.item_id IS NOT NULL, {self.SELECT.replace('item_id, ', '', 1)}
+                    FROM (SELECT DISTINCT item_id FROM item_changes WHERE change_id > ?) c
+                    LEFT JOIN items i ON i.item_id = c.item_id
+                    ORDER BY c.item_id''',
+                (self.last_change,)
+            )
+            for item_id, exists, *values in cur.fetchall():
+                #deleted items stay behind as dead positions, so positions never move
+                p = bisect_left(self.item_ids, item_id)
+                if p < len(self.item_ids) and self.item_ids[p] == item_id:
+                    if self.live >> p & 1:
+                        self.index(p, False)
+                elif not exists:
+                    continue
+                elif p < len(self.item_ids):
+                    #an id below the newest one reappeared, the positions would have to move
+                    self.rebuild(cur)
+                    return
+                else:
+                    for name, value in zip(self.COLUMNS, [item_id] + values):
+                        getattr(self, name).append(value)
+                if exists:
+                    for name, value in zip(self.COLUMNS[1:], values):
+                        getattr(self, name)[p] = value
+                    self.index(p, True)
+            self.last_change = last_change
+            if len(self.item_ids) > 2 * self.live.bit_count() + 1000:
+                self.rebuild(cur)
+
+    def price_bitmap(self, low, high):
+        #a narrow band is a short slice of the price order, a wide one is cheaper to compare in one pass
+        order, key, size = self.orders['price_cents'], self.sort_key('price_cents'), len(self.item_ids)
+        start = bisect_left(order, (low,), key=key) if low is not None else 0
+        end = bisect_left(order, (high + 1,), key=key) if high is not None else len(order)
+        if (end - start) * 2 < size:
+            return positions_bitmap(order[start:end], size)
+        bitmap = self.live
+        for op, cents in ((operator.ge, low), (operator.le, high)):
+            if cents is not None:
+                flags = bytes(map(op, self.price_cents, itertools.repeat(cents)))
+                bitmap &= int(flags.translate(FLAGS_TO_BITS)[::-1] or b'0', 2)
+        return bitmap
+
+    def page(self, filters, after=None, limit=PRODUCTS_PAGE_SIZE):
+        #(item ids of the page, next cursor), same order and cursors as the sql query
+        _, column, direction = SORT_MODES[filters['sort']]
+        cursor = catalog_cursor(after, column)
+        with self.lock:
+            size = len(self.item_ids)
+            matches = self.live
+            if filters['category']:
+                matches &= self.by_category.get(filters['category'], 0)
+            if filters['seller']:
+                matches &= self.by_seller.get(filters['seller'], 0)
+            if filters['availability'] == 'in':
+                matches &= self.in_stock
+            elif filters['availability'] == 'out':
+                matches &= ~self.in_stock
+            low, high = filters['min_price'], filters['max_price']
+            if matches and (low is not None or high is not None):
+                matches &= self.price_bitmap(low.cents if low is not None else None, high.cents if high is not None else None)
+            #one 0/1 byte per position, for compress() to walk in any order
+            flags = format(matches, f'0{size}b')[::-1].encode().translate(BITS_TO_FLAGS) if matches else bytes(size)
+            if column:
+                order, key = self.orders[column], self.sort_key(column)
+                if direction == 'ASC':
+                    walk = order[bisect_right(order, cursor, key=key):] if cursor else order
+                else:
+                    walk = (order[:bisect_left(order, cursor, key=key)] if cursor else order)[::-1]
+                found = list(itertools.islice(itertools.compress(walk, map(flags.__getitem__, walk)), limit + 1))
+            else:
+                if direction == 'ASC':
+                    start = bisect_right(self.item_ids, cursor[0]) if cursor else 0
+                    walk = range(start, size)
+                    walk_flags = flags[start:]
+                else:
+                    end = bisect_left(self.item_ids, cursor[0]) if cursor else size
+                    walk = range(end - 1, -1, -1)
+                    walk_flags = flags[:end][::-1]
+                found = list(itertools.islice(itertools.compress(walk, walk_flags), limit + 1))
+            next_cursor = None
+            if len(found) > limit:
+                found = found[:limit]
+                last = found[-1]
+                next_cursor = f'{getattr(self, column)[last]},{self.item_ids[last]}' if column else str(self.item_ids[last])
+            return [self.item_ids[p] for p in found], next_cursor
+
+def get_catalog_snapshot(app):
+    snapshot = app.extensions.get('bazaro_catalog')
+    if snapshot is None:
+        snapshot = app.extensions['bazaro_catalog'] = CatalogSnapshot()
+    return snapshot
+
+def catalog_snapshot_page(cur, filters, after, limit):
+    #query_catalog_page through the snapshot, reading just the rows of the page
+    snapshot = get_catalog_snapshot(current_app)
+    snapshot.refresh(cur)
+    ids, next_cursor = snapshot.page(filters, after, limit)
+    if not ids:
+        return [], next_cursor
+    cur.execute(f"SELECT * FROM items WHERE item_id IN ({','.join('?' * len(ids))})", ids)
+    rows = {row['item_id']: row for row in cur.fetchall()}
+    return [rows[item_id] for item_id in ids if item_id in rows], next_cursor
+
+def filters_query(filters, **changes):
+    #query string for the current filters with some of them changed
+    merged = dict(filters, **changes)
+    return urlencode({k: v.plain() if isinstance(v, Money) else v for k, v in merged.items() if v not in (None, '')})
+
+def load_facets(cur):
+    #{facet: [(value, count)]}, straight from facet_counts
+    cur.execute('SELECT facet, value, count FROM facet_counts WHERE count > 0')
+    facets = {}
+    for facet, value, count in cur.fetchall():
+        facets.setdefault(facet, []).append((value, count))
+    return facets
+
+def seller_names(cur, keys):
+    #'s:1' / 'u:2' facet values -> display names
+    seller_ids = [int(k[2:]) for k in keys if k.startswith('s:')]
+    user_ids = [int(k[2:]) for k in keys if k.startswith('u:')]
+    names = {}
+    if seller_ids:
+        cur.execute(f"SELECT seller_id, seller_name FROM sellers WHERE seller_id IN ({','.join('?' * len(seller_ids))})", seller_ids)
+        names.update({f's:{r[0]}': r[1] for r in cur.fetchall()})
+    if user_ids:
+        cur.execute(f"SELECT user_id, name FROM users WHERE user_id IN ({','.join('?' * len(user_ids))})", user_ids)
+        names.update({f'u:{r[0]}': r[1] for r in cur.fetchall()})
+    return names
+
+def facets_html(filters, facets, categories, sellers):
+    def link(label, count, selected, **changes):
+        style = 'font-weight: 700;' if selected else ''
+        return f'''
+            <a href="/products?{escape(filters_query(filters, **changes))}" style="display: flex; justify-content: space-between; color: #1F2937; text-decoration: none; padding: 0.25rem 0; {style}">
+                <span>{escape(label)}</span><span style="color: #6B7280;">{count}</span>
+            </a>
+        '''
     
-    conn = get_db_connection()
-    cur = conn.cursor()
+    category_names = {str(c['category_id']): c['name'] for c in categories}
+    sections = []
     
-    query = 'SELECT * FROM items WHERE 1=1'
-    params = []
+    html = link('All', '', not filters['category'], category=None)
+    for value, count in sorted(facets.get('category', []), key=lambda f: category_names.get(f[0], '')):
+        if value in category_names:
+            html += link(category_names[value], count, str(filters['category']) == value, category=int(value))
+    sections.append(('Category', html))
     
-    if search:
-        query += ' AND (name LIKE ? OR description LIKE ?)'
-        params.extend([f'%{search}%', f'%{search}%'])
+    band_counts = dict(facets.get('price', []))
+    html = link('Any price', '', filters['min_price'] is None and filters['max_price'] is None, min_price=None, max_price=None)
+    for i, (low, label) in enumerate(PRICE_BANDS):
+        high = Money(PRICE_BANDS[i + 1][0] - 1) if i + 1 < len(PRICE_BANDS) else None
+        selected = filters['min_price'] == Money(low) and filters['max_price'] == high
+        html += link(label, band_counts.get(str(low), 0), selected, min_price=Money(low), max_price=high)
+    sections.append(('Price', html))
     
-    if category:
-        query += ' AND category_id = ?'
-        params.append(int(category))
+    stock_counts = dict(facets.get('stock', []))
+    html = link('In stock', stock_counts.get('in', 0), filters['availability'] == 'in', availability='in')
+    html += link('Out of stock', stock_counts.get('out', 0), filters['availability'] == 'out', availability='out')
+    html += link('Any', '', not filters['availability'], availability='')
+    sections.append(('Availability', html))
     
-    cur.execute(query, params)
-    items = cur.fetchall()
+    html = link('All sellers', '', not filters['seller'], seller='')
+    for value, count, name in sellers:
+        html += link(name, count, filters['seller'] == value, seller=value)
+    sections.append(('Seller', html))
+    
+    return ''.join(f'<h4 style="margin: 1rem 0 0.5rem 0;">{title}</h4>{html}' for title, html in sections)
+
+@bp.route('/products')
+def products():
+    filters = catalog_filters(request.args)
+    
+    conn = get_read_connection(snapshot_ok=True)
+    cur = conn.cursor()
+    
+    items, next_cursor = query_catalog_page(cur, filters, request.args.get('after'))
     
     cur.execute('SELECT * FROM categories')
     categories = cur.fetchall()
     
+    facets = load_facets(cur)
+    top_sellers = sorted((f for f in facets.get('seller', []) if f[0]), key=lambda f: -f[1])[:TOP_SELLER_FACETS]
+    names = seller_names(cur, [value for value, _ in top_sellers])
+    
     cur.close()
     conn.close()
     
@@ -348,53 +1944,213 @@ def products():
                 <div class="product-info">
                     <div class="product-category">{cat['name'] if cat else ''}</div>
                     <div class="product-name">{item['name']}</div>
-                    <p style="color: #6B7280; font-size: 0.875rem; margin-bottom: 0.5rem;">{item['description'][:50]}...</p>
-                    <div class="product-price">${item['price']:.2f}</div>
+                    <p style="color: #6B7280; font-size: 0.875rem; margin-bottom: 0.5rem;">{(item['description'] or '')[:50]}...</p>
+                    <div class="product-price">{Money(item['price_cents'])}</div>
                     <div style="margin-top: 0.5rem; color: #6B7280; font-size: 0.75rem;">Stock: {item['quantity']}</div>
                 </div>
             </div>
         '''
     
-    categories_options = ''.join([f'<option value="{c["category_id"]}">{c["name"]}</option>' for c in categories])
+    categories_options = ''.join([f'<option value="{c["category_id"]}"{" selected" if c["category_id"] == filters["category"] else ""}>{c["name"]}</option>' for c in categories])
     
     current_user = get_current_user()
     add_product_btn = '<a href="/add-product" class="btn btn-success" style="margin-bottom: 1.5rem;">+ Add New Product</a>' if current_user else ''
     
+    hidden_filters = ''.join(
+        f'<input type="hidden" name="{key}" value="{escape(filters[key])}">' for key in ('availability', 'seller') if filters[key]
+    )
+    sort_options = ''.join(
+        f'<option value="{key}"{" selected" if key == filters["sort"] else ""}>{label}</option>' for key, (label, _, _) in SORT_MODES.items()
+    )
+    pager = ''
+    if request.args.get('after'):
+        pager += f'<a href="/products?{escape(filters_query(filters))}" class="btn" style="background: #E5E7EB;">← First page</a>'
+    if next_cursor:
+        pager += f'<a href="/products?{escape(filters_query(filters, after=next_cursor))}" class="btn btn-primary" style="margin-left: auto;">Next page →</a>'
+    
     content = f'''
         <h2 style="margin-bottom: 1.5rem;">Products</h2>
         
         <div class="card">
             <form method="GET" action="/products" class="search-bar">
-                <input type="text" name="search" class="form-control" placeholder="Search products..." value="{search}">
+                <input type="text" name="search" class="form-control" placeholder="Search products..." value="{escape(filters['search'])}" list="search-suggestions" autocomplete="off" oninput="suggestProducts(this.value)">
+                <datalist id="search-suggestions"></datalist>
                 <select name="category" class="form-control">
                     <option value="">All Categories</option>
                     {categories_options}
                 </select>
+                <input type="number" step="0.01" min="0" name="min_price" class="form-control" placeholder="Min $" value="{filters['min_price'].plain() if filters['min_price'] is not None else ''}">
+                <input type="number" step="0.01" min="0" name="max_price" class="form-control" placeholder="Max $" value="{filters['max_price'].plain() if filters['max_price'] is not None else ''}">
+                <select name="sort" class="form-control">
+                    {sort_options}
+                </select>
+                {hidden_filters}
                 <button type="submit" class="btn btn-primary">Search</button>
             </form>
         </div>
         
         {add_product_btn}
         
-        <div class="grid grid-4">
-            {products_html if products_html else '<p>No products found</p>'}
+        <div class="grid" style="grid-template-columns: 220px 1fr; align-items: start;">
+            <div class="card" style="padding: 1rem 1.5rem;">
+                {facets_html(filters, facets, categories, [(value, count, names.get(value, value)) for value, count in top_sellers])}
+            </div>
+            <div>
+                <div class="grid grid-4">
+                    {products_html if products_html else '<p>No products found</p>'}
+                </div>
+                <div style="display: flex; margin-top: 1.5rem;">{pager}</div>
+            </div>
         </div>
+        
+        <script>
+            let suggestTimer = null;
+            function suggestProducts(q) {{
+                clearTimeout(suggestTimer);
+                suggestTimer = setTimeout(() => {{
+                    fetch('/api/suggest?q=' + encodeURIComponent(q))
+                        .then(r => r.json())
+                        .then(data => {{
+                            const list = document.getElementById('search-suggestions');
+                            list.innerHTML = '';
+                            data.suggestions.forEach(s => {{
+                                const option = document.createElement('option');
+                                option.value = s.label;
+                                list.appendChild(option);
+                            }});
+                        }});
+                }}, 120);
+            }}
+        </script>
     '''
     
     return render_page(content, 'Products')
 
-@app.route('/item/<int:item_id>')
-def item_detail(item_id):
-    conn = get_db_connection()
+# Search suggestions, served from an in-memory sorted array of normalized name
+# prefixes. Each process keeps its own copy and catches up from item_changes.
+SUGGEST_LIMIT = 8
+TURKISH_FOLD = str.maketrans({'İ': 'i', 'I': 'i', 'ı': 'i', 'Ş': 's', 'ş': 's', 'Ğ': 'g', 'ğ': 'g',
+                              'Ü': 'u', 'ü': 'u', 'Ö': 'o', 'ö': 'o', 'Ç': 'c', 'ç': 'c'})
+
+def normalize_search(text):
+    #case and accent insensitive, dotted/dotless i and the other Turkish letters fold to ascii
+    text = unicodedata.normalize('NFKD', (text or '').translate(TURKISH_FOLD).lower())
+    return ' '.join(''.join(ch for ch in text if not unicodedata.combining(ch)).split())
+
+def suggest_keys(name):
+    #the whole name and every word-start suffix, so 'mac' finds 'Apple MacBook'
+    words = normalize_search(name).split(' ')
+    return {' '.join(words[i:]) for i in range(len(words)) if words[i]}
+
+class SuggestIndex:
+    def __init__(self):
+        self.entries = []
+        self.labels = {}
+        self.keys = {}
+        self.last_change = None
+        self.lock = threading.Lock()
+
+    def add(self, kind, ident, label):
+        self.remove(kind, ident)
+        self.labels[(kind, ident)] = label
+        self.keys[(kind, ident)] = suggest_keys(label)
+        for key in self.keys[(kind, ident)]:
+            insort(self.entries, (key, kind, ident))
+
+    def remove(self, kind, ident):
+        for key in self.keys.pop((kind, ident), ()):
+            i = bisect_left(self.entries, (key, kind, ident))
+            if i < len(self.entries) and self.entries[i] == (key, kind, ident):
+                del self.entries[i]
+        self.labels.pop((kind, ident), None)
+
+    def rebuild(self, cur):
+        cur.execute('SELECT COALESCE(MAX(change_id), 0) FROM item_changes')
+        last_change = cur.fetchone()[0]
+        self.entries = []
+        self.labels = {}
+        self.keys = {}
+        cur.execute('SELECT category_id, name FROM categories')
+        for category_id, name in cur.fetchall():
+            self.labels[('category', category_id)] = name
+            self.keys[('category', category_id)] = suggest_keys(name)
+        cur.execute('SELECT item_id, name FROM items')
+        for item_id, name in cur.fetchall():
+            self.labels[('item', item_id)] = name
+            self.keys[('item', item_id)] = suggest_keys(name)
+        self.entries = sorted((key, kind, ident) for (kind, ident), keys in self.keys.items() for key in keys)
+        self.last_change = last_change
+
+    def refresh(self, cur):
+        #apply the item writes since the last refresh, or rebuild if the change log was pruned past them
+        cur.execute('SELECT COALESCE((SELECT MAX(change_id) FROM item_changes), 0), COALESCE((SELECT MIN(change_id) FROM item_changes), 0)')
+        last_change, first_change = cur.fetchone()
+        with self.lock:
+            if self.last_change is None or first_change > self.last_change + 1:
+                self.rebuild(cur)
+                return
+            if last_change == self.last_change:
+                return
+            cur.execute(
+                '''SELECT c.item_id, i.name FROM (SELECT DISTINCT item_id FROM item_changes WHERE change_id > ?) c
+                   LEFT JOIN items i ON i.item_id = c.item_id''',
+                (self.last_change,)
+            )
+            for item_id, name in cur.fetchall():
+                if name is None:
+                    self.remove('item', item_id)
+                elif self.labels.get(('item', item_id)) != name:
+                    self.add('item', item_id, name)
+            self.last_change = last_change
+
+    def suggest(self, query, limit=SUGGEST_LIMIT):
+        prefix = normalize_search(query)
+        if not prefix:
+            return []
+        found = []
+        seen = set()
+        with self.lock:
+            i = bisect_left(self.entries, (prefix,))
+            while i < len(self.entries) and len(found) < limit * 4 and self.entries[i][0].startswith(prefix):
+                _, kind, ident = self.entries[i]
+                if (kind, ident) not in seen:
+                    seen.add((kind, ident))
+                    found.append((kind, ident, self.labels[(kind, ident)]))
+                i += 1
+        #categories first, then names that start with the query, then shorter names
+        found.sort(key=lambda f: (f[0] != 'category', not normalize_search(f[2]).startswith(prefix), len(f[2])))
+        return found[:limit]
+
+def get_suggest_index(app):
+    index = app.extensions.get('bazaro_suggest')
+    if index is None:
+        index = app.extensions['bazaro_suggest'] = SuggestIndex()
+    return index
+
+@bp.route('/api/suggest')
+def suggest():
+    query = request.args.get('q', '')[:100]
+    index = get_suggest_index(current_app)
+    conn = get_read_connection()
     cur = conn.cursor()
+    index.refresh(cur)
+    cur.close()
+    conn.close()
     
+    suggestions = []
+    for kind, ident, label in index.suggest(query):
+        url = f'/products?category={ident}' if kind == 'category' else f'/item/{ident}'
+        suggestions.append({'type': kind, 'id': ident, 'label': label, 'url': url})
+    response = jsonify({'q': query, 'suggestions': suggestions})
+    response.headers['Cache-Control'] = 'public, max-age=30'
+    return response
+
+def load_item_detail(cur, item_id):
+    #(item, category, seller, is_user) or None, seller is a users row when is_user
     cur.execute('SELECT * FROM items WHERE item_id = ?', (item_id,))
     item = cur.fetchone()
-    
     if not item:
-        cur.close()
-        conn.close()
-        return redirect('/products')
+        return None
     
     cur.execute('SELECT * FROM categories WHERE category_id = ?', (item['category_id'],))
     category = cur.fetchone()
@@ -406,9 +2162,20 @@ def item_detail(item_id):
         is_user = True
         cur.execute('SELECT * FROM users WHERE user_id = ?', (item['owner_user_id'],))
         seller = cur.fetchone()
-    
+    return item, category, seller, is_user
+
+@bp.route('/item/<int:item_id>')
+def item_detail(item_id):
+    conn = get_read_connection(snapshot_ok=True)
+    cur = conn.cursor()
+    detail = load_item_detail(cur, item_id)
+    co_purchased = load_co_purchased(cur, [item_id]) if detail else []
     cur.close()
     conn.close()
+    
+    if not detail:
+        return redirect('/products')
+    item, category, seller, is_user = detail
 
     error = request.args.get('error')
 
@@ -449,7 +2216,7 @@ def item_detail(item_id):
                 <div>
                     <div class="product-category">{category['name'] if category else 'Uncategorized'}</div>
                     <h1 style="font-size: 2.5rem; margin-bottom: 1rem; color: #1F2937;">{item['name']}</h1>
-                    <div class="product-price" style="font-size: 2rem; margin-bottom: 1.5rem;">${item['price']:.2f}</div>
+                    <div class="product-price" style="font-size: 2rem; margin-bottom: 1.5rem;">{Money(item['price_cents'])}</div>
                     
                     <div style="background: #F3F4F6; padding: 1rem; border-radius: 0.5rem; margin-bottom: 1.5rem;">
                         <p style="margin-bottom: 0.5rem;"><strong>Stock Available:</strong> {item['quantity']} units</p>
@@ -467,14 +2234,15 @@ def item_detail(item_id):
                     </form>
                 </div>
             </div>
+            {co_purchased_html(co_purchased)}
         </div>
     '''
     
     return render_page(content, item['name'])
 
-@app.route('/seller/<int:seller_id>')
+@bp.route('/seller/<int:seller_id>')
 def seller_detail(seller_id):
-    conn = get_db_connection()
+    conn = get_read_connection(snapshot_ok=True)
     cur = conn.cursor()
     is_user = True if request.args.get('isuser') == "1" else False
 
@@ -506,7 +2274,7 @@ def seller_detail(seller_id):
                 <div class="product-info">
                     <div class="product-name">{item['name']}</div>
                     <p style="color: #6B7280; font-size: 0.875rem; margin-bottom: 0.5rem;">{item['description'][:50]}...</p>
-                    <div class="product-price">${item['price']:.2f}</div>
+                    <div class="product-price">{Money(item['price_cents'])}</div>
                 </div>
             </div>
         '''
@@ -548,7 +2316,7 @@ def seller_detail(seller_id):
     
     return render_page(content, seller['name'] if is_user else seller['seller_name'])
 
-@app.route('/add-product', methods=['GET', 'POST'])
+@bp.route('/add-product', methods=['GET', 'POST'])
 def add_product():
     if not get_current_user():
         return redirect('/login')
@@ -561,20 +2329,20 @@ def add_product():
             if file and file.filename != '' and allowed_file(file.filename):
                 filename = secure_filename(file.filename)
                 # Add timestamp to avoid conflicts
-                import time
                 filename = f"{int(time.time())}_{filename}"
-                file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+                file.save(os.path.join(current_app.config['UPLOAD_FOLDER'], filename))
+                precompress_file(os.path.join(current_app.config['UPLOAD_FOLDER'], filename))
                 image_filename = filename
         
         current_user = get_current_user()
         conn = get_db_connection()
         cur = conn.cursor()
         cur.execute(
-            'INSERT INTO items (name, description, price, category_id, seller_id, quantity, image_filename, owner_user_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            'INSERT INTO items (name, description, price_cents, category_id, seller_id, quantity, image_filename, owner_user_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
             (
                 request.form.get('name'),
                 request.form.get('description'),
-                float(request.form.get('price')),
+                Money.parse(request.form.get('price')),
                 int(request.form.get('category_id')),
                 None,
                 int(request.form.get('quantity')),
@@ -587,7 +2355,7 @@ def add_product():
         conn.close()
         return redirect('/products')
     
-    conn = get_db_connection()
+    conn = get_read_connection(snapshot_ok=True)
     cur = conn.cursor()
     cur.execute('SELECT * FROM categories')
     categories = cur.fetchall()
@@ -641,7 +2409,7 @@ def add_product():
     
     return render_page(content, 'Add Product')
 
-@app.route('/delete-product/<int:item_id>', methods=['POST'])
+@bp.route('/delete-product/<int:item_id>', methods=['POST'])
 def delete_product(item_id):
     current_user = get_current_user()
     if not current_user:
@@ -655,22 +2423,340 @@ def delete_product(item_id):
     item = cur.fetchone()
     
     if item:
-        # Delete the product image file if it exists and is not the default
-        if item['image_filename'] and item['image_filename'] != 'temp.jpg':
-            image_path = os.path.join(app.config['UPLOAD_FOLDER'], item['image_filename'])
-            if os.path.exists(image_path):
-                os.remove(image_path)
-        
-        # Delete the product from database
         cur.execute('DELETE FROM items WHERE item_id = ?', (item_id,))
+        #the image goes too unless another item uses the same file, gc-images catches anything missed
+        cur.execute('SELECT 1 FROM items WHERE image_filename = ? LIMIT 1', (item['image_filename'],))
+        shared = cur.fetchone()
         conn.commit()
+        if item['image_filename'] and item['image_filename'] not in PROTECTED_IMAGES and not shared:
+            remove_image(current_app.config['UPLOAD_FOLDER'], item['image_filename'])
     
     cur.close()
     conn.close()
     
-    return redirect('/profile')
+    return redirect('/profile')
+
+# Image garbage collection. Files in the upload folder that no item references
+# are removed by `flask gc-images` once they are older than the grace period,
+# which covers uploads whose item row isn't committed yet.
+PROTECTED_IMAGES = {'temp.jpg', 'default.jpg', 'outofstock.jpg'}
+SIDECAR_SUFFIXES = ('.gz', '.br')
+
+def remove_image(upload_folder, filename):
+    #the image and its compressed sidecars
+    for name in [filename] + [filename + suffix for suffix in SIDECAR_SUFFIXES]:
+        path = os.path.join(upload_folder, name)
+        if os.path.exists(path):
+            os.remove(path)
+
+def scan_images(conn, upload_folder, grace_seconds, batch_size):
+    #yields (DirEntry, size, collectable) for every file; the folder is streamed with scandir and
+    #checked against items a batch at a time, so memory doesn't grow with the folder or the catalog
+    cutoff = time.time() - grace_seconds
+    
+    def check(batch):
+        names = sorted({image for image, _, _ in batch})
+        cur = conn.execute(f"SELECT image_filename FROM items WHERE image_filename IN ({','.join('?' * len(names))})", names)
+        referenced = {row[0] for row in cur}
+        for image, entry, size in batch:
+            yield entry, size, image not in referenced
+    
+    batch = []
+    with os.scandir(upload_folder) as entries:
+        for entry in entries:
+            if not entry.is_file(follow_symlinks=False):
+                continue
+            stat = entry.stat(follow_symlinks=False)
+            #a sidecar is referenced when its image is, a leftover .tmp file never is
+            image = entry.name[:-3] if entry.name.endswith(SIDECAR_SUFFIXES) else entry.name
+            if stat.st_mtime > cutoff or image in PROTECTED_IMAGES:
+                yield entry, stat.st_size, False
+            elif entry.name.endswith('.tmp'):
+                yield entry, stat.st_size, True
+            else:
+                batch.append((image, entry, stat.st_size))
+                if len(batch) >= batch_size:
+                    yield from check(batch)
+                    batch = []
+    if batch:
+        yield from check(batch)
+
+@bp.cli.command('gc-images')
+@click.option('--grace-hours', type=float, default=24, show_default=True, help='only files older than this are collected')
+@click.option('--quarantine', type=click.Path(file_okay=False), help='move collected files here instead of deleting them')
+@click.option('--max-files', type=int, help='stop after collecting this many files, to spread a large cleanup over several runs')
+@click.option('--batch-size', type=int, default=500, show_default=True, help='files checked against the catalog per query')
+@click.option('--dry-run', is_flag=True, help='only report what would be collected')
+def gc_images_command(grace_hours, quarantine, max_files, batch_size, dry_run):
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    conn = sqlite3.connect(f"file:{quote(current_app.config['DATABASE'])}?mode=ro", uri=True)
+    check_schema(conn)
+    if quarantine and not dry_run:
+        os.makedirs(quarantine, exist_ok=True)
+    
+    files = total_bytes = collected = reclaimed = 0
+    for entry, size, collectable in scan_images(conn, upload_folder, grace_hours * 3600, batch_size):
+        files += 1
+        total_bytes += size
+        if not collectable or (max_files is not None and collected >= max_files):
+            continue
+        collected += 1
+        reclaimed += size
+        if dry_run:
+            click.echo(f'would collect {entry.name} ({size} bytes)')
+        elif quarantine:
+            shutil.move(entry.path, os.path.join(quarantine, entry.name))
+        else:
+            os.remove(entry.path)
+    conn.close()
+    
+    verb = 'would reclaim' if dry_run else 'reclaimed'
+    click.echo(f'{files} file(s), {total_bytes} bytes in {upload_folder}; {collected} unreferenced, {verb} {reclaimed} bytes')
+
+# Bulk import / export. Rows have the columns of EXPORT_FIELDS (item_id is
+# ignored on import, category may be an id or a name, price is in dollars).
+EXPORT_FIELDS = ['item_id', 'name', 'description', 'price', 'quantity', 'category', 'image']
+IMPORT_BATCH_SIZE = 1000
+MAX_REPORTED_ERRORS = 1000
+
+class ImageSource:
+    #product images for an import, from a directory or a zip archive
+    def __init__(self, path_or_file):
+        self.directory = None
+        self.archive = None
+        if isinstance(path_or_file, str) and os.path.isdir(path_or_file):
+            self.directory = path_or_file
+        else:
+            self.archive = zipfile.ZipFile(path_or_file)
+            #members by base name, archives often wrap everything in a folder
+            self.members = {os.path.basename(n): n for n in self.archive.namelist() if not n.endswith('/')}
+
+    def save(self, name, upload_folder):
+        if not allowed_file(name):
+            raise ValueError(f'image {name!r} is not an accepted image type')
+        filename = f"{int(time.time())}_{secrets.token_hex(4)}_{secure_filename(os.path.basename(name))}"
+        target = os.path.join(upload_folder, filename)
+        if self.directory:
+            source = os.path.join(self.directory, os.path.basename(name))
+            if not os.path.isfile(source):
+                raise ValueError(f'image {name!r} not found')
+            shutil.copyfile(source, target)
+        else:
+            member = self.members.get(os.path.basename(name))
+            if member is None:
+                raise ValueError(f'image {name!r} not found in the archive')
+            with self.archive.open(member) as src, open(target, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+        precompress_file(target)
+        return filename
+
+    def close(self):
+        if self.archive:
+            self.archive.close()
+
+def read_import_rows(stream, fmt):
+    #stream is a text file, yields one dict per row
+    if fmt == 'jsonl':
+        for line in stream:
+            if line.strip():
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    row = None
+                yield row if isinstance(row, dict) else {'_error': 'line is not a JSON object'}
+    else:
+        yield from csv.DictReader(stream)
+
+def parse_import_row(row, categories, images, upload_folder):
+    if '_error' in row:
+        raise ValueError(row['_error'])
+    name = str(row.get('name') or '').strip()
+    if not name:
+        raise ValueError('name is required')
+    try:
+        price = Money.parse(row.get('price'))
+    except ValueError:
+        raise ValueError(f"invalid price {row.get('price')!r}")
+    if price < Money(0):
+        raise ValueError('price must not be negative')
+    try:
+        quantity = int(row.get('quantity') or 0)
+    except (TypeError, ValueError):
+        raise ValueError(f"invalid quantity {row.get('quantity')!r}")
+    if quantity < 0:
+        raise ValueError('quantity must not be negative')
+    category = str(row.get('category') or '').strip().lower()
+    if category not in categories:
+        raise ValueError(f"unknown category {row.get('category')!r}")
+    image_filename = 'temp.jpg'
+    if row.get('image'):
+        if images is None:
+            raise ValueError('row has an image but no image directory or archive was given')
+        image_filename = images.save(str(row['image']), upload_folder)
+    return name, str(row.get('description') or ''), price, quantity, categories[category], image_filename
+
+def import_products(rows, connect, upload_folder, owner_user_id=None, seller_id=None, images=None, batch_size=IMPORT_BATCH_SIZE):
+    #bad rows are reported and skipped, good ones are inserted batch_size at a time,
+    #each batch in its own transaction so checkouts can get the write lock in between
+    conn = connect()
+    cur = conn.cursor()
+    cur.execute('SELECT category_id, name FROM categories')
+    categories = {}
+    for category_id, name in cur.fetchall():
+        categories[str(category_id)] = category_id
+        categories[name.strip().lower()] = category_id
+    cur.close()
+    conn.close()
+    
+    imported = 0
+    failed = 0
+    errors = []
+    batch = []
+    
+    def flush():
+        conn = connect()
+        cur = conn.cursor()
+        cur.executemany(
+            'INSERT INTO items (name, description, price_cents, quantity, category_id, image_filename, seller_id, owner_user_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            [values + (seller_id, owner_user_id) for values in batch]
+        )
+        conn.commit()
+        cur.close()
+        conn.close()
+        batch.clear()
+    
+    for number, row in enumerate(rows, start=1):
+        try:
+            batch.append(parse_import_row(row, categories, images, upload_folder))
+        except ValueError as e:
+            failed += 1
+            if len(errors) < MAX_REPORTED_ERRORS:
+                errors.append((number, str(e)))
+            continue
+        imported += 1
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+    return imported, failed, errors
+
+def export_products(conn, fmt, owner_user_id=None):
+    #generator, the items are read in chunks and never held in memory all at once
+    try:
+        cur = conn.cursor()
+        query = '''SELECT i.item_id, i.name, i.description, i.price_cents, i.quantity, c.name AS category, i.image_filename
+                   FROM items i LEFT JOIN categories c ON c.category_id = i.category_id'''
+        params = []
+        if owner_user_id is not None:
+            query += ' WHERE i.owner_user_id = ?'
+            params.append(owner_user_id)
+        cur.execute(query + ' ORDER BY i.item_id', params)
+        if fmt == 'csv':
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(EXPORT_FIELDS)
+            #the header goes out even when there are no rows
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        while True:
+            rows = cur.fetchmany(500)
+            if not rows:
+                break
+            records = [(r['item_id'], r['name'], r['description'] or '', Money(r['price_cents']).plain(),
+                        r['quantity'], r['category'] or '', r['image_filename'] or '') for r in rows]
+            if fmt == 'csv':
+                writer.writerows(records)
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+            else:
+                yield ''.join(json.dumps(dict(zip(EXPORT_FIELDS, record)), ensure_ascii=False) + '\n' for record in records)
+        cur.close()
+    finally:
+        conn.close()
+
+@bp.route('/import-products', methods=['GET', 'POST'])
+def import_products_page():
+    current_user = get_current_user()
+    if not current_user:
+        return redirect('/login')
+    
+    report = ''
+    if request.method == 'POST':
+        file = request.files.get('products_file')
+        if not file or file.filename == '':
+            return redirect('/import-products')
+        fmt = 'jsonl' if file.filename.lower().endswith(('.jsonl', '.json')) else 'csv'
+        images_file = request.files.get('images_archive')
+        images = None
+        try:
+            if images_file and images_file.filename:
+                images = ImageSource(images_file.stream)
+            stream = io.TextIOWrapper(file.stream, encoding='utf-8-sig', newline='')
+            imported, failed, errors = import_products(
+                read_import_rows(stream, fmt), get_db_connection, current_app.config['UPLOAD_FOLDER'],
+                owner_user_id=current_user['user_id'], images=images)
+        except (UnicodeDecodeError, csv.Error, zipfile.BadZipFile) as e:
+            imported, failed, errors = 0, 0, [(0, f'could not read the file: {e}')]
+        finally:
+            if images:
+                images.close()
+        
+        errors_html = ''.join(f'<li>Row {number}: {message}</li>' for number, message in errors)
+        more = f'<li>... and {failed - len(errors)} more</li>' if failed > len(errors) else ''
+        report = f'''
+            <div class="alert {'alert-success' if not failed else 'alert-warning'}" style="display: block;">
+                Imported {imported} products, {failed} rows skipped.
+            </div>
+            {f'<div class="card"><h3 style="margin-bottom: 1rem;">Skipped rows</h3><ul style="margin-left: 1.5rem; color: #92400E;">{errors_html}{more}</ul></div>' if errors else ''}
+        '''
+    
+    content = f'''
+        <div style="max-width: 700px; margin: 0 auto;">
+            {report}
+            <div class="card">
+                <h2 style="margin-bottom: 1.5rem;">Import Products</h2>
+                <p style="color: #6B7280; margin-bottom: 1rem;">
+                    CSV with a header row, or JSON lines, with the columns {', '.join(EXPORT_FIELDS[1:])}.
+                    The category can be its name or id, the price is in dollars.
+                </p>
+                <form method="POST" enctype="multipart/form-data">
+                    <div class="form-group">
+                        <label>Products file (.csv or .jsonl) *</label>
+                        <input type="file" name="products_file" class="form-control" accept=".csv,.jsonl,.json" required>
+                    </div>
+                    <div class="form-group">
+                        <label>Images (.zip, optional)</label>
+                        <input type="file" name="images_archive" class="form-control" accept=".zip">
+                        <small style="color: #6B7280;">The image column refers to file names inside the archive</small>
+                    </div>
+                    <div style="display: flex; gap: 1rem;">
+                        <button type="submit" class="btn btn-success" style="flex: 1;">Import</button>
+                        <a href="/export-products?format=csv" class="btn" style="flex: 1; background: #E5E7EB; text-align: center;">Export my products</a>
+                    </div>
+                </form>
+            </div>
+        </div>
+    '''
+    return render_page(content, 'Import Products')
+
+@bp.route('/export-products')
+def export_products_page():
+    current_user = get_current_user()
+    if not current_user:
+        return redirect('/login')
+    
+    fmt = 'jsonl' if request.args.get('format') == 'jsonl' else 'csv'
+    #admins can export the whole catalog
+    owner_user_id = None if request.args.get('all') == '1' and is_admin(current_user) else current_user['user_id']
+    conn = get_read_connection()
+    mimetype = 'application/x-ndjson' if fmt == 'jsonl' else 'text/csv'
+    response = Response(stream_with_context(export_products(conn, fmt, owner_user_id)), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename=bazaro-products.{fmt}'
+    return response
 
-@app.route('/add-to-cart/<int:item_id>', methods=['POST'])
+@bp.route('/add-to-cart/<int:item_id>', methods=['POST'])
 def add_to_cart(item_id):
     if not get_current_user():
         return redirect('/login')
@@ -678,7 +2764,7 @@ def add_to_cart(item_id):
     cart = session.get('cart', [])
     
     existing = next((c for c in cart if c['item_id'] == item_id), None)
-    conn = get_db_connection()
+    conn = get_read_connection()
     cur = conn.cursor()
     cur.execute('SELECT quantity FROM items WHERE item_id = ?', (item_id,))
     maxquantity = cur.fetchone()[0]
@@ -688,16 +2774,29 @@ def add_to_cart(item_id):
             if existing['quantity'] < maxquantity:
                 existing['quantity'] += 1
             else:
+                metrics.inc('bazaro_stock_failures_total')
                 return redirect(f'/item/{item_id}?error=2')
         else:
             cart.append({'item_id': item_id, 'quantity': 1})
     else:
+        metrics.inc('bazaro_stock_failures_total')
         return redirect(f'/item/{item_id}?error=1')
     
     session['cart'] = cart
     return redirect(request.referrer or '/products')
 
-@app.route('/cart')
+def load_cart_items(cur, cart):
+    #([(item row, quantity)] in cart order, total) with a single query
+    if not cart:
+        return [], Money(0)
+    cte, params = cart_cte(cart)
+    cur.execute(f'{cte} SELECT i.* FROM cart JOIN items i ON i.item_id = cart.item_id', params)
+    items = {row['item_id']: row for row in cur.fetchall()}
+    cart_items = [(items.get(c['item_id']), c['quantity']) for c in cart]
+    total = Money(sum(item['price_cents'] * quantity for item, quantity in cart_items if item))
+    return cart_items, total
+
+@bp.route('/cart')
 def cart():
     if not get_current_user():
         return redirect('/login')
@@ -714,19 +2813,21 @@ def cart():
             </div>
         '''
     else:
-        conn = get_db_connection()
+        conn = get_read_connection()
         cur = conn.cursor()
+        cart_items, total = load_cart_items(cur, cart)
+        co_purchased = load_co_purchased(cur, [c['item_id'] for c in cart])
+        balance = ledger_balance(cur, wallet_account(current_user['user_id']))
+        cur.close()
+        conn.close()
+        #lines whose item has been deleted can't be shown or bought, drop them
+        if not all(item for item, _ in cart_items):
+            session['cart'] = [c for c, (item, _) in zip(cart, cart_items) if item]
         
         cart_items_html = ''
-        total = 0
         
-        for cart_item in cart:
-            cur.execute('SELECT * FROM items WHERE item_id = ?', (cart_item['item_id'],))
-            item = cur.fetchone()
-            
+        for item, quantity in cart_items:
             if item:
-                subtotal = item['price'] * cart_item['quantity']
-                total += subtotal
                 image_url = f'/product_images/{item["image_filename"]}'
                 
                 cart_items_html += f'''
@@ -735,13 +2836,13 @@ def cart():
                         <div class="cart-item-info">
                             <h3>{item['name']}</h3>
                             <p style="color: #6B7280; font-size: 0.875rem;">{item['description']}</p>
-                            <p style="color: #2563EB; font-weight: bold; margin-top: 0.5rem;">${item['price']:.2f}</p>
+                            <p style="color: #2563EB; font-weight: bold; margin-top: 0.5rem;">{Money(item['price_cents'])}</p>
                         </div>
                         <div class="quantity-controls">
                             <form method="POST" action="/update-cart/{item['item_id']}/decrease" style="display: inline;">
                                 <button type="submit" class="quantity-btn">−</button>
                             </form>
-                            <span style="min-width: 2rem; text-align: center; font-weight: bold;">{cart_item['quantity']}</span>
+                            <span style="min-width: 2rem; text-align: center; font-weight: bold;">{quantity}</span>
                             <form method="POST" action="/update-cart/{item['item_id']}/increase" style="display: inline;">
                                 <button type="submit" class="quantity-btn">+</button>
                             </form>
@@ -752,14 +2853,13 @@ def cart():
                     </div>
                 '''
         
-        cur.close()
-        conn.close()
-        
         error = request.args.get('error')
         if error == "1":
             print(error)
             print("hata1")
             error_msg = '<div class="alert alert-warning">cant add more.</div>'
+        elif error == "2":
+            error_msg = '<div class="alert alert-warning">Some items in your cart are no longer in stock.</div>'
         else:
             error_msg = ""
         
@@ -778,27 +2878,29 @@ def cart():
                         <div style="border-top: 1px solid #E5E7EB; padding-top: 1rem; margin-top: 1rem;">
                             <div style="display: flex; justify-content: space-between; font-size: 1.5rem; font-weight: bold; margin-bottom: 1rem;">
                                 <span>Total:</span>
-                                <span style="color: #2563EB;">${total:.2f}</span>
+                                <span style="color: #2563EB;">{total}</span>
                             </div>
                         </div>
                         <div class="alert alert-info">
                             <p style="margin: 0; font-size: 0.875rem;">Wallet Balance:</p>
-                            <p style="margin: 0; font-size: 1.25rem; font-weight: bold; color: #2563EB;">${current_user['wallet_balance']:.2f}</p>
+                            <p style="margin: 0; font-size: 1.25rem; font-weight: bold; color: #2563EB;">{balance}</p>
                         </div>
                         <form method="POST" action="/checkout">
+                            {idempotency_field()}
                             <button type="submit" class="btn btn-success" style="width: 100%;">Complete Purchase</button>
                         </form>
                     </div>
                 </div>
             </div>
+            {co_purchased_html(co_purchased)}
         '''
     
     return render_page(content, 'Cart')
 
-@app.route('/update-cart/<int:item_id>/<action>', methods=['POST'])
+@bp.route('/update-cart/<int:item_id>/<action>', methods=['POST'])
 def update_cart(item_id, action):
     cart = session.get('cart', [])
-    conn = get_db_connection()
+    conn = get_read_connection()
     cur = conn.cursor()
     cur.execute('SELECT quantity FROM items WHERE item_id = ?', (item_id,))
     maxquantity = cur.fetchone()[0]
@@ -813,6 +2915,7 @@ def update_cart(item_id, action):
                 item_in_cart['quantity'] += 1
             else:
                 session['cart'] = cart
+                metrics.inc('bazaro_stock_failures_total')
                 return redirect('/cart?error=1')
         elif action == 'decrease':
             item_in_cart['quantity'] -= 1
@@ -822,82 +2925,107 @@ def update_cart(item_id, action):
     session['cart'] = cart
     return redirect('/cart')
 
-@app.route('/remove-from-cart/<int:item_id>', methods=['POST'])
+@bp.route('/remove-from-cart/<int:item_id>', methods=['POST'])
 def remove_from_cart(item_id):
     cart = session.get('cart', [])
     cart = [c for c in cart if c['item_id'] != item_id]
     session['cart'] = cart
     return redirect('/cart')
 
-@app.route('/checkout', methods=['POST'])
-def checkout():
-    current_user = get_current_user()
-    if not current_user:
-        return redirect('/login')
+def place_order(user, cart):
+    #the checkout write path shared by /checkout and the API,
+    #returns (outcome, order_id, redirect) with outcome one of ok, replay, empty, stock, insufficient
+    #a double click or client retry gets the original outcome, before even looking at the cart
+    replay = check_idempotent(user['user_id'])
+    if replay:
+        return 'replay', replay[1], replay[0]
     
-    cart = session.get('cart', [])
     if not cart:
-        return redirect('/cart')
+        return 'empty', None, '/cart'
     
     conn = get_db_connection()
     cur = conn.cursor()
+    replay = begin_idempotent(cur, user['user_id'])
+    if replay:
+        cur.close()
+        conn.close()
+        metrics.inc('bazaro_idempotent_replays_total')
+        return 'replay', replay[1], replay[0]
+    
+    #items deleted since they went into the cart are skipped, like the cart page does
+    cte, cte_params = cart_cte(cart)
+    cur.execute(f'{cte} SELECT i.item_id FROM cart JOIN items i ON i.item_id = cart.item_id', cte_params)
+    existing = {row[0] for row in cur.fetchall()}
+    cart = [c for c in cart if c['item_id'] in existing]
+    if not cart:
+        cur.close()
+        conn.close()
+        return 'empty', None, '/cart'
     
-    total = 0
-
     for cart_item in cart:
-        cur.execute(
-        'SELECT price FROM items WHERE item_id = ?',
-        (cart_item['item_id'],))
-        item = cur.fetchone()
-
-        if not item:
-            continue
-
-        price = item['price']
-        subtotal = price * cart_item['quantity']
-        total += subtotal
-
-        cur.execute('UPDATE items SET quantity = quantity - ? WHERE item_id = ?',(cart_item['quantity'], cart_item['item_id']))
-
+        cur.execute('UPDATE items SET quantity = quantity - ?, sales_count = sales_count + ? WHERE item_id = ? AND quantity >= ?',(cart_item['quantity'], cart_item['quantity'], cart_item['item_id'], cart_item['quantity']))
+        if cur.rowcount == 0:
+            #someone else bought the last units since the item went into the cart
+            cur.close()
+            conn.close()
+            metrics.inc('bazaro_stock_failures_total')
+            return 'stock', None, '/cart?error=2'
     
-    if current_user['wallet_balance'] < total:
+    cte, cte_params = cart_cte(cart)
+    cur.execute(f'{cte} SELECT COALESCE(SUM(i.price_cents * cart.quantity), 0) FROM cart JOIN items i ON i.item_id = cart.item_id', cte_params)
+    total = Money(cur.fetchone()[0])
+    
+    #the balance check is part of the update so two checkouts can't both spend the same funds
+    cur.execute(
+        'UPDATE users SET wallet_balance_cents = wallet_balance_cents - ? WHERE user_id = ? AND wallet_balance_cents >= ?',
+        (total, user['user_id'], total)
+    )
+    if cur.rowcount == 0:
         cur.close()
         conn.close()
-        return redirect('/wallet?error=insufficient')
+        metrics.inc('bazaro_checkout_insufficient_funds_total')
+        return 'insufficient', None, '/wallet?error=insufficient'
     
     cur.execute(
-        'INSERT INTO orders (buyer_id, total_price) VALUES (?, ?)',
-        (current_user['user_id'], total)
+        'INSERT INTO orders (buyer_id, total_price_cents) VALUES (?, ?)',
+        (user['user_id'], total)
     )
     order_id = cur.lastrowid
-    
-    for cart_item in cart:
-        cur.execute('SELECT price FROM items WHERE item_id = ?', (cart_item['item_id'],))
-        item = cur.fetchone()
-        if item:
-            cur.execute(
-                'INSERT INTO order_items (order_id, item_id, quantity, price) VALUES (?, ?, ?, ?)',
-                (order_id, cart_item['item_id'], cart_item['quantity'], item['price'])
-            )
+    post_wallet_transaction(cur, 'purchase', [(wallet_account(user['user_id']), -total), ('sales', total)], order_id)
     
     cur.execute(
-        'INSERT INTO payments (order_id, payment_status, payment_method) VALUES (?, ?, ?)',
-        (order_id, 'completed', 'wallet')
+        f'''{cte} INSERT INTO order_items (order_id, item_id, quantity, price_cents)
+            SELECT ?, i.item_id, cart.quantity, i.price_cents FROM cart JOIN items i ON i.item_id = cart.item_id''',
+        cte_params + [order_id]
     )
     
     cur.execute(
-        'UPDATE users SET wallet_balance = wallet_balance - ? WHERE user_id = ?',
-        (total, current_user['user_id'])
+        'INSERT INTO payments (order_id, payment_status, payment_method) VALUES (?, ?, ?)',
+        (order_id, 'completed', 'wallet')
     )
+    remember_idempotent(cur, user['user_id'], '/orders?success=1', order_id)
+    #everything after the purchase runs in the job worker, committed together with the order
+    enqueue_job(cur, 'order_placed', {'order_id': order_id, 'buyer_id': user['user_id']})
     
     conn.commit()
     cur.close()
     conn.close()
+    metrics.inc('bazaro_orders_total')
+    return 'ok', order_id, '/orders?success=1'
+
+@bp.route('/checkout', methods=['POST'])
+def checkout():
+    current_user = get_current_user()
+    if not current_user:
+        return redirect('/login')
     
-    session['cart'] = []
-    return redirect('/orders?success=1')
+    outcome, order_id, location = place_order(current_user, session.get('cart', []))
+    if outcome in ('ok', 'replay'):
+        #a retried checkout whose first response was lost has bought the cart all the same
+        session['cart'] = []
+    return redirect(location)
 
-@app.route('/wallet')
+@bp.route('/wallet')
 def wallet():
     current_user = get_current_user()
     if not current_user:
@@ -909,9 +3037,51 @@ def wallet():
     alerts = ''
     if error == 'insufficient':
         alerts = '<div class="alert alert-warning">Insufficient wallet balance. Please add funds.</div>'
+    elif error == 'amount':
+        alerts = '<div class="alert alert-warning">Please enter a valid amount.</div>'
     if success:
         alerts = '<div class="alert alert-success">Funds added successfully!</div>'
     
+    #statement, newest first, paged with ?before=<entry_id>
+    before = request.args.get('before', type=int)
+    conn = get_read_connection()
+    cur = conn.cursor()
+    query = '''SELECT e.entry_id, e.amount_cents, t.kind, t.order_id, t.created_at
+               FROM wallet_entries e JOIN wallet_transactions t ON t.txn_id = e.txn_id
+               WHERE e.account = ?'''
+    params = [wallet_account(current_user['user_id'])]
+    if before:
+        query += ' AND e.entry_id < ?'
+        params.append(before)
+    query += ' ORDER BY e.entry_id DESC LIMIT ?'
+    params.append(STATEMENT_PAGE_SIZE + 1)
+    cur.execute(query, params)
+    entries = cur.fetchall()
+    balance = ledger_balance(cur, wallet_account(current_user['user_id']))
+    cur.close()
+    conn.close()
+    
+    has_more = len(entries) > STATEMENT_PAGE_SIZE
+    entries = entries[:STATEMENT_PAGE_SIZE]
+    kinds = {'opening': 'Opening balance', 'deposit': 'Funds added', 'purchase': 'Purchase'}
+    statement_html = ''
+    for entry in entries:
+        amount = Money(entry['amount_cents'])
+        description = kinds.get(entry['kind'], entry['kind'])
+        if entry['order_id']:
+            description += f' <a href="/orders" class="seller-link">#{entry["order_id"]}</a>'
+        statement_html += f'''
+            <div style="display: flex; justify-content: space-between; font-size: 0.875rem; padding: 0.5rem 0; border-bottom: 1px solid #E5E7EB;">
+                <span><span style="color: #6B7280; margin-right: 1rem;">{entry['created_at']}</span>{description}</span>
+                <span style="font-weight: 600; color: {'#059669' if amount > Money(0) else '#DC2626'};">{'+' if amount > Money(0) else ''}{amount}</span>
+            </div>
+        '''
+    pager = ''
+    if before:
+        pager += '<a href="/wallet" class="seller-link">Newest</a>'
+    if has_more:
+        pager += f'<a href="/wallet?before={entries[-1]["entry_id"]}" class="seller-link" style="margin-left: auto;">Older →</a>'
+    
     content = f'''
         {alerts}
         
@@ -919,13 +3089,14 @@ def wallet():
         
         <div class="wallet-card">
             <p style="font-size: 0.875rem; margin-bottom: 0.5rem;">Current Balance</p>
-            <div class="wallet-balance">${current_user['wallet_balance']:.2f}</div>
+            <div class="wallet-balance">{balance}</div>
         </div>
         
         <div style="max-width: 600px; margin: 0 auto;">
             <div class="card">
                 <h3 style="margin-bottom: 1.5rem;">Add Funds</h3>
                 <form method="POST" action="/add-funds">
+                    {idempotency_field()}
                     <div class="form-group">
                         <label>Amount ($)</label>
                         <input type="number" step="0.01" name="amount" class="form-control" placeholder="Enter amount" required>
@@ -933,42 +3104,115 @@ def wallet():
                     <button type="submit" class="btn btn-success" style="width: 100%;">Add Funds</button>
                 </form>
             </div>
+            
+            <div class="card">
+                <h3 style="margin-bottom: 1.5rem;">Statement</h3>
+                {statement_html if statement_html else '<p style="color: #6B7280;">No transactions yet</p>'}
+                <div style="display: flex; margin-top: 1rem;">{pager}</div>
+            </div>
         </div>
     '''
     
     return render_page(content, 'Wallet')
 
-@app.route('/add-funds', methods=['POST'])
+@bp.route('/add-funds', methods=['POST'])
 def add_funds():
     current_user = get_current_user()
     if not current_user:
         return redirect('/login')
     
-    amount = float(request.form.get('amount', 0))
-    if amount > 0:
+    replay = check_idempotent(current_user['user_id'])
+    if replay:
+        return redirect(replay[0])
+    
+    try:
+        amount = Money.parse(request.form.get('amount', 0))
+    except ValueError:
+        return redirect('/wallet?error=amount')
+    if amount > Money(0):
         conn = get_db_connection()
         cur = conn.cursor()
+        replay = begin_idempotent(cur, current_user['user_id'])
+        if replay:
+            cur.close()
+            conn.close()
+            metrics.inc('bazaro_idempotent_replays_total')
+            return redirect(replay[0])
         cur.execute(
-            'UPDATE users SET wallet_balance = wallet_balance + ? WHERE user_id = ?',
+            'UPDATE users SET wallet_balance_cents = wallet_balance_cents + ? WHERE user_id = ?',
             (amount, current_user['user_id'])
         )
+        post_wallet_transaction(cur, 'deposit', [(wallet_account(current_user['user_id']), amount), ('funding', -amount)])
+        remember_idempotent(cur, current_user['user_id'], '/wallet?success=1')
         conn.commit()
         cur.close()
         conn.close()
     
     return redirect('/wallet?success=1')
 
-@app.route('/orders')
+ORDERS_PAGE_SIZE = 20
+
+def query_orders(cur, schema, user_id, before, limit):
+    #up to limit of the user's orders from main or archive, newest first, each with its
+    #items and payment status, in three queries however many orders there are
+    query = f'SELECT * FROM {schema}.orders WHERE buyer_id = ?'
+    params = [user_id]
+    if before:
+        query += ' AND order_id < ?'
+        params.append(before)
+    cur.execute(query + ' ORDER BY order_id DESC LIMIT ?', params + [limit])
+    orders = [{'order': row, 'payment_status': None, 'items': []} for row in cur.fetchall()]
+    if not orders:
+        return []
+    
+    by_id = {o['order']['order_id']: o for o in orders}
+    placeholders = ','.join('?' * len(by_id))
+    cur.execute(f'SELECT order_id, payment_status FROM {schema}.payments WHERE order_id IN ({placeholders})', list(by_id))
+    for order_id, status in cur.fetchall():
+        by_id[order_id]['payment_status'] = status
+    cur.execute(
+        f'''SELECT oi.*, i.name FROM {schema}.order_items oi 
+            JOIN main.items i ON oi.item_id = i.item_id 
+            WHERE oi.order_id IN ({placeholders}) ORDER BY oi.order_item_id''',
+        list(by_id)
+    )
+    for order_item in cur.fetchall():
+        by_id[order_item['order_id']]['items'].append(order_item)
+    return orders
+
+def load_orders(cur, user_id, before=None, limit=ORDERS_PAGE_SIZE):
+    #a page of the user's orders, returns (orders, has_more); archived orders are all older
+    #than the live ones, so the archive is only read once the live orders run out
+    orders = query_orders(cur, 'main', user_id, before, limit + 1)
+    if len(orders) <= limit and attach_archive(cur.connection):
+        archive_before = orders[-1]['order']['order_id'] if orders else before
+        orders += query_orders(cur, 'archive', user_id, archive_before, limit + 1 - len(orders))
+    return orders[:limit], len(orders) > limit
+
+def order_totals(cur, user_id):
+    #(order count, total spent) over live and archived orders; UNION drops the copy of an
+    #order that is in both while archive_orders is between its copy and delete
+    query = 'SELECT order_id, total_price_cents FROM main.orders WHERE buyer_id = ?'
+    params = [user_id]
+    if attach_archive(cur.connection):
+        query += ' UNION SELECT order_id, total_price_cents FROM archive.orders WHERE buyer_id = ?'
+        params.append(user_id)
+    cur.execute(f'SELECT COUNT(*), COALESCE(SUM(total_price_cents), 0) FROM ({query})', params)
+    count, total = cur.fetchone()
+    return count, Money(total)
+
+@bp.route('/orders')
 def orders():
     current_user = get_current_user()
     if not current_user:
         return redirect('/login')
     
-    conn = get_db_connection()
+    before = request.args.get('before', type=int)
+    conn = get_read_connection()
     cur = conn.cursor()
-    
-    cur.execute('SELECT * FROM orders WHERE buyer_id = ? ORDER BY order_date DESC', (current_user['user_id'],))
-    user_orders = cur.fetchall()
+    user_orders, has_more = load_orders(cur, current_user['user_id'], before)
+    cur.close()
+    conn.close()
     
     success = request.args.get('success')
     alerts = '<div class="alert alert-success">Order placed successfully!</div>' if success else ''
@@ -984,24 +3228,15 @@ def orders():
         '''
     else:
         orders_html = ''
-        for order in user_orders:
-            cur.execute('SELECT * FROM payments WHERE order_id = ?', (order['order_id'],))
-            payment = cur.fetchone()
-            
-            cur.execute(
-                '''SELECT oi.*, i.name FROM order_items oi 
-                   JOIN items i ON oi.item_id = i.item_id 
-                   WHERE oi.order_id = ?''',
-                (order['order_id'],)
-            )
-            order_items = cur.fetchall()
+        for entry in user_orders:
+            order = entry['order']
             
             items_html = ''
-            for order_item in order_items:
+            for order_item in entry['items']:
                 items_html += f'''
                     <div style="display: flex; justify-content: space-between; font-size: 0.875rem; margin-bottom: 0.5rem;">
                         <span>{order_item['name']} x {order_item['quantity']}</span>
-                        <span style="font-weight: 600;">${(order_item['price'] * order_item['quantity']):.2f}</span>
+                        <span style="font-weight: 600;">{Money(order_item['price_cents']) * order_item['quantity']}</span>
                     </div>
                 '''
             
@@ -1015,8 +3250,8 @@ def orders():
                             <p style="color: #6B7280; font-size: 0.875rem;">{order_date}</p>
                         </div>
                         <div style="text-align: right;">
-                            <p style="font-size: 1.5rem; font-weight: bold; color: #2563EB; margin-bottom: 0.5rem;">${order['total_price']:.2f}</p>
-                            <span class="status-badge">{payment['payment_status'] if payment else 'Pending'}</span>
+                            <p style="font-size: 1.5rem; font-weight: bold; color: #2563EB; margin-bottom: 0.5rem;">{Money(order['total_price_cents'])}</p>
+                            <span class="status-badge">{entry['payment_status'] or 'Pending'}</span>
                         </div>
                     </div>
                     <div style="border-top: 1px solid #E5E7EB; padding-top: 1rem;">
@@ -1026,29 +3261,32 @@ def orders():
                 </div>
             '''
         
+        pager = ''
+        if before:
+            pager += '<a href="/orders" class="btn" style="background: #E5E7EB;">← Newest orders</a>'
+        if has_more:
+            pager += f'<a href="/orders?before={user_orders[-1]["order"]["order_id"]}" class="btn btn-primary" style="margin-left: auto;">Older orders →</a>'
+        
         content = f'''
             {alerts}
             <h2 style="margin-bottom: 1.5rem;">My Orders</h2>
             {orders_html}
+            <div style="display: flex; margin-top: 1.5rem;">{pager}</div>
         '''
     
-    cur.close()
-    conn.close()
-    
     return render_page(content, 'Orders')
 
-@app.route('/profile')
+@bp.route('/profile')
 def profile():
     current_user = get_current_user()
     if not current_user:
         return redirect('/login')
     
-    conn = get_db_connection()
+    conn = get_read_connection()
     cur = conn.cursor()
     
-    cur.execute('SELECT * FROM orders WHERE buyer_id = ?', (current_user['user_id'],))
-    user_orders = cur.fetchall()
-    total_spent = sum(o['total_price'] for o in user_orders)
+    order_count, total_spent = order_totals(cur, current_user['user_id'])
+    balance = ledger_balance(cur, wallet_account(current_user['user_id']))
     
     # Get products added by this user
     cur.execute('SELECT * FROM items WHERE owner_user_id = ?', (current_user['user_id'],))
@@ -1076,7 +3314,7 @@ def profile():
                         <div class="product-category">{cat['name'] if cat else ''}</div>
                         <div class="product-name">{item['name']}</div>
                         <p style="color: #6B7280; font-size: 0.875rem; margin-bottom: 0.5rem;">{item['description'][:50] if item['description'] else ''}...</p>
-                        <div class="product-price">${item['price']:.2f}</div>
+                        <div class="product-price">{Money(item['price_cents'])}</div>
                         <div style="margin-top: 0.5rem; color: #6B7280; font-size: 0.75rem;">Stock: {item['quantity']}</div>
                     </div>
                 </div>
@@ -1095,7 +3333,10 @@ def profile():
             <div style="margin-top: 2rem;">
                 <div style="display: flex; justify-content: space-between; align-items: center; margin-bottom: 1rem;">
                     <h3 style="font-weight: bold;">🛍️ My Products ({len(my_products)})</h3>
-                    <a href="/add-product" class="btn btn-success" style="font-size: 0.875rem;">+ Add New Product</a>
+                    <div style="display: flex; gap: 0.5rem;">
+                        <a href="/import-products" class="btn btn-primary" style="font-size: 0.875rem;">Import / Export</a>
+                        <a href="/add-product" class="btn btn-success" style="font-size: 0.875rem;">+ Add New Product</a>
+                    </div>
                 </div>
                 <div class="grid grid-3">
                     {my_products_html}
@@ -1109,6 +3350,7 @@ def profile():
                 <div class="card" style="text-align: center; padding: 2rem;">
                     <p style="color: #6B7280; margin-bottom: 1rem;">You haven't added any products yet.</p>
                     <a href="/add-product" class="btn btn-success">+ Add Your First Product</a>
+                    <a href="/import-products" class="btn btn-primary">Import Products</a>
                 </div>
             </div>
         '''
@@ -1135,11 +3377,11 @@ def profile():
                     </div>
                     <div style="display: flex; justify-content: space-between; margin-bottom: 1rem;">
                         <span style="color: #6B7280;">Wallet Balance:</span>
-                        <span style="font-weight: 600; color: #2563EB;">${current_user['wallet_balance']:.2f}</span>
+                        <span style="font-weight: 600; color: #2563EB;">{balance}</span>
                     </div>
                     <div style="display: flex; justify-content: space-between;">
                         <span style="color: #6B7280;">Total Orders:</span>
-                        <span style="font-weight: 600;">{len(user_orders)}</span>
+                        <span style="font-weight: 600;">{order_count}</span>
                     </div>
                 </div>
                 
@@ -1152,7 +3394,7 @@ def profile():
                         </div>
                         <div style="background: #D1FAE5; padding: 1rem; border-radius: 0.5rem;">
                             <p style="color: #6B7280; font-size: 0.875rem; margin-bottom: 0.25rem;">Total Spent</p>
-                            <p style="font-size: 1.5rem; font-weight: bold; color: #059669;">${total_spent:.2f}</p>
+                            <p style="font-size: 1.5rem; font-weight: bold; color: #059669;">{total_spent}</p>
                         </div>
                         <div style="background: #FEF3C7; padding: 1rem; border-radius: 0.5rem;">
                             <p style="color: #6B7280; font-size: 0.875rem; margin-bottom: 0.25rem;">My Products</p>
@@ -1168,8 +3410,1000 @@ def profile():
     
     return render_page(content, 'Profile')
 
+@bp.cli.command('wallet-reconcile')
+def wallet_reconcile_command():
+    #checkpoints every account, then compares the ledger with users.wallet_balance_cents
+    conn = sqlite3.connect(current_app.config['DATABASE'])
+    cur = conn.cursor()
+    cur.execute('SELECT DISTINCT account FROM wallet_entries')
+    for (account,) in cur.fetchall():
+        checkpoint_wallet_account(cur, account)
+    conn.commit()
+    
+    problems = 0
+    cur.execute('SELECT COALESCE(SUM(amount_cents), 0) FROM wallet_entries')
+    imbalance = cur.fetchone()[0]
+    if imbalance:
+        problems += 1
+        click.echo(f"ledger does not balance, entries sum to {Money(imbalance)}")
+    cur.execute('SELECT user_id, wallet_balance_cents FROM users')
+    for user_id, balance in cur.fetchall():
+        ledger = ledger_balance(cur, wallet_account(user_id))
+        if ledger != Money(balance):
+            problems += 1
+            click.echo(f"user {user_id}: wallet balance {Money(balance)}, ledger {ledger}")
+    cur.close()
+    conn.close()
+    click.echo(f"{problems} problem(s) found")
+
+@bp.cli.command('rebuild-facets')
+def rebuild_facets_command():
+    #recount facet_counts from items, the triggers keep it current after that
+    conn = sqlite3.connect(current_app.config['DATABASE'])
+    rebuild_facet_counts(conn.cursor())
+    conn.commit()
+    conn.close()
+
+@bp.cli.command('import-products')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--owner-user-id', type=int, help='user the products belong to')
+@click.option('--seller-id', type=int, help='seller the products belong to')
+@click.option('--images', type=click.Path(exists=True), help='directory or .zip with the product images')
+@click.option('--batch-size', type=int, default=IMPORT_BATCH_SIZE, show_default=True)
+def import_products_command(path, owner_user_id, seller_id, images, batch_size):
+    #products without an owner could not be edited or deleted from the site
+    if owner_user_id is None and seller_id is None:
+        raise click.UsageError('pass --owner-user-id or --seller-id')
+    database = current_app.config['DATABASE']
+    fmt = 'jsonl' if path.lower().endswith(('.jsonl', '.json')) else 'csv'
+    try:
+        image_source = ImageSource(images) if images else None
+    except zipfile.BadZipFile:
+        raise click.BadParameter('not a directory or a zip archive', param_hint='--images')
+    try:
+        with open(path, encoding='utf-8-sig', newline='') as f:
+            imported, failed, errors = import_products(
+                read_import_rows(f, fmt), lambda: sqlite3.connect(database, timeout=30), current_app.config['UPLOAD_FOLDER'],
+                owner_user_id=owner_user_id, seller_id=seller_id, images=image_source, batch_size=batch_size)
+    finally:
+        if image_source:
+            image_source.close()
+    for number, message in errors:
+        click.echo(f"row {number}: {message}")
+    click.echo(f"{imported} products imported, {failed} rows skipped")
+
+@bp.cli.command('export-products')
+@click.argument('path', type=click.Path(dir_okay=False, writable=True))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), default='csv', show_default=True)
+@click.option('--owner-user-id', type=int, help='only export this user\'s products')
+def export_products_command(path, fmt, owner_user_id):
+    conn = sqlite3.connect(f"file:{quote(current_app.config['DATABASE'])}?mode=ro", uri=True)
+    conn.row_factory = sqlite3.Row
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        for chunk in export_products(conn, fmt, owner_user_id):
+            f.write(chunk)
+
+def load_secret_key(app):
+    #workers must all sign sessions with the same key, so a generated key is kept in a file;
+    #O_EXCL makes sure only one process ever writes it
+    path = os.path.join(app.instance_path, 'secret_key')
+    os.makedirs(app.instance_path, exist_ok=True)
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        for _ in range(50):
+            with open(path) as f:
+                key = f.read().strip()
+            if key:
+                return key
+            time.sleep(0.01)
+        raise RuntimeError(f'{path} is empty')
+    key = secrets.token_hex(32)
+    with os.fdopen(fd, 'w') as f:
+        f.write(key)
+    return key
+
+@bp.cli.command('migrate')
+def migrate_command():
+    migrate(current_app)
+
+# Background jobs. Jobs are rows in the jobs table, enqueued inside the caller's
+# transaction so they exist exactly when its writes commit (outbox). `flask run-worker`
+# claims them with a lease, a worker that dies leaves the job to be claimed again
+# once the lease runs out.
+JOB_HANDLERS = {}
+JOB_BACKOFF_MAX = 3600
+
+def enqueue_job(cur, kind, payload, delay=0):
+    cur.execute(
+        'INSERT INTO jobs (kind, payload, run_after) VALUES (?, ?, ?)',
+        (kind, json.dumps(payload, separators=(',', ':')), time.time() + delay)
+    )
+    return cur.lastrowid
+
+def job_handler(kind):
+    #registers handler(cur, payload) for a kind of job, a kind can have several;
+    #handlers run in the transaction that marks the job done, so their database writes
+    #happen once, anything outside the database happens at least once
+    def register(handler):
+        JOB_HANDLERS.setdefault(kind, []).append(handler)
+        return handler
+    return register
+
+def claim_job(conn, lease, max_attempts):
+    now = time.time()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        #a job that keeps outliving its lease is probably taking its worker down with it
+        conn.execute(
+            "UPDATE jobs SET status = 'dead', last_error = 'lease expired' WHERE status = 'running' AND run_after <= ? AND attempts >= ?",
+            (now, max_attempts)
+        )
+        job = conn.execute(
+            """SELECT * FROM jobs WHERE status IN ('queued', 'running') AND run_after <= ?
+               ORDER BY run_after, job_id LIMIT 1""",
+            (now,)
+        ).fetchone()
+        if job:
+            conn.execute(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1, run_after = ? WHERE job_id = ?",
+                (now + lease, job['job_id'])
+            )
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    return job
+
+def job_retry_delay(attempt, base):
+    #exponential backoff with jitter so failed jobs don't all come back at once
+    return min(base * 2 ** (attempt - 1), JOB_BACKOFF_MAX) * random.uniform(0.5, 1.5)
+
+def run_job(conn, job, max_attempts, backoff):
+    #returns the status the job ended in
+    attempt = job['attempts'] + 1
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        handlers = JOB_HANDLERS.get(job['kind'])
+        if not handlers:
+            raise LookupError(f"no handler for job kind {job['kind']!r}")
+        cur = conn.cursor()
+        payload = json.loads(job['payload'])
+        for handler in handlers:
+            handler(cur, payload)
+        #a job whose lease ran out may have been claimed again by then, only its latest claim counts
+        cur.execute(
+            "UPDATE jobs SET status = 'done', finished_at = CURRENT_TIMESTAMP WHERE job_id = ? AND attempts = ?",
+            (job['job_id'], attempt)
+        )
+        cur.close()
+        conn.execute('COMMIT')
+        return 'done'
+    except Exception as e:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        status = 'dead' if attempt >= max_attempts else 'queued'
+        current_app.logger.warning('job %s (%s) attempt %s failed: %s', job['job_id'], job['kind'], attempt, e)
+        try:
+            conn.execute(
+                'UPDATE jobs SET status = ?, run_after = ?, last_error = ? WHERE job_id = ? AND attempts = ?',
+                (status, time.time() + job_retry_delay(attempt, backoff), f'{type(e).__name__}: {e}', job['job_id'], attempt)
+            )
+        except sqlite3.OperationalError as busy:
+            #the database is still busy, the job stays running and is claimed again once its lease runs out
+            current_app.logger.warning('job %s could not be rescheduled: %s', job['job_id'], busy)
+            return 'running'
+        return status
+
+def job_worker(app, stop, poll_interval, drain):
+    with app.app_context():
+        config = app.config
+        conn = sqlite3.connect(config['DATABASE'], timeout=config['DB_TIMEOUT'], isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            while not stop.is_set():
+                try:
+                    job = claim_job(conn, config['JOB_LEASE_SECONDS'], config['JOB_MAX_ATTEMPTS'])
+                except sqlite3.OperationalError as e:
+                    #locked past DB_TIMEOUT by a long write (a rollup rebuild, an archive batch, a VACUUM), try again later
+                    app.logger.warning('job worker could not claim a job: %s', e)
+                    stop.wait(poll_interval)
+                    continue
+                if job:
+                    run_job(conn, job, config['JOB_MAX_ATTEMPTS'], config['JOB_BACKOFF_SECONDS'])
+                elif drain:
+                    return
+                else:
+                    stop.wait(poll_interval)
+        finally:
+            conn.close()
+
+@bp.cli.command('run-worker')
+@click.option('--threads', type=int, help='worker threads, defaults to JOB_WORKER_THREADS')
+@click.option('--poll-interval', type=float, default=1.0, show_default=True, help='seconds to wait when the queue is empty')
+@click.option('--drain', is_flag=True, help='exit once no job is ready instead of waiting for more')
+def run_worker_command(threads, poll_interval, drain):
+    app = current_app._get_current_object()
+    check_schema(sqlite3.connect(app.config['DATABASE']))
+    stop = threading.Event()
+    #on SIGTERM or ctrl-c running jobs finish and nothing new is claimed
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    workers = [
+        threading.Thread(target=job_worker, args=(app, stop, poll_interval, drain), name=f'bazaro-job-worker-{n}')
+        for n in range(threads or app.config['JOB_WORKER_THREADS'])
+    ]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            while worker.is_alive():
+                worker.join(0.5)
+    except KeyboardInterrupt:
+        stop.set()
+        for worker in workers:
+            worker.join()
+
+@bp.cli.command('jobs')
+@click.option('--retry-dead', is_flag=True, help='queue the dead jobs again')
+def jobs_command(retry_dead):
+    conn = sqlite3.connect(current_app.config['DATABASE'])
+    if retry_dead:
+        count = conn.execute("UPDATE jobs SET status = 'queued', attempts = 0, run_after = ? WHERE status = 'dead'", (time.time(),)).rowcount
+        conn.commit()
+        click.echo(f'{count} dead job(s) queued again')
+    for kind, status, count in conn.execute('SELECT kind, status, COUNT(*) FROM jobs GROUP BY kind, status ORDER BY kind, status'):
+        click.echo(f'{kind:<24} {status:<8} {count}')
+    conn.close()
+
+@job_handler('order_placed')
+def log_receipt(cur, payload):
+    #receipt for the buyer, and the items this order sold out
+    cur.execute('SELECT o.total_price_cents, u.email FROM orders o JOIN users u ON u.user_id = o.buyer_id WHERE o.order_id = ?', (payload['order_id'],))
+    order = cur.fetchone()
+    if order is None:
+        return
+    current_app.logger.info('receipt: order %s for %s, total %s', payload['order_id'], order['email'], Money(order['total_price_cents']))
+    cur.execute('SELECT i.item_id, i.name FROM order_items oi JOIN items i ON i.item_id = oi.item_id WHERE oi.order_id = ? AND i.quantity <= 0', (payload['order_id'],))
+    for item in cur.fetchall():
+        current_app.logger.info('stock alert: item %s (%s) is sold out', item['item_id'], item['name'])
+
+# Sales reporting. The rollup tables are only written by the order_placed job and
+# rebuild_sales_rollups, the dashboard never touches orders or order_items.
+# Sellers use the same 's:<seller_id>' / 'u:<owner_user_id>' keys as the facets,
+# sales of items that no longer exist count under category 0 and seller ''.
+SALES_LINES_SQL = """
+    SELECT date(o.order_date) AS day, o.order_id, oi.item_id,
+           COALESCE(i.category_id, 0) AS category_id,
+           COALESCE('s:' || i.seller_id, 'u:' || i.owner_user_id, '') AS seller_key,
+           oi.quantity AS units, oi.quantity * oi.price_cents AS revenue_cents
+    FROM {schema}.orders o
+    JOIN {schema}.order_items oi ON oi.order_id = o.order_id
+    LEFT JOIN main.items i ON i.item_id = oi.item_id
+"""
+SALES_DASHBOARD_DAYS = 30
+
+def rebuild_sales_rollups(cur):
+    #recount every rollup from the order history, in the caller's transaction;
+    #archived orders are included when the archive is attached
+    for table in ('sales_daily', 'sales_by_category', 'sales_by_seller', 'sales_by_item', 'sales_rollup_orders'):
+        cur.execute(f'DELETE FROM {table}')
+    cur.execute('PRAGMA database_list')
+    schemas = [row[1] for row in cur.fetchall() if row[1] in ('main', 'archive')]
+    cur.execute(f"CREATE TEMP TABLE sales_lines AS {SALES_LINES_SQL.format(schema='main')}")
+    if 'archive' in schemas:
+        #an order being archived right now is in both databases, count it once
+        cur.execute(f"INSERT INTO sales_lines {SALES_LINES_SQL.format(schema='archive')} WHERE o.order_id NOT IN (SELECT order_id FROM main.orders)")
+    cur.execute('INSERT INTO sales_daily SELECT day, COUNT(DISTINCT order_id), SUM(units), SUM(revenue_cents) FROM sales_lines GROUP BY day')
+    for table, key in (('sales_by_category', 'category_id'), ('sales_by_seller', 'seller_key'), ('sales_by_item', 'item_id')):
+        cur.execute(f'INSERT INTO {table} SELECT {key}, SUM(units), SUM(revenue_cents) FROM sales_lines GROUP BY {key}')
+    for schema in schemas:
+        cur.execute(f'INSERT OR IGNORE INTO sales_rollup_orders SELECT order_id FROM {schema}.orders')
+    cur.execute('DROP TABLE temp.sales_lines')
+
+@job_handler('order_placed')
+def apply_order_to_rollups(cur, payload):
+    cur.execute('INSERT OR IGNORE INTO sales_rollup_orders (order_id) VALUES (?)', (payload['order_id'],))
+    if cur.rowcount == 0:
+        return
+    cur.execute(f"{SALES_LINES_SQL.format(schema='main')} WHERE o.order_id = ?", (payload['order_id'],))
+    lines = cur.fetchall()
+    if not lines:
+        return
+    cur.execute(
+        '''INSERT INTO sales_daily (day, orders, units, revenue_cents) VALUES (?, 1, ?, ?)
+           ON CONFLICT (day) DO UPDATE SET orders = orders + 1, units = units + excluded.units, revenue_cents = revenue_cents + excluded.revenue_cents''',
+        (lines[0]['day'], sum(l['units'] for l in lines), sum(l['revenue_cents'] for l in lines))
+    )
+    for table, key in (('sales_by_category', 'category_id'), ('sales_by_seller', 'seller_key'), ('sales_by_item', 'item_id')):
+        cur.executemany(
+            f'''INSERT INTO {table} ({key}, units, revenue_cents) VALUES (?, ?, ?)
+                ON CONFLICT ({key}) DO UPDATE SET units = units + excluded.units, revenue_cents = revenue_cents + excluded.revenue_cents''',
+            [(l[key], l['units'], l['revenue_cents']) for l in lines]
+        )
+
+@bp.cli.command('rebuild-sales-rollups')
+def rebuild_sales_rollups_command():
+    #one write transaction over the whole order history, run it off-peak
+    conn = sqlite3.connect(current_app.config['DATABASE'], isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    cur = conn.cursor()
+    if os.path.exists(current_app.config['ARCHIVE_DATABASE']):
+        cur.execute('ATTACH DATABASE ? AS archive', (current_app.config['ARCHIVE_DATABASE'],))
+    cur.execute('BEGIN IMMEDIATE')
+    try:
+        rebuild_sales_rollups(cur)
+        cur.execute('COMMIT')
+    except Exception:
+        cur.execute('ROLLBACK')
+        raise
+    cur.execute('SELECT COUNT(*) FROM sales_rollup_orders')
+    click.echo(f'sales rollups rebuilt from {cur.fetchone()[0]} order(s)')
+    conn.close()
+
+def sales_table_html(title, rows):
+    #rows of (label, units, revenue_cents)
+    rows_html = ''
+    for label, units, revenue in rows:
+        rows_html += f'''
+            <div style="display: flex; justify-content: space-between; padding: 0.5rem 0; border-bottom: 1px solid #E5E7EB;">
+                <span>{escape(label)}</span>
+                <span>{units} sold, <strong>{Money(revenue)}</strong></span>
+            </div>
+        '''
+    return f'''
+        <div class="card">
+            <h3 style="margin-bottom: 1rem;">{title}</h3>
+            {rows_html if rows_html else '<p>No sales yet</p>'}
+        </div>
+    '''
+
+@bp.route('/admin/sales')
+def admin_sales():
+    if not is_admin(get_current_user()):
+        abort(403)
+    
+    conn = get_read_connection()
+    cur = conn.cursor()
+    cur.execute('SELECT * FROM sales_daily ORDER BY day DESC LIMIT ?', (SALES_DASHBOARD_DAYS,))
+    days = cur.fetchall()
+    cur.execute('SELECT COALESCE(SUM(orders), 0), COALESCE(SUM(units), 0), COALESCE(SUM(revenue_cents), 0) FROM sales_daily')
+    total_orders, total_units, total_revenue = cur.fetchone()
+    cur.execute('SELECT s.*, c.name FROM sales_by_category s LEFT JOIN categories c ON c.category_id = s.category_id ORDER BY s.revenue_cents DESC')
+    categories = cur.fetchall()
+    cur.execute('SELECT * FROM sales_by_seller ORDER BY revenue_cents DESC LIMIT 20')
+    sellers = cur.fetchall()
+    names = seller_names(cur, [s['seller_key'] for s in sellers])
+    cur.execute('SELECT s.*, i.name FROM sales_by_item s LEFT JOIN items i ON i.item_id = s.item_id ORDER BY s.revenue_cents DESC LIMIT 10')
+    top_items = cur.fetchall()
+    cur.close()
+    conn.close()
+    
+    days_html = sales_table_html(f'Last {SALES_DASHBOARD_DAYS} days', [(f"{d['day']} ({d['orders']} orders)", d['units'], d['revenue_cents']) for d in days])
+    items_html = sales_table_html('Top products', [(i['name'] or f"Item #{i['item_id']}", i['units'], i['revenue_cents']) for i in top_items])
+    categories_html = sales_table_html('Categories', [(c['name'] or 'Uncategorized', c['units'], c['revenue_cents']) for c in categories])
+    sellers_html = sales_table_html('Sellers', [(names.get(s['seller_key'], 'Unknown seller'), s['units'], s['revenue_cents']) for s in sellers])
+    
+    content = f'''
+        <h2 style="margin-bottom: 1.5rem;">Sales</h2>
+        <div class="wallet-card">
+            <p>Revenue from {total_orders} orders, {total_units} units</p>
+            <div class="wallet-balance">{Money(total_revenue)}</div>
+        </div>
+        <div class="grid grid-2">
+            {days_html}
+            {items_html}
+            {categories_html}
+            {sellers_html}
+        </div>
+    '''
+    return render_page(content, 'Sales')
+
+# Order archive. Old orders with their items and payments move to a separate
+# database, /orders attaches it read-only when a user pages past the live ones.
+ARCHIVE_TABLES = {
+    'orders': 'order_id INTEGER PRIMARY KEY, buyer_id INTEGER, order_date TIMESTAMP, total_price_cents INTEGER NOT NULL DEFAULT 0',
+    'order_items': 'order_item_id INTEGER PRIMARY KEY, order_id INTEGER, item_id INTEGER, quantity INTEGER NOT NULL, price_cents INTEGER NOT NULL DEFAULT 0',
+    'payments': 'payment_id INTEGER PRIMARY KEY, order_id INTEGER, payment_status TEXT NOT NULL, payment_date TIMESTAMP, payment_method TEXT NOT NULL',
+}
+
+def attach_archive(conn):
+    #attaches the archive read-only, once per pooled connection; False while there is no archive yet
+    if conn.archive_attached:
+        return True
+    path = current_app.config['ARCHIVE_DATABASE']
+    if not os.path.exists(path):
+        return False
+    conn.execute('ATTACH DATABASE ? AS archive', (f'file:{quote(path)}?mode=ro',))
+    conn.archive_attached = True
+    return True
+
+def create_archive_schema(conn):
+    conn.execute('PRAGMA archive.journal_mode = WAL')
+    for table, columns in ARCHIVE_TABLES.items():
+        conn.execute(f'CREATE TABLE IF NOT EXISTS archive.{table} ({columns})')
+    conn.execute('CREATE INDEX IF NOT EXISTS archive.idx_orders_buyer ON orders (buyer_id, order_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS archive.idx_order_items_order ON order_items (order_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS archive.idx_payments_order ON payments (order_id)')
+
+def archive_orders(conn, older_than_days, batch_size):
+    #moves orders older than the cutoff in batches, returns how many moved. Each batch is copied
+    #in one transaction and deleted from the live database in the next (sqlite can't commit two
+    #WAL databases atomically), so an interrupted run copies a batch again and loses nothing.
+    #Orders still waiting for their order_placed job stay until it has counted them.
+    moved = 0
+    while True:
+        ids = [row[0] for row in conn.execute(
+            '''SELECT order_id FROM main.orders
+               WHERE order_date < datetime('now', ?) AND order_id IN (SELECT order_id FROM sales_rollup_orders)
+               ORDER BY order_id LIMIT ?''',
+            (f'-{older_than_days} days', batch_size)
+        )]
+        if not ids:
+            return moved
+        placeholders = ','.join('?' * len(ids))
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for table, columns in ARCHIVE_TABLES.items():
+                names = ', '.join(column.split()[0] for column in columns.split(', '))
+                conn.execute(f'INSERT OR REPLACE INTO archive.{table} ({names}) SELECT {names} FROM main.{table} WHERE order_id IN ({placeholders})', ids)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for table in ('order_items', 'payments', 'orders'):
+                conn.execute(f'DELETE FROM main.{table} WHERE order_id IN ({placeholders}) AND order_id IN (SELECT order_id FROM archive.orders)', ids)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        moved += len(ids)
+
+@bp.cli.command('archive-orders')
+@click.option('--older-than-days', type=int, help='defaults to ARCHIVE_AFTER_DAYS')
+@click.option('--batch-size', type=int, default=500, show_default=True, help='orders moved per transaction')
+def archive_orders_command(older_than_days, batch_size):
+    config = current_app.config
+    conn = sqlite3.connect(config['DATABASE'], timeout=config['DB_TIMEOUT'], isolation_level=None)
+    check_schema(conn)
+    conn.execute('ATTACH DATABASE ? AS archive', (config['ARCHIVE_DATABASE'],))
+    create_archive_schema(conn)
+    moved = archive_orders(conn, older_than_days if older_than_days is not None else config['ARCHIVE_AFTER_DAYS'], batch_size)
+    conn.close()
+    click.echo(f'{moved} order(s) archived')
+
+# Frequently bought together. co_purchases counts, for every pair of items, the orders
+# containing both (stored in both directions); co_purchase_top keeps the top
+# CO_PURCHASE_TOP_K of each item in rank order, which is all the pages read.
+CO_PURCHASE_TOP_K = 10
+CO_PURCHASE_SHOWN = 4
+# pairs grow with the square of an order's size, bulk orders only count their first items
+CO_PURCHASE_MAX_ORDER_ITEMS = 50
+
+def order_item_pairs(item_ids):
+    #unordered pairs of the distinct items in one order
+    items = sorted(set(item_ids))[:CO_PURCHASE_MAX_ORDER_ITEMS]
+    return [(a, b) for n, a in enumerate(items) for b in items[n + 1:]]
+
+def add_co_purchase_counts(cur, table, counts):
+    #counts maps (a, b) with a < b to the number of orders, added in both directions
+    cur.executemany(
+        f'''INSERT INTO {table} (item_id, other_item_id, count) VALUES (?, ?, ?)
+            ON CONFLICT (item_id, other_item_id) DO UPDATE SET count = count + excluded.count''',
+        [row for (a, b), count in counts.items() for row in ((a, b, count), (b, a, count))]
+    )
+
+def refresh_co_purchase_top(cur, item_ids):
+    for item_id in item_ids:
+        cur.execute('DELETE FROM co_purchase_top WHERE item_id = ?', (item_id,))
+        cur.execute(
+            '''INSERT INTO co_purchase_top (item_id, rank, other_item_id, count)
+               SELECT item_id, ROW_NUMBER() OVER (ORDER BY count DESC, other_item_id), other_item_id, count
+               FROM co_purchases WHERE item_id = ? ORDER BY count DESC, other_item_id LIMIT ?''',
+            (item_id, CO_PURCHASE_TOP_K)
+        )
+
+@job_handler('order_placed')
+def apply_order_to_co_purchases(cur, payload):
+    cur.execute('INSERT OR IGNORE INTO co_purchase_orders (order_id) VALUES (?)', (payload['order_id'],))
+    if cur.rowcount == 0:
+        return
+    cur.execute('SELECT item_id FROM order_items WHERE order_id = ?', (payload['order_id'],))
+    pairs = order_item_pairs([row[0] for row in cur.fetchall()])
+    if pairs:
+        add_co_purchase_counts(cur, 'co_purchases', dict.fromkeys(pairs, 1))
+        refresh_co_purchase_top(cur, sorted({item_id for pair in pairs for item_id in pair}))
+
+def build_co_purchases(conn, max_pairs):
+    #rebuilds the co-purchase tables from the whole order history, archive included.
+    #order_items are streamed in order id order and pairs counted in a dict that is flushed
+    #to a temp table every max_pairs pairs, so memory stays bounded however long the history.
+    #Counting runs on one read snapshot without the write lock; orders placed meanwhile
+    #are applied during the final swap. Returns the number of pairs.
+    cur = conn.cursor()
+    cur.execute('PRAGMA database_list')
+    schemas = [row[1] for row in cur.fetchall() if row[1] in ('archive', 'main')]
+    cur.execute('''CREATE TEMP TABLE co_purchase_build (item_id INTEGER, other_item_id INTEGER, count INTEGER,
+                   PRIMARY KEY (item_id, other_item_id)) WITHOUT ROWID''')
+    
+    cur.execute('BEGIN')
+    try:
+        #the archive holds the oldest orders, and all of them once main.orders has been emptied
+        cur.execute('SELECT COALESCE(MAX(order_id), 0) FROM ('
+                    + ' UNION ALL '.join(f'SELECT MAX(order_id) AS order_id FROM {schema}.orders' for schema in schemas) + ')')
+        built_through = cur.fetchone()[0]
+        counts = {}
+        for schema in schemas:
+            #an order being archived right now is in both databases, count it once
+            lines = conn.execute(
+                f'''SELECT order_id, item_id FROM {schema}.order_items WHERE order_id <= ?
+                    {'AND order_id NOT IN (SELECT order_id FROM main.orders)' if schema == 'archive' else ''}
+                    ORDER BY order_id''',
+                (built_through,)
+            )
+            for _, order_lines in itertools.groupby(lines, key=lambda line: line[0]):
+                for pair in order_item_pairs([item_id for _, item_id in order_lines]):
+                    counts[pair] = counts.get(pair, 0) + 1
+                if len(counts) >= max_pairs:
+                    add_co_purchase_counts(cur, 'temp.co_purchase_build', counts)
+                    counts.clear()
+        add_co_purchase_counts(cur, 'temp.co_purchase_build', counts)
+        cur.execute('COMMIT')
+    except Exception:
+        cur.execute('ROLLBACK')
+        raise
+    
+    cur.execute('BEGIN IMMEDIATE')
+    try:
+        for table in ('co_purchases', 'co_purchase_top', 'co_purchase_orders'):
+            cur.execute(f'DELETE FROM main.{table}')
+        cur.execute('INSERT INTO main.co_purchases SELECT * FROM temp.co_purchase_build')
+        cur.execute(
+            '''INSERT INTO main.co_purchase_top
+               SELECT item_id, rank, other_item_id, count FROM (
+                   SELECT *, ROW_NUMBER() OVER (PARTITION BY item_id ORDER BY count DESC, other_item_id) AS rank
+                   FROM main.co_purchases
+               ) WHERE rank <= ?''',
+            (CO_PURCHASE_TOP_K,)
+        )
+        for schema in schemas:
+            cur.execute(f'INSERT OR IGNORE INTO main.co_purchase_orders SELECT order_id FROM {schema}.orders WHERE order_id <= ?', (built_through,))
+        cur.execute('SELECT order_id FROM main.orders WHERE order_id > ?', (built_through,))
+        for (late_order_id,) in cur.fetchall():
+            apply_order_to_co_purchases(cur, {'order_id': late_order_id})
+        cur.execute('SELECT COUNT(*) FROM main.co_purchases')
+        pairs = cur.fetchone()[0]
+        cur.execute('COMMIT')
+    except Exception:
+        cur.execute('ROLLBACK')
+        raise
+    cur.execute('DROP TABLE temp.co_purchase_build')
+    return pairs
+
+@bp.cli.command('rebuild-co-purchases')
+@click.option('--max-pairs', type=int, default=1000000, show_default=True, help='pairs counted in memory before flushing to disk')
+def rebuild_co_purchases_command(max_pairs):
+    config = current_app.config
+    conn = sqlite3.connect(config['DATABASE'], timeout=config['DB_TIMEOUT'], isolation_level=None)
+    check_schema(conn)
+    if os.path.exists(config['ARCHIVE_DATABASE']):
+        conn.execute('ATTACH DATABASE ? AS archive', (config['ARCHIVE_DATABASE'],))
+    pairs = build_co_purchases(conn, max_pairs)
+    conn.close()
+    click.echo(f'co-purchases rebuilt, {pairs // 2} item pair(s)')
+
+def load_co_purchased(cur, item_ids, limit=CO_PURCHASE_SHOWN):
+    #in-stock items most often bought with any of item_ids, from their co_purchase_top rows
+    placeholders = ','.join('?' * len(item_ids))
+    cur.execute(
+        f'''SELECT i.* FROM co_purchase_top t JOIN items i ON i.item_id = t.other_item_id
+            WHERE t.item_id IN ({placeholders}) AND t.other_item_id NOT IN ({placeholders}) AND i.quantity > 0
+            GROUP BY t.other_item_id ORDER BY SUM(t.count) DESC, t.other_item_id LIMIT ?''',
+        list(item_ids) + list(item_ids) + [limit]
+    )
+    return cur.fetchall()
+
+def co_purchased_html(items):
+    if not items:
+        return ''
+    cards_html = ''
+    for item in items:
+        cards_html += f'''
+            <div class="product-card" onclick="window.location.href='/item/{item['item_id']}'">
+                <img src="/product_images/{item['image_filename']}" alt="{item['name']}" class="product-image" onerror="this.src='/product_images/temp.jpg'">
+                <div class="product-info">
+                    <div class="product-name">{item['name']}</div>
+                    <div class="product-price">{Money(item['price_cents'])}</div>
+                </div>
+            </div>
+        '''
+    return f'''
+        <h3 style="margin: 2rem 0 1rem 0;">Frequently bought together</h3>
+        <div class="grid grid-4">{cards_html}</div>
+    '''
+
+# Database maintenance, run by `flask maintenance` as its own process next to the
+# web and job workers. Every task has an interval; the ones that rewrite pages or
+# wait on readers only run in a quiet window, when no other connection has
+# committed for MAINTENANCE_QUIET_SECONDS.
+class BackupRestarted(Exception):
+    pass
+
+def online_backup(database, path, pages, pause, max_restarts=3):
+    #copies the live database to path a few pages at a time, pausing in between. A commit by
+    #another connection makes sqlite start the copy over, after max_restarts it is finished
+    #in one step instead; in WAL mode that only holds a read snapshot, writers carry on
+    src = sqlite3.connect(f'file:{quote(database)}?mode=ro', uri=True)
+    tmp_path = path + '.tmp'
+    dst = sqlite3.connect(tmp_path)
+    restarts = 0
+    previous = None
+    
+    def progress(status, remaining, total):
+        nonlocal restarts, previous
+        if previous is not None and remaining > previous:
+            restarts += 1
+            if restarts > max_restarts:
+                raise BackupRestarted()
+        previous = remaining
+    
+    try:
+        try:
+            src.backup(dst, pages=pages, progress=progress, sleep=pause)
+        except BackupRestarted:
+            src.backup(dst)
+        dst.execute('PRAGMA journal_mode = DELETE')
+    finally:
+        dst.close()
+        src.close()
+    os.replace(tmp_path, path)
+    return restarts
+
+class Maintenance:
+    def __init__(self, config):
+        self.config = config
+        #a short busy timeout, maintenance gives way to the app rather than waiting on it
+        self.conn = sqlite3.connect(config['DATABASE'], timeout=1, isolation_level=None)
+        self.data_version = None
+        self.last_write = time.monotonic()
+        self.last_run = {}
+        self.tasks = [
+            ('checkpoint', 60, False),
+            ('optimize', 3600, False),
+            ('prune', 3600, False),
+            ('analyze', 86400, True),
+            ('vacuum', 600, True),
+            ('backup', config['BACKUP_INTERVAL_HOURS'] * 3600, False),
+        ]
+
+    def quiet(self):
+        #data_version changes whenever another connection commits
+        version = self.conn.execute('PRAGMA data_version').fetchone()[0]
+        now = time.monotonic()
+        if version != self.data_version:
+            self.data_version, self.last_write = version, now
+        return now - self.last_write >= self.config['MAINTENANCE_QUIET_SECONDS']
+
+    def tick(self, force=False):
+        #runs the tasks that are due, force runs all of them now; returns the names of those that failed
+        try:
+            quiet = self.quiet()
+        except sqlite3.OperationalError:
+            quiet = False
+        failed = []
+        for name, interval, needs_quiet in self.tasks:
+            if not force and (time.monotonic() - self.last_run.get(name, float('-inf')) < interval or needs_quiet and not quiet):
+                continue
+            try:
+                result = getattr(self, name)(quiet or force)
+                click.echo(f'{datetime.now():%Y-%m-%d %H:%M:%S} {name}: {result}')
+            except sqlite3.OperationalError as e:
+                #busy, try again next tick
+                click.echo(f'{datetime.now():%Y-%m-%d %H:%M:%S} {name} failed: {e}')
+                failed.append(name)
+                continue
+            except Exception:
+                #a full disk or a missing backup directory must not stop the other tasks or the loop,
+                #the task is tried again at its next interval
+                current_app.logger.exception('maintenance task %s failed', name)
+                failed.append(name)
+            self.last_run[name] = time.monotonic()
+        return failed
+
+    def checkpoint(self, quiet):
+        #PASSIVE never waits; TRUNCATE resets a large WAL, but has to wait for readers, so only when quiet
+        wal_path = self.config['DATABASE'] + '-wal'
+        wal_size = os.path.getsize(wal_path) if os.path.exists(wal_path) else 0
+        mode = 'TRUNCATE' if quiet and wal_size > self.config['WAL_TRUNCATE_BYTES'] else 'PASSIVE'
+        busy, log_pages, checkpointed = self.conn.execute(f'PRAGMA wal_checkpoint({mode})').fetchone()
+        return f'{mode.lower()}, {checkpointed}/{log_pages} WAL pages written back{" (busy)" if busy else ""}'
+
+    def optimize(self, quiet):
+        #only analyzes tables whose statistics look stale, analysis_limit keeps each one cheap
+        self.conn.execute('PRAGMA analysis_limit = 1000')
+        self.conn.execute('PRAGMA optimize')
+        return 'done'
+
+    def analyze(self, quiet):
+        self.conn.execute('PRAGMA analysis_limit = 1000')
+        self.conn.execute('ANALYZE')
+        return 'done'
+
+    def vacuum(self, quiet):
+        #hands free pages back to the filesystem a batch per transaction, stopping when writes resume
+        if self.conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            return 'skipped, run `flask maintenance --enable-incremental-vacuum` once'
+        freed = 0
+        version = self.conn.execute('PRAGMA data_version').fetchone()[0]
+        while self.conn.execute('PRAGMA freelist_count').fetchone()[0] > 0:
+            before = self.conn.execute('PRAGMA page_count').fetchone()[0]
+            #the pragma frees a page per step, fetchall runs it to the end
+            self.conn.execute(f"PRAGMA incremental_vacuum({self.config['VACUUM_PAGES_PER_STEP']})").fetchall()
+            freed += before - self.conn.execute('PRAGMA page_count').fetchone()[0]
+            if self.conn.execute('PRAGMA data_version').fetchone()[0] != version:
+                break
+        return f'{freed} page(s) freed'
+
+    def prune(self, quiet):
+        #bookkeeping rows nothing reads any more, deleted in batches to keep each transaction short
+        config = self.config
+        statements = [
+            ('idempotency_keys', "DELETE FROM idempotency_keys WHERE idem_key IN (SELECT idem_key FROM idempotency_keys WHERE created_at < datetime('now', ?) LIMIT 1000)",
+             (f"-{config['IDEMPOTENCY_KEY_HOURS']} hours",)),
+            ('jobs', "DELETE FROM jobs WHERE job_id IN (SELECT job_id FROM jobs WHERE status = 'done' AND run_after < ? LIMIT 1000)",
+             (time.time() - config['JOB_RETENTION_DAYS'] * 86400,)),
+            #the suggestion index rebuilds itself when it finds its position pruned away
+            ('item_changes', 'DELETE FROM item_changes WHERE change_id IN (SELECT change_id FROM item_changes WHERE change_id <= (SELECT MAX(change_id) FROM item_changes) - ? LIMIT 1000)',
+             (config['ITEM_CHANGES_KEEP'],)),
+        ]
+        pruned = {}
+        for table, statement, params in statements:
+            pruned[table] = 0
+            while True:
+                count = self.conn.execute(statement, params).rowcount
+                pruned[table] += count
+                if count < 1000:
+                    break
+        return ', '.join(f'{count} {table}' for table, count in pruned.items())
+
+    def backup(self, quiet):
+        config = self.config
+        os.makedirs(config['BACKUP_DIR'], exist_ok=True)
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        results = []
+        for name, database in (('bazaro', config['DATABASE']), ('archive', config['ARCHIVE_DATABASE'])):
+            if not os.path.exists(database):
+                continue
+            path = os.path.join(config['BACKUP_DIR'], f'{name}-{stamp}.db')
+            restarts = online_backup(database, path, config['BACKUP_PAGES_PER_STEP'], config['BACKUP_STEP_PAUSE'])
+            results.append(f'{os.path.basename(path)} ({os.path.getsize(path)} bytes, {restarts} restart(s))')
+            #keep the newest BACKUP_KEEP of each database
+            old = sorted(f for f in os.listdir(config['BACKUP_DIR']) if f.startswith(f'{name}-') and f.endswith('.db'))
+            for filename in old[:-config['BACKUP_KEEP']]:
+                os.remove(os.path.join(config['BACKUP_DIR'], filename))
+        return ', '.join(results)
+
+@bp.cli.command('maintenance')
+@click.option('--once', is_flag=True, help='run every task once and exit, for cron')
+@click.option('--enable-incremental-vacuum', is_flag=True, help='switch the database to incremental vacuum; runs a full VACUUM, which blocks writes while it runs')
+def maintenance_command(once, enable_incremental_vacuum):
+    config = current_app.config
+    maintenance = Maintenance(config)
+    check_schema(maintenance.conn)
+    if enable_incremental_vacuum:
+        maintenance.conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        maintenance.conn.execute('VACUUM')
+        click.echo('incremental vacuum enabled')
+        return
+    if once:
+        #a non-zero exit lets cron report the failure
+        if maintenance.tick(force=True):
+            sys.exit(1)
+        return
+    try:
+        while True:
+            maintenance.tick()
+            time.sleep(config['MAINTENANCE_TICK_SECONDS'])
+    except KeyboardInterrupt:
+        pass
+
+# JSON API for the mobile app and partner integrations. It shares the query and
+# checkout code with the HTML routes, money is sent as integer cents.
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+def api_json(data, status=200):
+    return Response(json.dumps(data, separators=(',', ':'), ensure_ascii=False), status, mimetype='application/json')
+
+def api_error(message, status):
+    return api_json({'error': message}, status)
+
+def item_json(item):
+    return {
+        'id': item['item_id'],
+        'name': item['name'],
+        'price_cents': item['price_cents'],
+        'quantity': item['quantity'],
+        'category_id': item['category_id'],
+        'image_url': url_for('bazaro.product_image', filename=item['image_filename']) if item['image_filename'] else None,
+    }
+
+def api_user():
+    #the logged in user, the API uses the same session cookie as the site
+    user = get_current_user()
+    if not user:
+        abort(api_error('login required', 401))
+    return user
+
+def api_cart_json(cart):
+    conn = get_read_connection()
+    cur = conn.cursor()
+    cart_items, total = load_cart_items(cur, cart)
+    cur.close()
+    conn.close()
+    return {
+        'items': [dict(item_json(item), cart_quantity=quantity) for item, quantity in cart_items if item],
+        'total_cents': total.cents,
+    }
+
+@api.route('/session', methods=['POST'])
+def api_login():
+    data = request.get_json(silent=True) or {}
+    try:
+        user = authenticate(data.get('email'), data.get('password'))
+    except LoginThrottled as e:
+        response = api_error('too many login attempts', 429)
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response
+    if not user:
+        return api_error('invalid email or password', 401)
+    session['user_id'] = user['user_id']
+    session['cart'] = []
+    return api_json({'user_id': user['user_id'], 'name': user['name']})
+
+@api.route('/session', methods=['DELETE'])
+def api_logout():
+    session.clear()
+    return '', 204
+
+@api.route('/products')
+def api_products():
+    filters = catalog_filters(request.args)
+    limit = min(max(request.args.get('limit', PRODUCTS_PAGE_SIZE, type=int), 1), 100)
+    conn = get_read_connection(snapshot_ok=True)
+    cur = conn.cursor()
+    items, next_cursor = query_catalog_page(cur, filters, request.args.get('after'), limit)
+    cur.close()
+    conn.close()
+    return api_json({'items': [item_json(item) for item in items], 'next_cursor': next_cursor})
+
+@api.route('/items/<int:item_id>')
+def api_item(item_id):
+    conn = get_read_connection(snapshot_ok=True)
+    cur = conn.cursor()
+    detail = load_item_detail(cur, item_id)
+    cur.close()
+    conn.close()
+    if not detail:
+        return api_error('item not found', 404)
+    item, category, seller, is_user = detail
+    return api_json(dict(
+        item_json(item),
+        description=item['description'],
+        category=category['name'] if category else None,
+        seller={'type': 'user' if is_user else 'seller', 'id': seller[0], 'name': seller['name' if is_user else 'seller_name']} if seller else None,
+    ))
+
+@api.route('/cart')
+def api_cart():
+    api_user()
+    return api_json(api_cart_json(session.get('cart', [])))
+
+@api.route('/cart/items', methods=['POST'])
+def api_add_to_cart():
+    api_user()
+    data = request.get_json(silent=True) or {}
+    item_id, quantity = data.get('item_id'), data.get('quantity', 1)
+    if type(item_id) is not int or type(quantity) is not int or quantity < 0:
+        return api_error('item_id and a non-negative quantity are required', 400)
+    
+    conn = get_read_connection()
+    cur = conn.cursor()
+    cur.execute('SELECT quantity FROM items WHERE item_id = ?', (item_id,))
+    row = cur.fetchone()
+    cur.close()
+    conn.close()
+    if not row:
+        return api_error('item not found', 404)
+    if quantity > row[0]:
+        metrics.inc('bazaro_stock_failures_total')
+        return api_error('not enough stock', 409)
+    
+    #sets the quantity rather than adding to it, so retrying the request is harmless
+    cart = [c for c in session.get('cart', []) if c['item_id'] != item_id]
+    if quantity:
+        cart.append({'item_id': item_id, 'quantity': quantity})
+    session['cart'] = cart
+    return api_json(api_cart_json(cart))
+
+@api.route('/cart/items/<int:item_id>', methods=['DELETE'])
+def api_remove_from_cart(item_id):
+    api_user()
+    cart = [c for c in session.get('cart', []) if c['item_id'] != item_id]
+    session['cart'] = cart
+    return api_json(api_cart_json(cart))
+
+@api.route('/checkout', methods=['POST'])
+def api_checkout():
+    user = api_user()
+    outcome, order_id, _ = place_order(user, session.get('cart', []))
+    if outcome in ('ok', 'replay'):
+        session['cart'] = []
+    if outcome == 'ok':
+        return api_json({'order_id': order_id}, 201)
+    if outcome == 'replay':
+        return api_json({'order_id': order_id})
+    if outcome == 'empty':
+        return api_error('cart is empty', 400)
+    if outcome == 'stock':
+        return api_error('not enough stock', 409)
+    return api_error('insufficient wallet balance', 402)
+
+@api.route('/orders')
+def api_orders():
+    user = api_user()
+    conn = get_read_connection()
+    cur = conn.cursor()
+    user_orders, has_more = load_orders(cur, user['user_id'], request.args.get('before', type=int))
+    cur.close()
+    conn.close()
+    orders = [{
+        'id': entry['order']['order_id'],
+        'date': str(entry['order']['order_date']),
+        'total_cents': entry['order']['total_price_cents'],
+        'payment_status': entry['payment_status'],
+        'items': [{'item_id': i['item_id'], 'name': i['name'], 'quantity': i['quantity'], 'price_cents': i['price_cents']} for i in entry['items']],
+    } for entry in user_orders]
+    return api_json({'orders': orders, 'next_before': orders[-1]['id'] if has_more else None})
+
+@api.after_request
+def api_cache_headers(response):
+    #compresses here rather than in compress_dynamic_response, the ETag needs to know the encoding
+    #responses depend on the session, so caches may keep them but must check the ETag every time
+    response.headers['Cache-Control'] = 'private, no-cache'
+    etag = None
+    if request.method == 'GET' and response.status_code == 200:
+        etag = hashlib.blake2b(response.get_data(), digest_size=16).hexdigest()
+        #the compressed variant carries a suffix, either form matches the same body
+        if any(tag.split('-')[0] == etag for tag in request.if_none_match.as_set()):
+            response = Response(status=304)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            response.set_etag(etag)
+            return response
+    config = current_app.config
+    encoding = compress_response(response, config['COMPRESS_MIN_SIZE'], config['COMPRESS_LEVEL'], config['BROTLI_QUALITY'])
+    if etag:
+        response.set_etag(f'{etag}-{encoding}' if encoding else etag)
+    return response
+
+def create_app(config=None):
+    #static files are served by static_file, which knows about the compressed sidecars
+    app = Flask(__name__, static_folder=None)
+    app.config.update(default_config())
+    if config:
+        app.config.update(config)
+    if not app.config['SECRET_KEY']:
+        app.config['SECRET_KEY'] = load_secret_key(app)
+    if app.config['PROXY_COUNT']:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_COUNT'], x_proto=app.config['PROXY_COUNT'])
+    
+    app.register_blueprint(bp)
+    app.register_blueprint(api)
+    return app
+
 if __name__ == '__main__':
-    init_database()
+    app = create_app()
+    migrate(app)
     print("\n" + "="*60)
     print("🛒  Starting Bazaro Marketplace with SQLite...")
     print("="*60)
@@ -0,0 +1,49 @@
+# Measures how long a fresh worker process takes from interpreter start to its
+# first served response: import, create_app() and the first request (which opens
+# the first pooled connection and checks the schema version).
+#
+#   python bench_startup.py [runs] [path]
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+CHILD = r'''
+import json, sys, time
+t0 = time.perf_counter()
+import app as bazaro
+t1 = time.perf_counter()
+application = bazaro.create_app()
+t2 = time.perf_counter()
+response = application.test_client().get(sys.argv[1])
+t3 = time.perf_counter()
+assert response.status_code == 200, response.status_code
+print(json.dumps({'import': t1 - t0, 'create_app': t2 - t1, 'first_request': t3 - t2, 'total': t3 - t0}))
+'''
+
+
+def run_once(path):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.path.dirname(os.path.abspath(__file__))
+    env.setdefault('BAZARO_SECRET_KEY', 'bench')
+    out = subprocess.run([sys.executable, '-c', CHILD, path], env=env, capture_output=True, text=True)
+    if out.returncode:
+        # the child's traceback says why, e.g. an unmigrated database (run `flask --app app migrate`)
+        sys.stderr.write(out.stderr)
+        sys.exit(f'benchmark process failed with exit code {out.returncode}')
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    path = sys.argv[2] if len(sys.argv) > 2 else '/products'
+    results = [run_once(path) for _ in range(runs)]
+    print(f'{runs} cold starts, first request {path}')
+    for key in ('import', 'create_app', 'first_request', 'total'):
+        values = [r[key] * 1000 for r in results]
+        print(f'  {key:<14} median {statistics.median(values):7.1f} ms   min {min(values):7.1f} ms   max {max(values):7.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,26 @@
+# gunicorn settings for Bazaro, every value can be overridden from the environment
+import multiprocessing
+import os
+
+bind = os.environ.get('BAZARO_BIND', '0.0.0.0:5000')
+
+# SQLite allows one writer at a time, so more processes mostly add lock
+# contention. A few processes with a handful of threads each keep the CPUs busy
+# while other threads wait on sqlite or the network (sqlite releases the GIL).
+workers = int(os.environ.get('BAZARO_WORKERS', min(multiprocessing.cpu_count(), 4)))
+worker_class = 'gthread'
+threads = int(os.environ.get('BAZARO_THREADS', 8))
+timeout = int(os.environ.get('BAZARO_TIMEOUT', 30))
+keepalive = 5
+
+# load the app in the master so workers fork with the code already imported,
+# database connections are opened per worker after the fork
+preload_app = True
+max_requests = 10000
+max_requests_jitter = 1000
+
+
+def on_starting(server):
+    # runs once in the master, before any worker is forked
+    from app import create_app, migrate
+    migrate(create_app())
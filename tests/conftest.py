@@ -0,0 +1,42 @@
+import os
+import shutil
+import sqlite3
+
+import pytest
+
+import app as bazaro
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def create_test_app(tmp_path, **config):
+    #a migrated copy of the demo database, so tests never touch bazaro.db itself
+    database = tmp_path / 'bazaro.db'
+    shutil.copy(os.path.join(ROOT, 'bazaro.db'), database)
+    application = bazaro.create_app(dict({
+        'DATABASE': str(database),
+        'UPLOAD_FOLDER': str(tmp_path / 'product_images'),
+        'ARCHIVE_DATABASE': str(tmp_path / 'bazaro.archive.db'),
+        'SECRET_KEY': 'test',
+        'TESTING': True,
+    }, **config))
+    bazaro.migrate(application)
+    return application
+
+
+@pytest.fixture
+def app(tmp_path):
+    return create_test_app(tmp_path)
+
+
+@pytest.fixture
+def db(app):
+    conn = sqlite3.connect(app.config['DATABASE'])
+    yield conn
+    conn.close()
+
+
+def login(client, email, password):
+    response = client.post('/login', data={'email': email, 'password': password})
+    assert response.headers['Location'] == '/products'
+    return client
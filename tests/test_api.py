@@ -0,0 +1,68 @@
+import gzip
+import json
+
+import pytest
+
+
+@pytest.fixture
+def client(app, db):
+    db.execute('UPDATE users SET wallet_balance_cents = 10000000 WHERE user_id = 2')
+    db.commit()
+    client = app.test_client()
+    response = client.post('/api/v1/session', json={'email': 'bibi@bibi', 'password': 'bibi'})
+    assert response.status_code == 200
+    assert response.get_json()['user_id'] == 2
+    return client
+
+
+def test_login_required(app):
+    response = app.test_client().get('/api/v1/cart')
+    assert response.status_code == 401
+    assert response.get_json() == {'error': 'login required'}
+
+
+def test_checkout(client, db):
+    stock = db.execute('SELECT quantity, price_cents FROM items WHERE item_id = 3').fetchone()
+    cart = client.post('/api/v1/cart/items', json={'item_id': 3, 'quantity': 2}).get_json()
+    assert cart['total_cents'] == 2 * stock[1]
+
+    response = client.post('/api/v1/checkout')
+    assert response.status_code == 201
+    order_id = response.get_json()['order_id']
+    assert client.get('/api/v1/cart').get_json() == {'items': [], 'total_cents': 0}
+    assert db.execute('SELECT quantity FROM items WHERE item_id = 3').fetchone()[0] == stock[0] - 2
+
+    orders = client.get('/api/v1/orders').get_json()['orders']
+    assert orders[0]['id'] == order_id
+    assert orders[0]['total_cents'] == 2 * stock[1]
+    assert [(i['item_id'], i['quantity']) for i in orders[0]['items']] == [(3, 2)]
+
+
+def test_checkout_errors(client, db):
+    assert client.post('/api/v1/checkout').status_code == 400
+    assert client.post('/api/v1/cart/items', json={'item_id': 3, 'quantity': 10 ** 6}).status_code == 409
+    client.post('/api/v1/cart/items', json={'item_id': 3, 'quantity': 1})
+    db.execute('UPDATE users SET wallet_balance_cents = 0 WHERE user_id = 2')
+    db.commit()
+    assert client.post('/api/v1/checkout').status_code == 402
+
+
+def test_etag(client, db):
+    response = client.get('/api/v1/products')
+    assert response.status_code == 200
+    assert response.headers['Cache-Control'] == 'private, no-cache'
+    etag = response.headers['ETag']
+    assert client.get('/api/v1/products', headers={'If-None-Match': etag}).status_code == 304
+
+    #the compressed variant is tagged by encoding and still matches the same body
+    compressed = client.get('/api/v1/products', headers={'Accept-Encoding': 'gzip'})
+    assert compressed.headers['Content-Encoding'] == 'gzip'
+    assert compressed.headers['ETag'] == etag[:-1] + '-gzip"'
+    assert json.loads(gzip.decompress(compressed.data)) == response.get_json()
+    assert client.get('/api/v1/products', headers={'If-None-Match': compressed.headers['ETag']}).status_code == 304
+
+    db.execute('UPDATE items SET name = name || ? WHERE item_id = ?', ('!', response.get_json()['items'][0]['id']))
+    db.commit()
+    changed = client.get('/api/v1/products', headers={'If-None-Match': etag})
+    assert changed.status_code == 200
+    assert changed.headers['ETag'] != etag
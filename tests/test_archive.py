@@ -0,0 +1,54 @@
+import re
+import sqlite3
+
+from app import archive_orders_command, rebuild_co_purchases_command, rebuild_sales_rollups_command
+from conftest import login
+
+
+def archive_all(app):
+    #every order counted by the rollups, then moved to the archive
+    runner = app.test_cli_runner()
+    assert runner.invoke(rebuild_sales_rollups_command).exit_code == 0
+    result = runner.invoke(archive_orders_command, ['--older-than-days', '0'])
+    assert result.exit_code == 0, result.output
+    archive = sqlite3.connect(app.config['ARCHIVE_DATABASE'])
+    assert archive.execute('SELECT COUNT(*) FROM orders').fetchone()[0] > 0
+    archive.close()
+
+
+def profile_totals(client):
+    html = client.get('/profile').get_data(as_text=True)
+    count = re.search(r'Total Orders:</span>\s*<span[^>]*>(\d+)<', html).group(1)
+    spent = re.search(r'Total Spent</p>\s*<p[^>]*>([^<]+)<', html).group(1)
+    return count, spent
+
+
+def order_ids(client):
+    return re.findall(r'Order #(\d+)', client.get('/orders').get_data(as_text=True))
+
+
+def test_profile_and_orders_after_archiving(app, db):
+    client = login(app.test_client(), 'bibi@bibi', 'bibi')
+    totals, orders = profile_totals(client), order_ids(client)
+    assert totals[0] != '0'
+
+    archive_all(app)
+    assert db.execute('SELECT COUNT(*) FROM orders').fetchone()[0] == 0
+    assert profile_totals(client) == totals
+    assert order_ids(client) == orders
+
+
+def test_rebuild_co_purchases_after_archiving(app, db):
+    runner = app.test_cli_runner()
+    assert runner.invoke(rebuild_co_purchases_command).exit_code == 0
+    pairs = db.execute('SELECT * FROM co_purchases ORDER BY item_id, other_item_id').fetchall()
+    top = db.execute('SELECT * FROM co_purchase_top ORDER BY item_id, rank').fetchall()
+    assert pairs
+
+    archive_all(app)
+    result = runner.invoke(rebuild_co_purchases_command)
+    assert result.exit_code == 0, result.output
+    assert f'{len(pairs) // 2} item pair(s)' in result.output
+    assert db.execute('SELECT * FROM co_purchases ORDER BY item_id, other_item_id').fetchall() == pairs
+    assert db.execute('SELECT * FROM co_purchase_top ORDER BY item_id, rank').fetchall() == top
+    assert 'Frequently bought together' in app.test_client().get(f'/item/{top[0][0]}').get_data(as_text=True)
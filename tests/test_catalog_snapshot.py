@@ -0,0 +1,75 @@
+import itertools
+import random
+
+import pytest
+
+from app import SORT_MODES, Money, get_read_connection, query_catalog_page
+
+
+@pytest.fixture
+def catalog(app, db):
+    #a few hundred items with repeated prices and sales counts, so pages break inside ties
+    rng = random.Random(1)
+    categories = [row[0] for row in db.execute('SELECT category_id FROM categories')]
+    sellers = [row[0] for row in db.execute('SELECT seller_id FROM sellers')]
+    for n in range(400):
+        seller_id = rng.choice(sellers + [None])
+        db.execute(
+            'INSERT INTO items (name, description, price_cents, quantity, category_id, seller_id, owner_user_id, sales_count) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (f'item {n}', '', rng.randint(1, 50) * 1000, rng.randint(0, 3), rng.choice(categories), seller_id,
+             None if seller_id else rng.randint(1, 3), rng.randint(0, 5)))
+    db.commit()
+    return rng, categories, sellers
+
+
+def walk(app, filters, snapshot):
+    app.config['CATALOG_SNAPSHOT'] = snapshot
+    pages = []
+    after = None
+    with app.test_request_context():
+        conn = get_read_connection()
+        cur = conn.cursor()
+        while True:
+            items, after = query_catalog_page(cur, filters, after, 7)
+            pages.append([item['item_id'] for item in items])
+            if not after:
+                break
+        cur.close()
+        conn.close()
+    return pages
+
+
+def assert_same_pages(app, categories, sellers):
+    for sort, category, availability, seller, prices in itertools.product(
+            SORT_MODES, [None, categories[0]], ['', 'in', 'out'], ['', f's:{sellers[0]}', 'u:2'],
+            [(None, None), (Money(10000), Money(30000))]):
+        filters = dict(search='', category=category, min_price=prices[0], max_price=prices[1],
+                       availability=availability, seller=seller, sort=sort)
+        assert walk(app, filters, True) == walk(app, filters, False), filters
+
+
+def test_snapshot_pages_match_sql(app, catalog):
+    _, categories, sellers = catalog
+    assert_same_pages(app, categories, sellers)
+
+
+def test_snapshot_follows_writes(app, db, catalog):
+    rng, categories, sellers = catalog
+    #build the snapshot, then change the catalog under it
+    walk(app, dict(search='', category=None, min_price=None, max_price=None, availability='', seller='', sort=''), True)
+    for item_id, in db.execute('SELECT item_id FROM items ORDER BY item_id DESC LIMIT 60').fetchall():
+        db.execute('UPDATE items SET price_cents = ?, quantity = ?, sales_count = sales_count + 1 WHERE item_id = ?',
+                   (rng.randint(1, 50) * 1000, rng.randint(0, 2), item_id))
+    db.execute('DELETE FROM items WHERE item_id IN (SELECT item_id FROM items ORDER BY item_id DESC LIMIT 20 OFFSET 100)')
+    for n in range(10):
+        db.execute('INSERT INTO items (name, price_cents, quantity, category_id, seller_id) VALUES (?, ?, ?, ?, ?)',
+                   (f'new {n}', 5000, 1, categories[0], sellers[0]))
+    db.commit()
+    assert_same_pages(app, categories, sellers)
+
+
+def test_search_ignores_snapshot(app, catalog):
+    filters = dict(search='item 1', category=None, min_price=None, max_price=None, availability='', seller='', sort='price_asc')
+    pages = walk(app, filters, True)
+    assert pages == walk(app, filters, False) and sum(map(len, pages)) > 0
@@ -0,0 +1,22 @@
+from app import rebuild_facet_counts
+
+
+def facet_counts(db):
+    return sorted(db.execute('SELECT facet, value, count FROM facet_counts WHERE count != 0').fetchall())
+
+
+def test_items_without_category_or_owner(app, db):
+    db.execute("INSERT INTO items (name, price_cents, quantity) VALUES ('Loose', 100, 1)")
+    item_id = db.execute('SELECT MAX(item_id) FROM items').fetchone()[0]
+    db.execute('UPDATE items SET category_id = 1, owner_user_id = 2 WHERE item_id = ?', (item_id,))
+    db.execute('UPDATE items SET category_id = NULL WHERE item_id = ?', (item_id,))
+    db.commit()
+    counted = facet_counts(db)
+    assert ('category', '', 1) in counted
+    rebuild_facet_counts(db.cursor())
+    assert facet_counts(db) == counted
+
+    db.execute('DELETE FROM items WHERE item_id = ?', (item_id,))
+    db.commit()
+    assert ('category', '', 1) not in facet_counts(db)
+    assert app.test_client().get('/products').status_code == 200
@@ -0,0 +1,75 @@
+from conftest import login
+
+
+def test_same_key_from_two_users(app, db):
+    #keys are scoped per user, the second user's deposit must not collide with the first
+    for email, password in [('bibi@bibi', 'bibi'), ('john@example.com', 'password123')]:
+        client = login(app.test_client(), email, password)
+        response = client.post('/add-funds', data={'amount': '10'}, headers={'Idempotency-Key': 'same-key'})
+        assert response.status_code == 302
+        assert response.headers['Location'] == '/wallet?success=1'
+    assert db.execute('SELECT COUNT(*) FROM idempotency_keys WHERE idem_key = ?', ('same-key',)).fetchone()[0] == 2
+
+
+def test_replayed_deposit_runs_once(app, db):
+    client = login(app.test_client(), 'bibi@bibi', 'bibi')
+    before = db.execute('SELECT wallet_balance_cents FROM users WHERE user_id = 2').fetchone()[0]
+    for _ in range(2):
+        client.post('/add-funds', data={'amount': '10'}, headers={'Idempotency-Key': 'deposit-1'})
+    assert db.execute('SELECT wallet_balance_cents FROM users WHERE user_id = 2').fetchone()[0] == before + 1000
+
+
+def test_replayed_checkout_clears_cart(app, db):
+    client = login(app.test_client(), 'bibi@bibi', 'bibi')
+    client.post('/add-funds', data={'amount': '1000'})
+    client.post('/add-to-cart/3')
+    with client.session_transaction() as session:
+        cart = list(session['cart'])
+    orders = db.execute('SELECT COUNT(*) FROM orders').fetchone()[0]
+
+    response = client.post('/checkout', headers={'Idempotency-Key': 'checkout-1'})
+    assert response.headers['Location'] == '/orders?success=1'
+
+    #the response was lost: the browser still has its old session with the full cart and retries
+    with client.session_transaction() as session:
+        session['cart'] = cart
+    response = client.post('/checkout', headers={'Idempotency-Key': 'checkout-1'})
+    assert response.headers['Location'] == '/orders?success=1'
+    with client.session_transaction() as session:
+        assert session['cart'] == []
+    assert db.execute('SELECT COUNT(*) FROM orders').fetchone()[0] == orders + 1
+
+
+def test_replayed_api_checkout_clears_cart(app, db):
+    client = login(app.test_client(), 'bibi@bibi', 'bibi')
+    client.post('/add-funds', data={'amount': '1000'})
+    client.post('/api/v1/cart/items', json={'item_id': 3, 'quantity': 1})
+    with client.session_transaction() as session:
+        cart = list(session['cart'])
+
+    first = client.post('/api/v1/checkout', headers={'Idempotency-Key': 'api-checkout-1'})
+    assert first.status_code == 201
+    with client.session_transaction() as session:
+        session['cart'] = cart
+    retry = client.post('/api/v1/checkout', headers={'Idempotency-Key': 'api-checkout-1'})
+    assert retry.status_code == 200
+    assert retry.get_json()['order_id'] == first.get_json()['order_id']
+    with client.session_transaction() as session:
+        assert session['cart'] == []
+
+
+def test_key_reused_on_another_endpoint(app, db):
+    client = login(app.test_client(), 'bibi@bibi', 'bibi')
+    client.post('/add-funds', data={'amount': '1000'}, headers={'Idempotency-Key': 'k1'})
+    client.post('/add-to-cart/3')
+    orders = db.execute('SELECT COUNT(*) FROM orders').fetchone()[0]
+
+    response = client.post('/api/v1/checkout', headers={'Idempotency-Key': 'k1'})
+    assert response.status_code == 422
+    assert 'error' in response.get_json()
+    with client.session_transaction() as session:
+        assert session['cart'] == [{'item_id': 3, 'quantity': 1}]
+    assert db.execute('SELECT COUNT(*) FROM orders').fetchone()[0] == orders
+
+    assert client.post('/checkout', headers={'Idempotency-Key': 'k1'}).status_code == 422
+    assert client.post('/checkout', headers={'Idempotency-Key': 'k2'}).headers['Location'] == '/orders?success=1'
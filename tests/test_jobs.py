@@ -0,0 +1,42 @@
+import sqlite3
+import threading
+import time
+
+from app import claim_job, job_worker, run_job
+
+
+def queue_job(db):
+    db.execute("INSERT INTO jobs (kind, payload, run_after) VALUES ('order_placed', ?, 0)",
+               ('{"order_id": 1, "buyer_id": 1}',))
+    db.commit()
+    return db.execute('SELECT MAX(job_id) FROM jobs').fetchone()[0]
+
+
+def test_worker_waits_out_a_locked_database(app, db):
+    app.config['DB_TIMEOUT'] = 0.1
+    job_id = queue_job(db)
+    db.execute('BEGIN IMMEDIATE')
+    worker = threading.Thread(target=job_worker, args=(app, threading.Event(), 0.1, True))
+    worker.start()
+    time.sleep(0.5)
+    assert worker.is_alive()
+    db.commit()
+    worker.join(10)
+    assert not worker.is_alive()
+    assert db.execute('SELECT status FROM jobs WHERE job_id = ?', (job_id,)).fetchone()[0] == 'done'
+
+
+def test_run_job_on_a_locked_database(app, db):
+    job_id = queue_job(db)
+    conn = sqlite3.connect(app.config['DATABASE'], timeout=0.1, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    job = claim_job(conn, 300, 5)
+    assert job['job_id'] == job_id
+    db.execute('BEGIN IMMEDIATE')
+    with app.app_context():
+        #neither the job nor its rescheduling can write, the lease brings it back later
+        assert run_job(conn, job, 5, 10) == 'running'
+    db.commit()
+    assert not conn.in_transaction
+    assert db.execute('SELECT status FROM jobs WHERE job_id = ?', (job_id,)).fetchone()[0] == 'running'
+    conn.close()
@@ -0,0 +1,64 @@
+from conftest import create_test_app, login
+
+
+def post_login(client, email, forwarded_for=None):
+    headers = {'X-Forwarded-For': forwarded_for} if forwarded_for else {}
+    return client.post('/login', data={'email': email, 'password': 'wrong'}, headers=headers)
+
+
+def test_login_ip_limit_per_forwarded_client(tmp_path):
+    app = create_test_app(tmp_path, PROXY_COUNT=1, LOGIN_EMAIL_BURST=100)
+    client = app.test_client()
+    codes = [post_login(client, f'user{n}@example.com', '203.0.113.1').status_code for n in range(11)]
+    assert codes[:10] == [302] * 10 and codes[10] == 429
+    #another client behind the same proxy has its own bucket
+    assert post_login(client, 'other@example.com', '203.0.113.2').status_code == 302
+
+
+def test_forwarded_header_ignored_without_proxy_count(app):
+    app.config['LOGIN_EMAIL_BURST'] = 100
+    client = app.test_client()
+    codes = [post_login(client, f'user{n}@example.com', f'203.0.113.{n}').status_code for n in range(11)]
+    assert codes[10] == 429
+
+
+def test_register_has_its_own_budget(app):
+    client = app.test_client()
+    for n in range(10):
+        post_login(client, f'user{n}@example.com')
+    assert post_login(client, 'one-more@example.com').status_code == 429
+    response = client.post('/register', data={'name': 'New', 'email': 'new@example.com', 'password': 'pw'})
+    assert response.headers['Location'] == '/products'
+
+
+def stored_password(db, user_id):
+    return db.execute('SELECT password FROM users WHERE user_id = ?', (user_id,)).fetchone()[0]
+
+
+def test_plaintext_password_is_hashed_on_login(app, db):
+    assert stored_password(db, 2) == 'bibi'
+    assert app.test_client().post('/login', data={'email': 'bibi@bibi', 'password': 'wrong'}).headers['Location'] != '/products'
+    assert stored_password(db, 2) == 'bibi'
+    login(app.test_client(), 'bibi@bibi', 'bibi')
+    hashed = stored_password(db, 2)
+    assert hashed.startswith('scrypt:')
+    #the hash is checked from now on
+    login(app.test_client(), 'bibi@bibi', 'bibi')
+    assert stored_password(db, 2) == hashed
+
+
+def test_registered_password_is_hashed(app, db):
+    client = app.test_client()
+    client.post('/register', data={'name': 'New', 'email': 'new@example.com', 'password': 'secret'})
+    user_id, password = db.execute("SELECT user_id, password FROM users WHERE email = 'new@example.com'").fetchone()
+    assert password.startswith('scrypt:') and 'secret' not in password
+    client.get('/logout')
+    login(client, 'new@example.com', 'secret')
+
+
+def test_api_session_throttled(app):
+    app.config['LOGIN_EMAIL_BURST'] = 100
+    client = app.test_client()
+    responses = [client.post('/api/v1/session', json={'email': f'user{n}@example.com', 'password': 'x'}) for n in range(11)]
+    assert [r.status_code for r in responses[:10]] == [401] * 10
+    assert responses[10].status_code == 429 and int(responses[10].headers['Retry-After']) > 0
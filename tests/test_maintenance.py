@@ -0,0 +1,22 @@
+from app import Maintenance, maintenance_command
+
+
+def test_failed_backup_does_not_stop_the_other_tasks(app, tmp_path):
+    #a file where the backup directory should be makes every backup fail with an OSError
+    (tmp_path / 'backups').write_text('')
+    app.config['BACKUP_DIR'] = str(tmp_path / 'backups')
+    with app.app_context():
+        maintenance = Maintenance(app.config)
+        assert maintenance.tick(force=True) == ['backup']
+        assert {'checkpoint', 'optimize', 'prune', 'analyze', 'vacuum'} <= set(maintenance.last_run)
+        #the loop keeps going, the backup is retried once its interval has passed
+        assert maintenance.tick() == []
+        maintenance.conn.close()
+
+
+def test_maintenance_once_exits_non_zero_on_failure(app, tmp_path):
+    (tmp_path / 'backups').write_text('')
+    app.config['BACKUP_DIR'] = str(tmp_path / 'backups')
+    result = app.test_cli_runner().invoke(maintenance_command, ['--once'])
+    assert result.exit_code == 1
+    assert 'checkpoint:' in result.output
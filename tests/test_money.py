@@ -0,0 +1,34 @@
+import pytest
+
+from app import Money, import_products_command
+from conftest import login
+
+
+@pytest.mark.parametrize('text', ['1e30', '1e20', '92233720368547758.08', 'nan', 'abc'])
+def test_parse_rejects(text):
+    with pytest.raises(ValueError):
+        Money.parse(text)
+
+
+def test_parse_largest_amount():
+    assert Money.parse('92233720368547758.07').cents == 2 ** 63 - 1
+
+
+@pytest.mark.parametrize('amount', ['1e30', '1e20'])
+def test_add_funds_out_of_range(app, db, amount):
+    client = login(app.test_client(), 'bibi@bibi', 'bibi')
+    before = db.execute('SELECT wallet_balance_cents FROM users WHERE user_id = 2').fetchone()[0]
+    response = client.post('/add-funds', data={'amount': amount})
+    assert response.headers['Location'] == '/wallet?error=amount'
+    assert db.execute('SELECT wallet_balance_cents FROM users WHERE user_id = 2').fetchone()[0] == before
+
+
+def test_import_skips_out_of_range_prices(app, db, tmp_path):
+    path = tmp_path / 'products.csv'
+    path.write_text('name,price,quantity,category\nPen,1.50,3,Electronics\nHuge,1e30,1,Electronics\n'
+                    'Big,1e20,1,Electronics\nCup,2,1,Electronics\n')
+    result = app.test_cli_runner().invoke(import_products_command, [str(path), '--owner-user-id', '2', '--batch-size', '1'])
+    assert result.exit_code == 0, result.output
+    assert '2 products imported, 2 rows skipped' in result.output
+    names = {row[0] for row in db.execute("SELECT name FROM items WHERE name IN ('Pen', 'Huge', 'Big', 'Cup')")}
+    assert names == {'Pen', 'Cup'}
@@ -0,0 +1,27 @@
+import threading
+import time
+
+import app as bazaro
+
+
+def test_concurrent_first_requests_share_one_pool(app, monkeypatch):
+    class SlowPool(bazaro.ConnectionPool):
+        def __init__(self, *args, **kwargs):
+            time.sleep(0.05)
+            super().__init__(*args, **kwargs)
+
+    monkeypatch.setattr(bazaro, 'ConnectionPool', SlowPool)
+    barrier = threading.Barrier(8)
+    pools = []
+
+    def first_request():
+        barrier.wait()
+        pools.append(bazaro.get_pool(app, 'rw'))
+
+    threads = [threading.Thread(target=first_request) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(pools) == 8
+    assert all(pool is pools[0] for pool in pools)
@@ -0,0 +1,33 @@
+import io
+
+from app import import_products_command
+from conftest import login
+
+
+def test_export_without_products_has_header(app, db):
+    db.execute("INSERT INTO users (name, email, password) VALUES ('Empty', 'empty@example.com', 'pw')")
+    db.commit()
+    client = login(app.test_client(), 'empty@example.com', 'pw')
+    response = client.get('/export-products')
+    assert response.get_data(as_text=True).splitlines() == ['item_id,name,description,price,quantity,category,image']
+
+
+def test_import_requires_an_owner(app, tmp_path):
+    path = tmp_path / 'products.csv'
+    path.write_text('name,price,quantity,category\nPen,1.50,3,Electronics\n')
+    result = app.test_cli_runner().invoke(import_products_command, [str(path)])
+    assert result.exit_code == 2
+    assert '--owner-user-id or --seller-id' in result.output
+    result = app.test_cli_runner().invoke(import_products_command, [str(path), '--owner-user-id', '2'])
+    assert result.exit_code == 0, result.output
+    assert '1 products imported' in result.output
+
+
+def test_import_page_with_a_broken_images_archive(app):
+    client = login(app.test_client(), 'bibi@bibi', 'bibi')
+    response = client.post('/import-products', content_type='multipart/form-data', data={
+        'products_file': (io.BytesIO(b'name,price,quantity,category\nPen,1.50,3,Electronics\n'), 'products.csv'),
+        'images_archive': (io.BytesIO(b'not a zip'), 'images.zip'),
+    })
+    assert response.status_code == 200
+    assert 'could not read the file' in response.get_data(as_text=True)
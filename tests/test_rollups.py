@@ -0,0 +1,39 @@
+import threading
+
+from app import job_worker, rebuild_co_purchases_command, rebuild_sales_rollups_command
+from conftest import login
+
+ROLLUP_TABLES = ['sales_daily', 'sales_by_category', 'sales_by_seller', 'sales_by_item', 'sales_rollup_orders',
+                 'co_purchases', 'co_purchase_top', 'co_purchase_orders']
+
+
+def snapshot(db):
+    #sorted rows, so the comparison doesn't depend on each table's key columns
+    return {table: sorted(map(tuple, db.execute(f'SELECT * FROM {table}'))) for table in ROLLUP_TABLES}
+
+
+def rebuild(app):
+    runner = app.test_cli_runner()
+    assert runner.invoke(rebuild_sales_rollups_command).exit_code == 0
+    assert runner.invoke(rebuild_co_purchases_command).exit_code == 0
+
+
+def test_order_jobs_match_a_full_rebuild(app, db):
+    rebuild(app)
+    client = login(app.test_client(), 'bibi@bibi', 'bibi')
+    client.post('/add-funds', data={'amount': '100000'})
+    for cart in [(3, 4), (3, 5), (4,)]:
+        for item_id in cart:
+            client.post(f'/add-to-cart/{item_id}')
+        assert client.post('/checkout').headers['Location'] == '/orders?success=1'
+
+    #the order_placed jobs update the rollups incrementally
+    before = snapshot(db)
+    job_worker(app, threading.Event(), 0.1, True)
+    assert db.execute("SELECT COUNT(*) FROM jobs WHERE status != 'done'").fetchone()[0] == 0
+    incremental = snapshot(db)
+    assert incremental['sales_by_item'] != before['sales_by_item']
+    assert any(tuple(row[:2]) == (3, 4) for row in incremental['co_purchases'])
+
+    rebuild(app)
+    assert snapshot(db) == incremental
@@ -0,0 +1,7 @@
+# WSGI entry point for production servers, e.g.
+#   gunicorn -c gunicorn.conf.py wsgi:app
+# Run the schema migrations once before starting the workers (gunicorn.conf.py
+# does that in its on_starting hook, or run `flask --app app migrate`), not from every worker process.
+from app import create_app
+
+app = create_app()